@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Cost of archiving every message, and of searching a chat, as the archive grows.
+
+Adds `--messages` messages over `--groups` chats to a `ChatArchive`, as
+`MyBot.save_state` does, timing the adds, then times `--searches` searches
+of random chats for one or two words, through the full-text index, and with
+a scan of the chat's messages (LIKE) for comparison.
+
+    python3 bench/bench_archive.py [--messages 200000] [--groups 500]
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import statistics
+
+import anyio
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from archive import ChatArchive  # noqa: E402
+
+# chat words are roughly Zipf distributed: a few very common, most rare
+COMMON = ("the a to and i you it is of in that for on be we was so at lol not").split()
+_letters = random.Random(0)
+RARE = [
+    "".join(_letters.choices("abcdefghijklmnopqrstuvwxyz", k=6)) for _ in range(5000)
+]
+WORDS = COMMON + RARE
+WEIGHTS = [1 / (rank + 1) for rank in range(len(WORDS))]
+
+
+def like_search(archive, chat_id, words):
+    query = "SELECT sender, time, body FROM messages WHERE chat_id = ?"
+    query += " AND body LIKE ?" * len(words) + " ORDER BY time DESC LIMIT 10"
+    args = [chat_id] + [f"%{word}%" for word in words]
+    return archive.db.execute(query, args).fetchall()
+
+
+def percentiles(times):
+    times = sorted(times)
+    return (
+        f"median {statistics.median(times) * 1e3:6.2f}ms  "
+        f"p95 {times[int(len(times) * 0.95)] * 1e3:6.2f}ms"
+    )
+
+
+async def run(args, tmp_dir):
+    rng = random.Random(1)
+    groups = [f"group{i:05d}/bench=" for i in range(args.groups)]
+    archive = ChatArchive(os.path.join(tmp_dir, "archive.db"))
+    adds = []
+    now = time.time() - args.messages
+    for i in range(args.messages):
+        msg = " ".join(rng.choices(WORDS, WEIGHTS, k=rng.randint(3, 20)))
+        start = time.perf_counter()
+        archive.add(rng.choice(groups), f"+4470000{i % 50:05d}", msg, now + i)
+        adds.append(time.perf_counter() - start)
+    size = sum(
+        os.path.getsize(os.path.join(tmp_dir, name)) for name in os.listdir(tmp_dir)
+    )
+    print(
+        f"{args.messages} messages in {args.groups} chats: add {percentiles(adds)}"
+        f"  archive {size / 1024 / 1024:.1f} MB"
+    )
+
+    # words used in many messages, and in hardly any (or misspelt)
+    for label, vocabulary in (("common", RARE[:100]), ("rare", RARE[3000:])):
+        fts, like = [], []
+        found = 0
+        for _ in range(args.searches):
+            chat_id = rng.choice(groups)
+            words = rng.sample(vocabulary, rng.randint(1, 2))
+            start = time.perf_counter()
+            results = await archive.search(chat_id, " ".join(words))
+            fts.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            expected = like_search(archive, chat_id, words)
+            like.append(time.perf_counter() - start)
+            found += len(results)
+            assert len(results) == len(expected), (results, expected)
+        print(
+            f"{label:<6} words, index: {percentiles(fts)}  "
+            f"({found / len(fts):.1f} results)"
+        )
+        print(f"{label:<6} words, scan:  {percentiles(like)}")
+    archive.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--messages", type=int, default=200000)
+    parser.add_argument("--groups", type=int, default=500)
+    parser.add_argument("--searches", type=int, default=200)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        anyio.run(run, args, tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Shared tmpfs usage of image downloads, with and without the quota.
+
+A local HTTP server serves `--size-mb` "images", which `--sends` concurrent
+sends each download `--images` of, and hold for `--hold` seconds (as long
+as signald takes to read them) before releasing.  The run without a quota
+shows how much space a burst needs; with `--quota-mb`, the peak stays under
+it and the sends wait their turn instead of failing with a full tmpfs.
+
+    python3 bench/bench_attachments.py [--sends 16] [--quota-mb 48]
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer
+
+import anyio
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+sys.path.insert(0, os.path.dirname(__file__))
+
+from bench_download import _ImageHandler  # noqa: E402
+from attachments import AttachmentStore, QuotaExceeded  # noqa: E402
+from downloads import make_http_client  # noqa: E402
+
+MB = 1024 * 1024
+
+
+def disk_usage(directory):
+    return sum(entry.stat().st_size for entry in os.scandir(directory))
+
+
+async def run(args, url, quota):
+    with tempfile.TemporaryDirectory() as out_dir:
+        store = AttachmentStore(out_dir, quota=quota, wait_timeout=args.timeout)
+        peak = 0
+        rejected = 0
+
+        async def send():
+            nonlocal rejected
+            files = []
+            try:
+                async with anyio.create_task_group() as tg:
+                    for _ in range(args.images):
+                        tg.start_soon(download, files)
+                await anyio.sleep(args.hold)
+            except (QuotaExceeded, anyio.ExceptionGroup):
+                rejected += 1
+            finally:
+                for file in files:
+                    store.release(file)
+
+        async def download(files):
+            files.append(await store.download(client, url, ".png", 64 * MB))
+
+        async def sample():
+            nonlocal peak
+            while True:
+                peak = max(peak, disk_usage(out_dir))
+                await anyio.sleep(0.01)
+
+        start = time.perf_counter()
+        async with make_http_client(max_connections=100) as client:
+            async with anyio.create_task_group() as tg:
+                tg.start_soon(sample)
+                async with anyio.create_task_group() as sends:
+                    for _ in range(args.sends):
+                        sends.start_soon(send)
+                tg.cancel_scope.cancel()
+        elapsed = time.perf_counter() - start
+        assert store.used == 0 and store.files == 0 and not os.listdir(out_dir)
+    return elapsed, peak, rejected
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sends", type=int, default=16)
+    parser.add_argument("--images", type=int, default=2)
+    parser.add_argument("--size-mb", type=int, default=3)
+    parser.add_argument("--hold", type=float, default=0.5)
+    parser.add_argument("--quota-mb", type=int, default=48)
+    parser.add_argument("--timeout", type=float, default=60)
+    args = parser.parse_args()
+
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), _ImageHandler)
+    httpd.daemon_threads = True
+    httpd.image_size = args.size_mb * MB
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    host, port = httpd.server_address
+    url = f"http://{host}:{port}/image.png"
+    for label, quota in (("no quota", 1 << 62), ("quota", args.quota_mb * MB)):
+        elapsed, peak, rejected = anyio.run(run, args, url, quota)
+        print(
+            f"{label:<9} {elapsed:6.2f}s  peak tmpfs {peak / MB:6.1f} MB  "
+            f"rejected {rejected}/{args.sends}"
+        )
+    httpd.shutdown()
+
+
+if __name__ == "__main__":
+    main()
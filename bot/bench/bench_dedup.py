@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Cost of the seen-message index for paid commands, as it grows.
+
+Adds `--messages` keys to a `SeenIndex` (as `MyBot.first_run` does for each
+paid command), timing the adds and the lookups at each size in `--sizes`,
+then reopens it from disk, as after a restart, and checks every key still
+in the index is found again.  Keys older than `--ttl` (in simulated time)
+expire, and the file is compacted as they do.
+
+    python3 bench/bench_dedup.py [--messages 200000] [--max-entries 10000]
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from dedup import SeenIndex, message_key  # noqa: E402
+from fake_signal import make_chats  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--messages", type=int, default=200000)
+    parser.add_argument("--max-entries", type=int, default=10000)
+    parser.add_argument("--ttl", type=float, default=3600)
+    parser.add_argument("--interval", type=float, default=0.1)
+    args = parser.parse_args()
+
+    chats = make_chats(16)
+    now = [1.7e9]
+    keys = [
+        message_key(chats[i % 16].context("/dalle3 x").message, f"chat{i % 16}", "d")
+        for i in range(args.messages)
+    ]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "seen.bin")
+        index = SeenIndex(
+            path, ttl=args.ttl, max_entries=args.max_entries, clock=lambda: now[0]
+        )
+        step = args.messages // 5
+        for start in range(0, args.messages, step):
+            batch = keys[start : start + step]
+            before = time.perf_counter()
+            for key in batch:
+                now[0] += args.interval
+                index.add(key)
+            add = (time.perf_counter() - before) / len(batch)
+            before = time.perf_counter()
+            found = sum(key in index for key in batch)
+            check = (time.perf_counter() - before) / len(batch)
+            print(
+                f"{start + len(batch):7d} added: add {add * 1e6:5.2f}us  "
+                f"check {check * 1e6:5.2f}us  in index {len(index.seen):6d}  "
+                f"({found} of the last {len(batch)})  "
+                f"file {os.path.getsize(path) / 1024:6.0f} KB"
+            )
+        live = list(index.seen)
+        index.close()
+
+        before = time.perf_counter()
+        reopened = SeenIndex(
+            path, ttl=args.ttl, max_entries=args.max_entries, clock=lambda: now[0]
+        )
+        elapsed = time.perf_counter() - before
+        again = sum(not reopened.add(key) for key in live)
+        print(
+            f"reopened in {elapsed * 1000:.1f}ms, "
+            f"{again} of {len(live)} live keys seen again"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Peak memory of image downloads, buffered versus streamed.
+
+A local HTTP server serves large "images".  "buffered" fetches them one at a
+time with `utils.save_image` (the whole body in memory), "streamed" fetches
+them all in parallel with `downloads.download_to_file`.  Each mode runs in its
+own process, and reports its peak RSS above the baseline after start-up.
+
+    python3 bench/bench_download.py [--images 4] [--size-mb 32]
+"""
+
+import os
+import sys
+import time
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import anyio
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from utils import save_image  # noqa: E402
+from downloads import make_http_client, download_to_file, tmp_path  # noqa: E402
+
+
+class _ImageHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        size = self.server.image_size
+        chunk = os.urandom(1024 * 1024)
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+        for _ in range(size // len(chunk)):
+            self.wfile.write(chunk)
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_mode(mode, url, n, out_dir, max_bytes):
+    baseline = peak_rss_mb()
+    start = time.perf_counter()
+    if mode == "buffered":
+        for _ in range(n):
+            save_image(url, tmp_path(out_dir, ".png"))
+    else:
+
+        async def streamed():
+            async with make_http_client() as client:
+                async with anyio.create_task_group() as tg:
+                    for _ in range(n):
+                        path = tmp_path(out_dir, ".png")
+                        tg.start_soon(download_to_file, client, url, path, max_bytes)
+
+        anyio.run(streamed)
+    elapsed = time.perf_counter() - start
+    print(f"{mode:<9} {elapsed:6.2f}s  peak RSS +{peak_rss_mb() - baseline:6.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--images", type=int, default=4)
+    parser.add_argument("--size-mb", type=int, default=32)
+    parser.add_argument("--mode", choices=["buffered", "streamed"])
+    parser.add_argument("--url")
+    args = parser.parse_args()
+    max_bytes = (args.size_mb + 1) * 1024 * 1024
+
+    with tempfile.TemporaryDirectory() as out_dir:
+        if args.mode:
+            run_mode(args.mode, args.url, args.images, out_dir, max_bytes)
+            return
+
+        httpd = ThreadingHTTPServer(("127.0.0.1", 0), _ImageHandler)
+        httpd.daemon_threads = True
+        httpd.image_size = args.size_mb * 1024 * 1024
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        host, port = httpd.server_address
+        for mode in ("buffered", "streamed"):
+            subprocess.run(
+                [
+                    sys.executable,
+                    __file__,
+                    f"--mode={mode}",
+                    f"--url=http://{host}:{port}/image.png",
+                    f"--images={args.images}",
+                    f"--size-mb={args.size_mb}",
+                ],
+                check=True,
+            )
+        httpd.shutdown()
+
+
+if __name__ == "__main__":
+    main()
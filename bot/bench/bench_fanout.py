@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+/thots latency and cost when asking one model, or several at once.
+
+Runs `MyBot.convo_fn` `--requests` times, `--concurrency` at a time, in
+different chats, against a local fake OpenAI server where the models take
+`--delay` seconds, and a random `--slow-rate` of requests take a further
+`--slow-delay`, the tail that hedging is meant to cut.  Modes:
+
+  single   the default model only
+  first    all of `--models` at once, replying with the first answer
+  hedged   the first model, and the others after `--hedge-after` seconds
+  all      all of `--models`, each reply sent labelled with its model
+
+Reports the time to the first message (median, p95, max) and the requests
+made per /thots, as each one is paid for.
+
+    python3 bench/bench_fanout.py [--requests 200] [--slow-rate 0.1]
+"""
+
+import os
+import sys
+import argparse
+import tempfile
+import statistics
+
+import anyio
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from fake_openai import FakeOpenAI  # noqa: E402
+from fake_signal import make_chats  # noqa: E402
+from bench_mailbox import make_bot, start_bot  # noqa: E402
+
+
+def modes(args):
+    models = args.models
+    return {
+        "single": {"BOT_FANOUT_MODELS": "", "BOT_FANOUT": "first"},
+        "first": {"BOT_FANOUT_MODELS": models, "BOT_FANOUT": "first"},
+        "hedged": {
+            "BOT_FANOUT_MODELS": models,
+            "BOT_FANOUT": "first",
+            "BOT_FANOUT_HEDGE_AFTER": str(args.hedge_after),
+        },
+        "all": {"BOT_FANOUT_MODELS": models, "BOT_FANOUT": "all"},
+    }
+
+
+async def run(env, args, server):
+    os.environ.update(env)
+    requests_before = len(server.requests)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        chats = make_chats(args.concurrency)
+        bot = make_bot(tmp_dir, chats)
+        limiter = anyio.CapacityLimiter(args.concurrency)
+
+        async def thots(i):
+            async with limiter:
+                chat = chats[i % len(chats)]
+                await bot.convo_fn(chat.context("/thots will it rain?"))
+
+        async with anyio.create_task_group() as tg:
+            await start_bot(bot, tg, chats)
+            async with anyio.create_task_group() as requests:
+                for i in range(args.requests):
+                    requests.start_soon(thots, i)
+            tg.cancel_scope.cancel()
+        # the requests of cancelled hedges are still counted, as they're paid
+        await anyio.sleep(args.delay + args.slow_delay)
+        made = (len(server.requests) - requests_before) / args.requests
+        return [t["first_message"] for t in bot.reply_timings], made
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--models", default="gpt-4o,gpt-4o-mini")
+    parser.add_argument("--delay", type=float, default=0.2)
+    parser.add_argument("--slow-rate", type=float, default=0.1)
+    parser.add_argument("--slow-delay", type=float, default=2.0)
+    parser.add_argument("--hedge-after", type=float, default=0.4)
+    args = parser.parse_args()
+
+    os.environ["OPENAI_DEFAULT_CONCURRENCY"] = str(2 * args.concurrency)
+    for mode, env in modes(args).items():
+        # each mode gets the same sequence of slow responses
+        with FakeOpenAI(
+            delay=args.delay, slow_rate=args.slow_rate, slow_delay=args.slow_delay
+        ) as server:
+            os.environ["OPENAI_BASE_URL"] = server.base_url
+            os.environ.setdefault("OPENAI_API_KEY", "fake")
+            latencies, made = anyio.run(run, env, args, server)
+        latencies.sort()
+        print(
+            f"{mode:<7} first message: median {statistics.median(latencies):.2f}s  "
+            f"p95 {latencies[int(len(latencies) * 0.95)]:.2f}s  "
+            f"max {latencies[-1]:.2f}s  requests per /thots {made:.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of the per-message cost of the history stores.
+
+Each store is filled to MAX_MESSAGES and then timed over a run of appends,
+as done by `MyBot.save_state` for every message in an allow-listed chat.
+
+    python3 bench/bench_history.py [--messages 2000] [--groups 10]
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from history import HISTORY_STORES  # noqa: E402
+
+
+def bench_store(kind, state_dir, max_messages, n_messages, n_groups):
+    store = HISTORY_STORES[kind](state_dir, max_messages)
+    groups = [f"group/{i}=" for i in range(n_groups)]
+    msg = "a fairly typical group chat message, about this long " * 2
+    for group_id in groups:
+        for _ in range(max_messages):
+            store.append(group_id, ("+441234567890", msg))
+
+    timings = []
+    for i in range(n_messages):
+        group_id = groups[i % n_groups]
+        start = time.perf_counter()
+        store.load(group_id)
+        store.append(group_id, ("+441234567890", msg))
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--groups", type=int, default=10)
+    parser.add_argument("--max-messages", type=int, default=50)
+    args = parser.parse_args()
+
+    print(f"{'store':<8} {'mean (us)':>10} {'p50 (us)':>10} {'p99 (us)':>10}")
+    for kind in HISTORY_STORES:
+        with tempfile.TemporaryDirectory() as state_dir:
+            timings = bench_store(
+                kind, state_dir, args.max_messages, args.messages, args.groups
+            )
+        timings = sorted(t * 1e6 for t in timings)
+        p50 = timings[len(timings) // 2]
+        p99 = timings[int(len(timings) * 0.99)]
+        print(f"{kind:<8} {statistics.mean(timings):>10.1f} {p50:>10.1f} {p99:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
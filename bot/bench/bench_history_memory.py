@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Memory used per retained history message, before and after `Turn` records.
+
+Writes logs for `--groups` chats of `--messages` turns each, from senders
+identified by phone numbers or UUIDs, then measures (with tracemalloc) the
+memory of loading every group with `LogHistoryStore`, against the previous
+representation: plain `(number, msg)` tuples straight from `json.loads`,
+with a separate copy of the sender string in every entry.
+
+    python3 bench/bench_history_memory.py [--groups 200] [--messages 50]
+"""
+
+import os
+import sys
+import json
+import random
+import argparse
+import tempfile
+import tracemalloc
+from collections import deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from history import LogHistoryStore, group_key  # noqa: E402
+
+MESSAGES = [
+    "lol",
+    "anyone about tonight?",
+    "did you see the match, absolute scenes",
+    "aye go on then, I'll bring snacks 🍕",
+    "a fairly typical group chat message, about this long, give or take",
+]
+
+
+def write_logs(state_dir, args, rng):
+    groups = [f"group{i:04d}/test=" for i in range(args.groups)]
+    for g, group_id in enumerate(groups):
+        senders = [f"+44{g:04d}{j:06d}" for j in range(3)] + [
+            f"{g:08x}-1111-2222-3333-{j:012x}" for j in range(2)
+        ]
+        with open(os.path.join(state_dir, f"{group_key(group_id)}.log"), "w") as f:
+            for _ in range(args.messages):
+                turn = (rng.choice(senders), rng.choice(MESSAGES))
+                f.write(json.dumps(turn) + "\n")
+    return groups
+
+
+def load_tuples(state_dir, groups, max_messages):
+    # the previous in-memory representation
+    buffers = {}
+    for group_id in groups:
+        buffer = deque(maxlen=max_messages)
+        with open(os.path.join(state_dir, f"{group_key(group_id)}.log")) as f:
+            for line in f:
+                number, msg = json.loads(line)
+                buffer.append((number, msg))
+        buffers[group_id] = buffer
+    return buffers
+
+
+def load_turns(state_dir, groups, max_messages):
+    store = LogHistoryStore(state_dir, max_messages)
+    for group_id in groups:
+        store.load(group_id)
+    return store
+
+
+def measure(load, *args):
+    tracemalloc.start()
+    kept = load(*args)  # noqa: F841, kept alive while measuring
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size, kept
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--groups", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as state_dir:
+        groups = write_logs(state_dir, args, random.Random(0))
+        total = args.groups * args.messages
+        for name, load in (("tuples", load_tuples), ("turns", load_turns)):
+            size, kept = measure(load, state_dir, groups, args.messages)
+            print(f"{name:<7} {size / total:6.1f} bytes per retained message")
+        print(f"store's own estimate: {kept.memory / total:.1f} bytes per message")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Bursty traffic through `MyBot`, with and without the per-chat mailboxes.
+
+Every chat gets a burst of messages, several of them /thots, delivered
+concurrently the way semaphore delivers them.  "direct" runs each message's
+commands straight away (the old behaviour), "mailbox" goes through
+`message_handler` and the chat mailboxes.  Reports the completions requested
+from a local fake OpenAI server, and the wall time.
+
+    python3 bench/bench_mailbox.py [--chats 20] [--burst 5] [--coalesce-window 0.3]
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+
+import anyio
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from fake_openai import FakeOpenAI  # noqa: E402
+from fake_signal import make_chats, burst, FakeSignalBot  # noqa: E402
+
+
+def make_bot(tmp_dir, chats, **options):
+    from bot import MyBot
+
+    allow_list = os.path.join(tmp_dir, "allowlist.json")
+    with open(allow_list, "w") as f:
+        json.dump({chat.group_id: "bench" for chat in chats}, f)
+    usernames = os.path.join(tmp_dir, "usernames.json")
+    with open(usernames, "w") as f:
+        json.dump(
+            {m.number: f"Member {m.number[-3:]}" for c in chats for m in c.members}, f
+        )
+    return MyBot(
+        bot_number=chats[0].bot_number,
+        bot_default_name="Bench Bot",
+        bot_default_model="gpt-4o",
+        admin_number="+449999999999",
+        admin_uuid="admin-uuid",
+        socket_path=os.path.join(tmp_dir, "signald.sock"),
+        usernames_file=usernames,
+        allow_list_file=allow_list,
+        state_dir=os.path.join(tmp_dir, "state"),
+        shared_tmpfs=tmp_dir,
+        **options,
+    )
+
+
+async def start_bot(bot, tg, chats):
+    # start the bot's background work, connected to a fake signald
+    await bot.start_services(tg)
+    bot.signal = FakeSignalBot(chats)
+    bot.outbox.connected()
+
+
+def bodies(n):
+    chat = ["anyone about?", "lol", "did you see that", "aye go on then"]
+    return [
+        "/thots what do you reckon?" if i % 2 == 0 else chat[i % len(chat)]
+        for i in range(n)
+    ]
+
+
+async def run(mode, args):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        chats = make_chats(args.chats)
+        bot = make_bot(tmp_dir, chats)
+
+        async def direct(ctx):
+            route = bot.router.route(ctx.message.get_body())
+            await bot.process_commands(route, ctx)
+
+        handler = direct if mode == "direct" else bot.message_handler
+        start = time.perf_counter()
+        async with anyio.create_task_group() as tg:
+            await start_bot(bot, tg, chats)
+            async with anyio.create_task_group() as senders:
+                for chat in chats:
+                    senders.start_soon(
+                        burst, handler, chat, bodies(args.burst), args.interval
+                    )
+            while (any(bot.mailboxes.queued().values()) or bot.outbox.queued()) or sum(
+                len(c.replies) for c in chats
+            ) < len(chats):
+                await anyio.sleep(0.01)
+            # let the last batches finish
+            await anyio.sleep(args.delay * 2)
+            tg.cancel_scope.cancel()
+        return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--burst", type=int, default=5)
+    parser.add_argument("--interval", type=float, default=0.05)
+    parser.add_argument("--delay", type=float, default=0.5)
+    parser.add_argument("--coalesce-window", type=float, default=0.0)
+    args = parser.parse_args()
+    os.environ["BOT_COALESCE_WINDOW"] = str(args.coalesce_window)
+
+    with FakeOpenAI(delay=args.delay) as server:
+        os.environ["OPENAI_BASE_URL"] = server.base_url
+        os.environ.setdefault("OPENAI_API_KEY", "fake")
+        os.environ.setdefault("OPENAI_CONCURRENCY", f"gpt-4o={args.chats}")
+        for mode in ("direct", "mailbox"):
+            server.requests.clear()
+            elapsed = anyio.run(run, mode, args)
+            print(
+                f"{mode:<8} {len(server.requests):4d} completions for "
+                f"{args.chats * args.burst} messages in {elapsed:.2f}s"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+/server-on, /server-off and /server-status against moto's mock EC2.
+
+Starts instances in a mocked EC2 and writes a minecraft.json giving one chat
+a single server and another `--servers` of them, then sends the commands to
+`MyBot` through fake chats and checks the replies and instance states.  The
+EC2 client is created once and reused; its calls are timed against creating
+a new client for every call, as the bot used to.
+
+    python3 bench/bench_minecraft.py [--servers 3] [--calls 20]
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+
+import anyio
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+sys.path.insert(0, os.path.dirname(__file__))
+
+from utils import AwsEc2Api  # noqa: E402
+from fake_signal import make_chats, FakeSignalBot  # noqa: E402
+from bench_mailbox import make_bot  # noqa: E402
+
+# moto only needs credentials to exist
+for name in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"):
+    os.environ.setdefault(name, "testing")
+
+
+def start_instances(count):
+    ec2 = AwsEc2Api.client("ec2")
+    image_id = ec2.describe_images()["Images"][0]["ImageId"]
+    response = ec2.run_instances(ImageId=image_id, MinCount=count, MaxCount=count)
+    return [instance["InstanceId"] for instance in response["Instances"]]
+
+
+def states(instance_ids):
+    described = AwsEc2Api.describe_instances(instance_ids)
+    return [described[instance_id][0] for instance_id in instance_ids]
+
+
+async def command(bot, chat, body):
+    # send a command, and wait for its reply
+    replies = len(chat.replies)
+    await bot.message_handler(chat.context(body, chat.members[0]))
+    with anyio.fail_after(10):
+        while len(chat.replies) == replies:
+            await anyio.sleep(0.01)
+    return chat.replies[-1][0]
+
+
+async def run(args, tmp_dir):
+    single, several = make_chats(2)
+    ids = start_instances(1 + args.servers)
+    info = {ids[0]: ["10.0.0.1", single.group_id]}
+    for i, instance_id in enumerate(ids[1:]):
+        info[instance_id] = [f"10.0.1.{i}", several.group_id]
+    minecraft_file = os.path.join(tmp_dir, "minecraft.json")
+    with open(minecraft_file, "w") as f:
+        json.dump(info, f)
+
+    bot = make_bot(tmp_dir, [single, several], minecraft_file=minecraft_file)
+    async with anyio.create_task_group() as tg:
+        await bot.start_services(tg)
+        bot.signal = FakeSignalBot([single, several])
+        bot.outbox.connected()
+
+        # a chat only controls its own servers, the first one for on and off
+        print(await command(bot, several, "/server-off"))
+        print("states:", states(ids))
+        status = await command(bot, several, "/server-status")
+        print(status.replace("\n", ", "))
+        assert status.count("stopped") == 1 and status.count("running") == 2
+        print(await command(bot, several, "/server-on"))
+        print(await command(bot, single, "/server-off"))
+        print("states:", states(ids))
+        assert states(ids) == ["stopped"] + ["running"] * args.servers
+
+        # the commands all used the one client
+        client = AwsEc2Api.client("ec2")
+        await command(bot, several, "/server-status")
+        assert AwsEc2Api.client("ec2") is client
+        tg.cancel_scope.cancel()
+
+    # the EC2 calls of a /server-status, with the client reused, and with a
+    # new client for every call
+    for name, reuse in (("reused", True), ("new client", False)):
+        start = time.perf_counter()
+        for _ in range(args.calls):
+            if not reuse:
+                AwsEc2Api._clients.clear()
+            AwsEc2Api.describe_instances(ids[1:])
+        elapsed = (time.perf_counter() - start) / args.calls
+        print(f"describe_instances, {name:10}  {elapsed * 1000:6.1f}ms per call")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--servers", type=int, default=3)
+    parser.add_argument("--calls", type=int, default=20)
+    args = parser.parse_args()
+
+    from moto import mock_aws
+
+    with tempfile.TemporaryDirectory() as tmp_dir, mock_aws():
+        anyio.run(run, args, tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+Shows that concurrent /thots completions no longer serialise on the event loop.
+
+Runs N concurrent chat completions through `OpenAIPool` against a local fake
+OpenAI server with a fixed delay.  With the per-model limit >= N the batch
+finishes in roughly the time of one request; the blocking client it replaced
+took N times as long.
+
+    python3 bench/bench_openai.py [--requests 8] [--delay 1.0] [--limit 8]
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import anyio
+from openai import AsyncOpenAI
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from llm import OpenAIPool  # noqa: E402
+from fake_openai import FakeOpenAI  # noqa: E402
+
+
+async def run(args, base_url):
+    client = AsyncOpenAI(base_url=base_url, api_key="fake")
+    pool = OpenAIPool(client=client, limits={"gpt-4o": args.limit}, timeout=30)
+    messages = [{"role": "user", "content": "Alice: what's up?"}]
+
+    async def one(i):
+        completion = await pool.chat("gpt-4o", messages, max_tokens=256)
+        assert completion.choices[0].message.content
+
+    start = time.perf_counter()
+    async with anyio.create_task_group() as tg:
+        for i in range(args.requests):
+            tg.start_soon(one, i)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=8)
+    parser.add_argument("--delay", type=float, default=1.0)
+    parser.add_argument("--limit", type=int, default=8)
+    args = parser.parse_args()
+
+    with FakeOpenAI(delay=args.delay) as server:
+        elapsed = anyio.run(run, args, server.base_url)
+    print(
+        f"{args.requests} concurrent completions ({args.delay:.1f}s each, "
+        f"limit {args.limit}): {elapsed:.2f}s, "
+        f"serial would take {args.requests * args.delay:.1f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
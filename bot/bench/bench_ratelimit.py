@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+The quotas and fair sharing of the paid commands, through `MyBot`.
+
+Prints the credits each kind of request is charged (per image for /dalle3,
+per model for a fan-out /thots), then has one member of a chat send
+`--requests` of them in a row and counts how many run straight away, are
+delayed until their credits are there, or are turned away.  Last, a busy
+group queues `--busy` requests for a single backend slot, and a quiet group
+sends one after them; with fair queueing the quiet group's request runs
+next rather than last.
+
+    python3 bench/bench_ratelimit.py [--requests 8] [--busy 10]
+"""
+
+import os
+import sys
+import argparse
+import tempfile
+
+import anyio
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from fake_signal import make_chats  # noqa: E402
+from bench_mailbox import make_bot, start_bot  # noqa: E402
+from ratelimit import FairScheduler  # noqa: E402
+
+REQUESTS = [
+    ("/thots", "/thots what do you reckon?", []),
+    ("/thots", "/thots what do you reckon?", ["gpt-4o", "gpt-4o-mini", "o1"]),
+    ("/dalle3", "/dalle3 a cat in a hat", []),
+    ("/dalle3", "/dalle3 x4 a cat in a hat", []),
+    ("/suno", "/suno a song about a cat", []),
+]
+
+
+async def outcomes(command, body, models, requests):
+    # a fresh bot's quotas, spent by one member sending the same request
+    chat = make_chats(1)[0]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        bot = make_bot(tmp_dir, [chat])
+        ran = await spend(bot, chat, command, body, models, requests)
+    # the outbox merges replies sent close together
+    replies = "\n".join(reply[0] for reply in chat.replies)
+    delayed = replies.count("will run in")
+    rejected = replies.count("again in")
+    return bot.command_cost(chat.context(body), command), ran, delayed, rejected
+
+
+async def spend(bot, chat, command, body, models, requests):
+    bot.FANOUT_MODELS = models
+    ran = []
+
+    async def handler(ctx):
+        ran.append(ctx)
+
+    async with anyio.create_task_group() as tg:
+        await start_bot(bot, tg, [chat])
+        for _ in range(requests):
+            await bot.run_limited(chat.context(body, chat.members[0]), command, handler)
+        while bot.outbox.queued():
+            await anyio.sleep(0.01)
+        tg.cancel_scope.cancel()
+    return len(ran)
+
+
+async def fair_share(busy):
+    # the position the quiet group's request runs at, behind a busy group
+    scheduler = FairScheduler(slots=1)
+    order = []
+
+    async def request(key):
+        async with scheduler.slot(key):
+            order.append(key)
+            await anyio.sleep(0.01)
+
+    async with anyio.create_task_group() as tg:
+        for _ in range(busy):
+            tg.start_soon(request, "busy")
+        await anyio.sleep(0.001)
+        tg.start_soon(request, "quiet")
+    return order.index("quiet") + 1
+
+
+async def run(args):
+    print(f"{args.requests} requests in a row from one member")
+    for command, body, models in REQUESTS:
+        cost, ran, delayed, rejected = await outcomes(
+            command, body, models, args.requests
+        )
+        label = body.split(" a ")[0].split(" what")[0]
+        if models:
+            label += f" ({len(models)} models)"
+        print(
+            f"  {label:24} {cost:3} credits  ran {ran}, delayed {delayed},"
+            f" turned away {rejected}"
+        )
+        assert ran + delayed + rejected == args.requests
+    position = await fair_share(args.busy)
+    print(f"quiet group's request ran {position} of {args.busy + 1}")
+    assert position <= 2
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=8)
+    parser.add_argument("--busy", type=int, default=10)
+    args = parser.parse_args()
+    anyio.run(run, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Per-message command dispatch cost, before and after `CommandRouter`.
+
+"linear" is the dispatch `message_handler` and `process_commands` used to do:
+three substring checks, then a scan of each command table over the words,
+plus `remove_commands` for messages that carry a command.  "router" is one
+`CommandRouter.route` call, which returns both the commands and the body.
+
+    python3 bench/bench_router.py [--messages 100000]
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from router import CommandRouter  # noqa: E402
+
+PUBLIC = dict.fromkeys(["/show-group-id", "/reload-allow-list", "/show-uuid"])
+SPECIAL = dict.fromkeys(
+    [
+        "/help",
+        "/set-name",
+        "/server-on",
+        "/server-off",
+        "/clear",
+        "/suno-limits",
+        "/suno-status",
+        "/echo",
+    ]
+)
+COMMANDS = dict.fromkeys(["/thots", "/dalle3", "/suno", "/suno-custom"])
+ADMIN = dict.fromkeys(["/awright"])
+
+CHAT = [
+    "haha yeah",
+    "anyone around tonight? thinking of getting food after work",
+    "did you see the match last night, absolute scenes in the second half",
+    "lol",
+    "I'll be there in 10",
+    "https://example.com/some/article/about/things worth a read",
+    "can't believe it's raining again, that's the fourth day in a row now",
+]
+WITH_COMMANDS = [
+    "/thots what do you reckon about that?",
+    "ok bot, /thots",
+    "/dalle3 a cat in a top hat riding a bicycle through Glasgow, oil painting",
+    "/suno a sea shanty about missing the last train home",
+    "/help",
+    "/set-name Alice",
+    "/server-on",
+    "/suno-limits",
+]
+
+
+def corpus(n, command_share, seed=0):
+    rng = random.Random(seed)
+    return [
+        rng.choice(WITH_COMMANDS if rng.random() < command_share else CHAT)
+        for _ in range(n)
+    ]
+
+
+def linear(msg):
+    for command in PUBLIC:
+        if command in msg.lower():
+            return command
+    words = msg.lower().split()
+    for command in SPECIAL:
+        if command in words:
+            return command
+    for command in ADMIN:
+        if command in words:
+            return command
+    queue = []
+    for command in COMMANDS:
+        if command in words:
+            words.remove(command)
+            queue.append(command)
+    body = " ".join(words)
+    if queue:
+        body = msg
+        for table in (SPECIAL, COMMANDS, ADMIN):
+            for command in table:
+                body = body.replace(command, "")
+        body = body.strip()
+    return queue, body
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--command-share", type=float, default=0.2)
+    args = parser.parse_args()
+
+    router = CommandRouter(
+        [
+            ("public", PUBLIC),
+            ("special", SPECIAL),
+            ("admin", ADMIN),
+            ("regular", COMMANDS),
+        ]
+    )
+    messages = corpus(args.messages, args.command_share)
+
+    for name, dispatch in (("linear", linear), ("router", router.route)):
+        start = time.perf_counter()
+        for msg in messages:
+            dispatch(msg)
+        elapsed = time.perf_counter() - start
+        print(f"{name:<8} {elapsed / len(messages) * 1e9:8.0f} ns/message")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Throughput of the bot run as one process, and sharded over worker processes.
+
+Runs `bot.py` as it is deployed, against a fake signald and OpenAI, with
+BOT_WORKERS set to each of `--workers` (0 is the single process).  Sends
+`--messages` messages over `--groups` group chats as fast as signald would
+deliver them: numbered `/echo`s, with a `/thots` every `--thots-every`
+messages, and waits for all the replies.  Reports the time taken, and checks
+each chat's echoes came back in the order they were sent, and the CPU time
+of the process talking to signald (the front, when sharded).
+
+    python3 bench/bench_shards.py [--workers 0,2,4] [--messages 2000]
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from fake_openai import FakeOpenAI  # noqa: E402
+from fake_signal import FakeSignald, make_chats  # noqa: E402
+
+SRC = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+BOT_NUMBER = "+440000000000"
+ECHO = re.compile(r"\(echo\): (\d+)")
+
+
+def write_config(tmp_dir, chats):
+    with open(os.path.join(tmp_dir, "allowlist.json"), "w") as f:
+        json.dump({chat.group_id: "bench" for chat in chats}, f)
+    with open(os.path.join(tmp_dir, "usernames.json"), "w") as f:
+        json.dump(
+            {m.number: f"Member {m.number[-3:]}" for c in chats for m in c.members}, f
+        )
+
+
+def bot_env(tmp_dir, workers, openai):
+    return dict(
+        os.environ,
+        BOT_NUMBER=BOT_NUMBER,
+        BOT_DEFAULT_NAME="Bench Bot",
+        BOT_DEFAULT_MODEL="gpt-4o",
+        BOT_ADMIN_NUMBER="+449999999999",
+        BOT_ADMIN_UUID="admin-uuid",
+        SIGNALD_SOCKET_PATH=os.path.join(tmp_dir, "signald.sock"),
+        BOT_STATE_DIR=os.path.join(tmp_dir, "state"),
+        BOT_SHARED_TMPFS=tmp_dir,
+        BOT_WORKERS=str(workers),
+        BOT_LOG_LEVEL="WARNING",
+        BOT_SEND_INTERVAL="0",
+        BOT_GROUP_BURST="1000000",
+        BOT_USER_BURST="1000000",
+        BOT_BACKEND_SLOTS="64",
+        OPENAI_BASE_URL=openai.base_url,
+        OPENAI_API_KEY="fake",
+        OPENAI_DEFAULT_CONCURRENCY="64",
+    )
+
+
+def wait_for(condition, timeout, what):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise SystemExit(f"timed out waiting for {what}")
+        time.sleep(0.01)
+
+
+def echoes(signald):
+    # the echoed numbers sent to each chat, in the order signald got them
+    sent = defaultdict(list)
+    for request in list(signald.received):
+        if request.get("type") == "send":
+            for n in ECHO.findall(request["messageBody"]):
+                sent[request.get("recipientGroupId")].append(int(n))
+    return sent
+
+
+def run(args, workers):
+    chats = make_chats(args.groups)
+    with tempfile.TemporaryDirectory() as tmp_dir, FakeOpenAI() as openai:
+        write_config(tmp_dir, chats)
+        with FakeSignald(os.path.join(tmp_dir, "signald.sock")) as signald:
+            bot = subprocess.Popen(
+                [sys.executable, os.path.join(SRC, "bot.py")],
+                cwd=tmp_dir,
+                env=bot_env(tmp_dir, workers, openai),
+            )
+            try:
+                wait_for(lambda: signald.subscribers, 30, "the bot to subscribe")
+                # give the workers time to start and connect to the front
+                time.sleep(1 + workers)
+                expected = defaultdict(list)
+                start = time.monotonic()
+                for i in range(args.messages):
+                    chat = chats[i % len(chats)]
+                    member = chat.members[i % len(chat.members)]
+                    if i % args.thots_every == 0:
+                        body = "/thots what do you reckon?"
+                    else:
+                        body = f"/echo {i}"
+                        expected[chat.group_id].append(i)
+                    signald.incoming(BOT_NUMBER, chat.group_id, member, body)
+                total = sum(len(numbers) for numbers in expected.values())
+                wait_for(
+                    lambda: sum(map(len, echoes(signald).values())) >= total,
+                    600,
+                    "the replies",
+                )
+                elapsed = time.monotonic() - start
+                front_cpu = cpu_seconds(bot.pid)
+            finally:
+                bot.terminate()
+                bot.wait(30)
+            in_order = echoes(signald) == expected
+    return elapsed, front_cpu, in_order
+
+
+def cpu_seconds(pid):
+    # user and system time of a running process
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--workers", default="0,2,4")
+    parser.add_argument("--groups", type=int, default=32)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--thots-every", type=int, default=4)
+    args = parser.parse_args()
+
+    for workers in map(int, args.workers.split(",")):
+        elapsed, front_cpu, in_order = run(args, workers)
+        print(
+            f"workers {workers}: {args.messages} messages in {elapsed:.2f}s, "
+            f"{args.messages / elapsed:.0f} msgs/s, "
+            f"signald process CPU {front_cpu:.1f}s, "
+            f"replies {'in order' if in_order else 'OUT OF ORDER'}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Startup cost of the bot: time until `bot.start()` and RSS at that point.
+
+Starts `MyBot.run` in a fresh interpreter with `python -X importtime`,
+against a fake signald socket, and stops it when it reaches `bot.start()`.
+Reports the wall time from launching the interpreter, the peak RSS, which
+of the backend SDKs had been imported, and the slowest top-level imports.
+
+    python3 bench/bench_startup.py [--runs 5]
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from fake_signal import FakeSignald  # noqa: E402
+
+SRC = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+SDKS = ("openai", "httpx", "requests", "boto3", "botocore", "tiktoken")
+
+CHILD = """
+import os, sys, json, time, resource
+sys.path.insert(0, {src!r})
+import anyio
+import semaphore
+
+async def started(self):
+    print(json.dumps({{
+        "ready": time.time(),
+        "rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "sdks": [name for name in {sdks!r} if name in sys.modules],
+    }}))
+    sys.stdout.flush()
+    os._exit(0)
+
+semaphore.Bot.start = started
+from bot import MyBot
+
+tmp_dir = {tmp_dir!r}
+bot = MyBot(
+    bot_number="+440000000000",
+    bot_default_name="Bench Bot",
+    bot_default_model="gpt-4o",
+    admin_number="+449999999999",
+    admin_uuid="admin-uuid",
+    socket_path=os.path.join(tmp_dir, "signald.sock"),
+    usernames_file=os.path.join(tmp_dir, "usernames.json"),
+    allow_list_file=os.path.join(tmp_dir, "allowlist.json"),
+    state_dir=os.path.join(tmp_dir, "state"),
+    shared_tmpfs=tmp_dir,
+    minecraft_file=os.path.join(tmp_dir, "minecraft.json"),
+)
+anyio.run(bot.run)
+"""
+
+
+def top_imports(stderr, n):
+    # the slowest imports made directly by the bot's own modules
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        if depth <= 1:
+            imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)[:n]
+
+
+def run_once(tmp_dir):
+    env = dict(os.environ, OPENAI_API_KEY="fake", BOT_LOG_LEVEL="OFF")
+    code = CHILD.format(src=SRC, sdks=SDKS, tmp_dir=tmp_dir)
+    start = time.time()
+    child = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        env=env,
+        cwd=tmp_dir,
+        timeout=60,
+    )
+    if child.returncode:
+        raise SystemExit(child.stderr[-2000:])
+    result = json.loads(child.stdout.strip().splitlines()[-1])
+    result["elapsed"] = result["ready"] - start
+    result["imports"] = top_imports(child.stderr, 8)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        with FakeSignald(os.path.join(tmp_dir, "signald.sock")):
+            results = [run_once(tmp_dir) for _ in range(args.runs)]
+
+    elapsed = statistics.median(r["elapsed"] for r in results)
+    rss = statistics.median(r["rss_kb"] for r in results) / 1024
+    print(f"time to bot.start(): {elapsed * 1000:.0f}ms, peak RSS {rss:.1f}MB")
+    print(f"SDKs imported at start: {', '.join(results[-1]['sdks']) or 'none'}")
+    print("slowest top-level imports (cumulative):")
+    for us, name in results[-1]["imports"]:
+        print(f"  {us / 1000:7.1f}ms  {name}")
+
+
+if __name__ == "__main__":
+    main()
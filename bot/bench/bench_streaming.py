@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Time to first message for /thots, with and without streamed replies.
+
+Runs `MyBot.convo_fn` against a local fake OpenAI server that takes `--delay`
+seconds before the first token and `--token-delay` per word after it, and
+reports the bot's recorded timings: time to first token, time until the
+first message was sent, and the total.
+
+    python3 bench/bench_streaming.py [--requests 5] [--delay 0.5] [--token-delay 0.02]
+"""
+
+import os
+import sys
+import argparse
+import tempfile
+import statistics
+
+import anyio
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from fake_openai import FakeOpenAI  # noqa: E402
+from fake_signal import make_chats  # noqa: E402
+from bench_mailbox import make_bot, start_bot  # noqa: E402
+
+REPLY = (
+    "Bot: Honestly, I reckon it could go either way. "
+    "The forecast said rain, but it has been wrong all week, and the "
+    "sky looks clear enough from here. If you're heading out I'd take a "
+    "jacket anyway, just in case. Worst case you carry it around for a "
+    "bit. Best case you stay dry and smug while everyone else gets soaked. "
+    "Either way, have a good one and send pictures if it does pour."
+)
+
+
+async def run(stream, args):
+    os.environ["BOT_STREAM_REPLIES"] = "1" if stream else "0"
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        chats = make_chats(1)
+        bot = make_bot(tmp_dir, chats)
+        async with anyio.create_task_group() as tg:
+            await start_bot(bot, tg, chats)
+            for _ in range(args.requests):
+                await bot.convo_fn(chats[0].context("/thots will it rain?"))
+            while bot.outbox.queued():
+                await anyio.sleep(0.01)
+            tg.cancel_scope.cancel()
+        messages = len(chats[0].replies) / args.requests
+        return list(bot.reply_timings), messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=5)
+    parser.add_argument("--delay", type=float, default=0.5)
+    parser.add_argument("--token-delay", type=float, default=0.02)
+    args = parser.parse_args()
+
+    with FakeOpenAI(
+        delay=args.delay, reply=REPLY, token_delay=args.token_delay
+    ) as server:
+        os.environ["OPENAI_BASE_URL"] = server.base_url
+        os.environ.setdefault("OPENAI_API_KEY", "fake")
+        for stream in (False, True):
+            timings, messages = anyio.run(run, stream, args)
+            summary = "  ".join(
+                f"{key} {statistics.median(t[key] for t in timings):.2f}s"
+                for key in ("first_token", "first_message", "total")
+            )
+            mode = "stream" if stream else "complete"
+            print(f"{mode:<8} {summary}  ({messages:.0f} messages per reply)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Prompt size of a long running chat, with and without rolling summaries.
+
+Plays `--messages` turns into one chat, keeping `--history` of them, and
+builds a /thots prompt every 10 turns, as `convo_fn` does.  With summaries,
+older turns are folded by a stub LLM that takes `--delay` seconds and
+returns a summary of at most `--summary-words` words, so the folds run in
+the background while the chat carries on.  Reports the prompt tokens, and
+checks the summary is picked up again from disk by a new `Summarizer`.
+
+    python3 bench/bench_summaries.py [--messages 1000] [--history 200]
+"""
+
+import os
+import sys
+import random
+import argparse
+import tempfile
+import statistics
+
+import anyio
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from history import LogHistoryStore  # noqa: E402
+from context import ContextBuilder, estimate_tokens  # noqa: E402
+from summaries import Summarizer  # noqa: E402
+
+GROUP = "group/bench="
+BOT = "+440000000000"
+SENDERS = [BOT] + [f"+4470000000{i:02d}" for i in range(5)]
+WORDS = "pizza match tonight snacks film boardgames pub weekend rain".split()
+
+
+def stub_llm(args, calls):
+    async def complete(messages, max_tokens):
+        calls.append(len(messages[-1]["content"]))
+        await anyio.sleep(args.delay)
+        # "summarise" by keeping the newest words that fit
+        words = messages[-1]["content"].split()
+        return " ".join(words[-args.summary_words :])
+
+    return complete
+
+
+async def play(args, state_dir, summaries):
+    rng = random.Random(1)
+    usernames = {number: f"user{i}" for i, number in enumerate(SENDERS)}
+    history = LogHistoryStore(state_dir, args.history)
+    context = ContextBuilder(
+        BOT,
+        usernames,
+        default_budget=100000,
+        tokenizer_factory=lambda m: estimate_tokens,
+    )
+    calls = []
+    tokens = []
+    async with anyio.create_task_group() as tg:
+        summarizer = None
+        if summaries:
+            summarizer = Summarizer(
+                state_dir,
+                stub_llm(args, calls),
+                lambda user, msg: usernames[user] + ": " + msg,
+                fold_after=args.fold_after,
+                keep=args.keep,
+            )
+            summarizer.start(tg)
+        for i in range(args.messages):
+            msg = " ".join(rng.choices(WORDS, k=rng.randint(3, 20)))
+            history.append(GROUP, (rng.choice(SENDERS), msg))
+            if summarizer is not None:
+                summarizer.maybe_fold(GROUP, history.load(GROUP))
+            if i % 10 == 9:
+                msg_history = history.load(GROUP)
+                summary = None
+                if summarizer is not None:
+                    summary, msg_history = summarizer.split(GROUP, msg_history)
+                context.build("bench", msg_history, 256, GROUP, summary)
+                tokens.append(context.last_prompt[GROUP]["tokens"])
+            await anyio.sleep(args.interval)
+
+    if summarizer is not None:
+        # a restarted bot picks the summary up from disk
+        reloaded = Summarizer(state_dir, None, None)
+        assert reloaded.split(GROUP, history.load(GROUP)) == summarizer.split(
+            GROUP, history.load(GROUP)
+        )
+    return tokens, calls
+
+
+def report(name, tokens, calls):
+    late = tokens[len(tokens) // 2 :]
+    print(
+        f"{name:>10}: prompt tokens mean {statistics.mean(late):7.0f}"
+        f"  max {max(late):6d}  (second half), folds {len(calls)}"
+    )
+
+
+async def main(args):
+    for summaries in (False, True):
+        with tempfile.TemporaryDirectory() as state_dir:
+            tokens, calls = await play(args, state_dir, summaries)
+        report("summaries" if summaries else "history", tokens, calls)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--history", type=int, default=200)
+    parser.add_argument("--fold-after", type=int, default=30)
+    parser.add_argument("--keep", type=int, default=10)
+    parser.add_argument("--summary-words", type=int, default=150)
+    parser.add_argument("--delay", type=float, default=0.05)
+    parser.add_argument("--interval", type=float, default=0.001)
+    anyio.run(main, parser.parse_args())
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Finished Suno songs posted as links, and as attachments.
+
+Runs `--jobs` Suno jobs through `MyBot` against a local suno-api stub, whose
+clips are `--size-kb` of audio, and which cuts off the first download of
+each clip after `--drop-kb` (0 never), to check downloads resume.  Modes:
+"links" posts the audio urls, "attachments" downloads both clips of a song
+in parallel and sends them as one message, and "capped" has a size cap
+below the clips' size, so they fall back to links.  Reports the time from
+submitting to the songs being posted, what was sent, and checks each
+attachment had the stub's audio when it was sent.
+
+    python3 bench/bench_suno_audio.py [--jobs 4] [--size-kb 4096]
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+import anyio
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from utils import SunoAPI  # noqa: E402
+from metrics import METRICS  # noqa: E402
+from fake_suno import FakeSuno  # noqa: E402
+from fake_signal import make_chats, FakeSignalBot  # noqa: E402
+from bench_mailbox import make_bot, start_bot  # noqa: E402
+
+MODES = {
+    "links": {"SUNO_ATTACHMENTS": "0"},
+    "attachments": {"SUNO_ATTACHMENTS": "1"},
+    "capped": {"SUNO_ATTACHMENTS": "1", "SUNO_MAX_AUDIO_BYTES": "1024"},
+}
+
+
+class CheckingSignalBot(FakeSignalBot):
+    # checks attachments while they are being sent, before they are released
+    def __init__(self, chats, bot, suno):
+        super().__init__(chats)
+        self.bot = bot
+        self.suno = suno
+        self.attachments = 0
+        self.bad = 0
+
+    async def send_message(self, receiver, body, attachments=None, **kwargs):
+        for attachment in attachments or []:
+            # named song-<job id>-<n>.mp3
+            _, job_id, n = attachment.custom_filename[: -len(".mp3")].split("-")
+            clip_id = self.bot.suno_jobs.jobs[job_id]["clip_ids"][int(n) - 1]
+            with open(attachment.filename, "rb") as f:
+                self.bad += f.read() != self.suno.audio(clip_id)
+            self.attachments += 1
+        return await super().send_message(receiver, body, attachments)
+
+
+def retries():
+    return sum(METRICS.counters.get("download_retries_total", {}).values())
+
+
+async def run(mode, args, suno):
+    os.environ.update(MODES[mode])
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        chats = make_chats(args.jobs)
+        bot = make_bot(tmp_dir, chats)
+        bot.suno_jobs.poll_interval = 0.1
+        retries_before = retries()
+        start = time.perf_counter()
+        async with anyio.create_task_group() as tg:
+            await start_bot(bot, tg, chats)
+            bot.signal = signal = CheckingSignalBot(chats, bot, suno)
+            for chat in chats:
+                bot.suno_jobs.submit(chat.group_id, {"prompt": "a song"})
+            # the limits are sent last for each song (merged with the links)
+            while sum("Credits left" in body for _, body in signal.sent) < args.jobs:
+                await anyio.sleep(0.01)
+            elapsed = time.perf_counter() - start
+            tg.cancel_scope.cancel()
+        links = sum(body.count("Audio ") for _, body in signal.sent)
+        left = bot.attachments.files
+    print(
+        f"{mode:<12} {elapsed:6.2f}s  attachments {signal.attachments:3d}  "
+        f"links {links:3d}  resumed {retries() - retries_before:3d}  "
+        f"bad {signal.bad}  files left {left}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--jobs", type=int, default=4)
+    parser.add_argument("--size-kb", type=int, default=4096)
+    parser.add_argument("--drop-kb", type=int, default=512)
+    parser.add_argument("--ready-after", type=float, default=0.5)
+    parser.add_argument("--complete-after", type=float, default=1.0)
+    args = parser.parse_args()
+
+    with FakeSuno(
+        ready_after=args.ready_after,
+        complete_after=args.complete_after,
+        audio_size=args.size_kb * 1024,
+        drop_after=args.drop_kb * 1024,
+    ) as suno:
+        SunoAPI.base_url = suno.base_url
+        for mode in MODES:
+            anyio.run(run, mode, args, suno)
+
+
+if __name__ == "__main__":
+    main()
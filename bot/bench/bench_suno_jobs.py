@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Runs Suno jobs through `SunoJobQueue` against a local suno-api stub.
+
+Submits N songs from different chats at once, and reports when each one is
+posted back, while checking that the event loop stays responsive.  Half way
+through, the queue is restarted from its jobs file to check jobs resume.
+
+    python3 bench/bench_suno_jobs.py [--jobs 4] [--ready-after 2.0]
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+import anyio
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from utils import SunoAPI  # noqa: E402
+from suno_jobs import SunoJobQueue  # noqa: E402
+from fake_suno import FakeSuno  # noqa: E402
+
+
+async def run(args, jobs_file):
+    start = time.perf_counter()
+    finished = []
+
+    async def notify(job):
+        elapsed = time.perf_counter() - start
+        finished.append(job)
+        print(f"{elapsed:6.2f}s  {job['chat_id']}: {job['status']} {job['urls']}")
+
+    def make_queue():
+        return SunoJobQueue(
+            jobs_file, notify, max_jobs=args.max_jobs, poll_interval=0.2
+        )
+
+    # submit the jobs, then cancel the queue as though the bot restarted
+    async with anyio.create_task_group() as tg:
+        queue = make_queue()
+        await queue.start(tg)
+        for i in range(args.jobs):
+            queue.submit(f"chat-{i}", {"prompt": f"song {i}", "wait_audio": False})
+        await anyio.sleep(args.ready_after / 2)
+        tg.cancel_scope.cancel()
+
+    # the jobs are resumed from the jobs file
+    max_lag = 0.0
+    async with anyio.create_task_group() as tg:
+        queue = make_queue()
+        await queue.start(tg)
+        while len(finished) < args.jobs:
+            before = time.perf_counter()
+            await anyio.sleep(0.01)
+            max_lag = max(max_lag, time.perf_counter() - before - 0.01)
+        for job in queue.status("chat-0"):
+            print(f"status of chat-0: {job['id']} {job['status']}")
+    print(f"worst event loop lag: {max_lag * 1000:.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--jobs", type=int, default=4)
+    parser.add_argument("--max-jobs", type=int, default=2)
+    parser.add_argument("--ready-after", type=float, default=2.0)
+    args = parser.parse_args()
+
+    with FakeSuno(ready_after=args.ready_after) as server:
+        SunoAPI.base_url = server.base_url
+        with tempfile.TemporaryDirectory() as state_dir:
+            anyio.run(run, args, os.path.join(state_dir, "suno_jobs.json"))
+        print(f"generate calls: {server.generate_calls}, get calls: {server.get_calls}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+A local stand-in for the OpenAI API, for benchmarks and manual testing.
+
+Serves `/v1/chat/completions` and `/v1/images/generations` from a thread,
+sleeping for a configurable delay (per model) before each response, and
+for a further `slow_delay` on a random `slow_rate` of them, for a tail of
+slow responses.  Chat replies take a further `token_delay` per word, and
+with `"stream": true` are sent word by word as server-sent events.
+
+    with FakeOpenAI(delay=1.0) as server:
+        client = AsyncOpenAI(base_url=server.base_url, api_key="fake")
+"""
+
+import sys
+import json
+import time
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, data, status=200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_event(self, data):
+        self.wfile.write(f"data: {data}\n\n".encode())
+        self.wfile.flush()
+
+    def _stream_reply(self, model, words, token_delay):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        for i, word in enumerate(words + [None]):
+            if word is not None and i:
+                time.sleep(token_delay)
+            chunk = {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [
+                    {
+                        "index": 0,
+                        "delta": {} if word is None else {"content": word},
+                        "finish_reason": "stop" if word is None else None,
+                    }
+                ],
+            }
+            self._send_event(json.dumps(chunk))
+        self._send_event("[DONE]")
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        server = self.server.fake
+        model = request.get("model", "")
+        server.requests.append((self.path, request))
+        delay = server.delays.get(model, server.delay)
+        with server.lock:
+            if server.random.random() < server.slow_rate:
+                delay += server.slow_delay
+        time.sleep(delay)
+
+        if self.path.endswith("/chat/completions"):
+            # keep the spaces, so the words join back into the reply
+            words = [word + " " for word in server.reply.split(" ")]
+            words[-1] = words[-1][:-1]
+            if request.get("stream"):
+                self._stream_reply(model, words, server.token_delay)
+                return
+            time.sleep(server.token_delay * (len(words) - 1))
+            self._send_json(
+                {
+                    "id": "chatcmpl-fake",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": server.reply},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": {
+                        "prompt_tokens": 1,
+                        "completion_tokens": 1,
+                        "total_tokens": 2,
+                    },
+                }
+            )
+        elif self.path.endswith("/images/generations"):
+            self._send_json(
+                {
+                    "created": int(time.time()),
+                    "data": [
+                        {"url": server.image_url} for _ in range(request.get("n", 1))
+                    ],
+                }
+            )
+        else:
+            self._send_json({"error": {"message": "not found"}}, status=404)
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients hang up on requests they cancel, e.g. hedged ones
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class FakeOpenAI:
+    def __init__(
+        self,
+        delay=0.0,
+        delays=None,
+        reply="Bot: hello there",
+        image_url="",
+        token_delay=0.0,
+        slow_rate=0.0,
+        slow_delay=0.0,
+        seed=1,
+    ):
+        self.delay = delay
+        self.token_delay = token_delay
+        self.delays = delays or {}
+        self.slow_rate = slow_rate
+        self.slow_delay = slow_delay
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.reply = reply
+        self.image_url = image_url
+        self.requests = []
+        self._httpd = _Server(("127.0.0.1", 0), _Handler)
+        self._httpd.fake = self
+
+    @property
+    def base_url(self):
+        host, port = self._httpd.server_address
+        return f"http://{host}:{port}/v1"
+
+    def __enter__(self):
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._httpd.shutdown()
+        self._httpd.server_close()
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""
+Fake semaphore `ChatContext` objects, for driving `MyBot.message_handler`
+without signald.
+
+Replies are recorded on the context (and in `FakeChat.replies`) instead of
+being sent.
+"""
+
+import os
+import json
+import time
+import socket
+import random
+import itertools
+import threading
+import socketserver
+
+import anyio
+
+_timestamps = itertools.count(int(time.time() * 1000))
+
+
+class FakeAddress:
+    def __init__(self, number=None, uuid=None):
+        self.number = number
+        self.uuid = uuid
+
+
+class FakeMessage:
+    def __init__(self, chat, body, source):
+        self.chat = chat
+        self.body = body
+        self.source = source
+        self.username = chat.bot_number
+        self.timestamp = next(_timestamps)
+        self.attachments = []
+
+    def get_body(self):
+        return self.body
+
+    def get_group_id(self):
+        return self.chat.group_id
+
+    def empty(self):
+        return not self.body
+
+    async def reply(self, body, attachments=[], quote=False, **kwargs):
+        if self.chat.reply_delay:
+            await anyio.sleep(self.chat.reply_delay)
+        self.chat.replies.append((body, attachments, self.timestamp if quote else None))
+        return True
+
+    async def typing_started(self):
+        pass
+
+    async def typing_stopped(self):
+        pass
+
+    async def mark_read(self):
+        pass
+
+
+class FakeContext:
+    def __init__(self, message):
+        self.message = message
+        self.match = None
+        self.job_queue = None
+        self.bot = None
+
+
+class FakeChat:
+    """A group chat (or a direct chat if group_id is None) with some members."""
+
+    def __init__(self, group_id, members, bot_number="+440000000000", reply_delay=0):
+        self.group_id = group_id
+        self.members = members  # list of FakeAddress
+        self.bot_number = bot_number
+        self.reply_delay = reply_delay
+        self.replies = []
+
+    def context(self, body, member=None):
+        source = member if member is not None else random.choice(self.members)
+        return FakeContext(FakeMessage(self, body, source))
+
+
+def make_chats(n, members_per_chat=4):
+    chats = []
+    for i in range(n):
+        members = [
+            FakeAddress(number=f"+44{i:04d}{j:05d}", uuid=f"uuid-{i}-{j}")
+            for j in range(members_per_chat)
+        ]
+        chats.append(FakeChat(f"fakegroup{i:04d}/test=", members))
+    return chats
+
+
+class FakeSignalBot:
+    """
+    Stands in for the semaphore `Bot` for messages that aren't replies, which
+    are recorded in `sent`, and in the replies of the chat they are sent to.
+    """
+
+    def __init__(self, chats=()):
+        self.sent = []
+        self.chats = {chat.group_id: chat for chat in chats}
+
+    async def send_message(self, receiver, body, attachments=None, **kwargs):
+        self.sent.append((receiver, body))
+        chat = self.chats.get(receiver)
+        if chat is not None:
+            chat.replies.append((body, attachments or [], None))
+        return True
+
+
+async def burst(handler, chat, bodies, interval=0.0):
+    # deliver messages to the handler the way semaphore does, each in its own task
+    async with anyio.create_task_group() as tg:
+        for body in bodies:
+            tg.start_soon(handler, chat.context(body))
+            await anyio.sleep(interval)
+
+
+class _SignaldHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        fake = self.server.fake
+        with fake.lock:
+            fake.connections.append(self.connection)
+        for line in self.rfile:
+            request = json.loads(line)
+            fake.received.append(request)
+            if request.get("type") == "subscribe":
+                with fake.lock:
+                    fake.subscribers.append(self.connection)
+            if request.get("type") == "send" and "id" in request:
+                # signald's answer to a send that went through
+                response = {
+                    "id": request["id"],
+                    "data": {"results": [{"success": True}]},
+                }
+                fake.write(self.connection, response)
+
+
+class FakeSignald:
+    """
+    A signald socket that accepts connections, records what is sent to it
+    in `received`, and answers sends as successful, e.g. to run `MyBot.run`
+    without signald.  `incoming()` sends a message to the subscribed bots,
+    and `drop()` closes the open connections, as a signald restart does.
+    """
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self.received = []
+        self.connections = []
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self._server = socketserver.ThreadingUnixStreamServer(
+            socket_path, _SignaldHandler
+        )
+        self._server.daemon_threads = True
+        self._server.fake = self
+
+    def write(self, connection, data):
+        with self.write_lock:
+            connection.sendall(json.dumps(data).encode() + b"\n")
+
+    def incoming(self, account, group_id, source, body):
+        # a group message from `source` (a FakeAddress) to the bot `account`
+        timestamp = next(_timestamps)
+        data = {
+            "type": "IncomingMessage",
+            "data": {
+                "account": account,
+                "source": {"number": source.number, "uuid": source.uuid},
+                "type": "CIPHERTEXT",
+                "timestamp": timestamp,
+                "server_receiver_timestamp": timestamp,
+                "data_message": {
+                    "timestamp": timestamp,
+                    "body": body,
+                    "groupV2": {"id": group_id},
+                },
+            },
+        }
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for connection in subscribers:
+            self.write(connection, data)
+        return len(subscribers)
+
+    def sent(self):
+        # the bodies of the messages sent
+        return [r["messageBody"] for r in self.received if r.get("type") == "send"]
+
+    def drop(self):
+        with self.lock:
+            connections, self.connections = self.connections, []
+            self.subscribers = []
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass  # already closed by the bot
+
+    def __enter__(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.drop()
+        self._server.shutdown()
+        self._server.server_close()
+        os.remove(self.socket_path)
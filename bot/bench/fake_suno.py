@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+A local stub of the suno-api endpoints used by the bot.
+
+`/api/generate` and `/api/custom_generate` return two new clips, which
+`/api/get` reports as "submitted" until `ready_after` seconds have passed,
+"streaming" after, and "complete" after `complete_after` seconds.  Their
+audio is `audio_size` bytes at `/audio/<clip id>.mp3`, which honours Range
+requests, and if `drop_after` is set, the first request for each clip is
+cut off after that many bytes, as a flaky CDN would.
+
+    with FakeSuno(ready_after=2.0) as server:
+        SunoAPI.base_url = server.base_url
+"""
+
+import re
+import json
+import time
+import hashlib
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, data, status=200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _clip(self, clip_id):
+        server = self.server.fake
+        age = time.time() - server.clips[clip_id]
+        ready = age >= server.ready_after
+        status = "streaming" if ready else "submitted"
+        if age >= server.complete_after:
+            status = "complete"
+        return {
+            "id": clip_id,
+            "status": status,
+            "audio_url": f"{server.base_url}/audio/{clip_id}.mp3" if ready else "",
+        }
+
+    def _send_audio(self, clip_id):
+        server = self.server.fake
+        audio = server.audio(clip_id)
+        start = 0
+        match = re.match(r"bytes=(\d+)-", self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            self.send_response(206)
+            self.send_header(
+                "Content-Range", f"bytes {start}-{len(audio) - 1}/{len(audio)}"
+            )
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", "audio/mpeg")
+        self.send_header("Content-Length", str(len(audio) - start))
+        self.end_headers()
+        with server.lock:
+            server.audio_requests[clip_id] = server.audio_requests.get(clip_id, 0) + 1
+            drop = server.drop_after and server.audio_requests[clip_id] == 1
+        if drop:
+            self.wfile.write(audio[start : start + server.drop_after])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(audio[start:])
+
+    def do_POST(self):
+        server = self.server.fake
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        if urlparse(self.path).path not in ("/api/generate", "/api/custom_generate"):
+            self._send_json({"error": "not found"}, status=404)
+            return
+        server.generate_calls += 1
+        clip_ids = []
+        with server.lock:
+            for _ in range(2):
+                clip_id = f"clip-{len(server.clips)}"
+                server.clips[clip_id] = time.time()
+                clip_ids.append(clip_id)
+        self._send_json([self._clip(clip_id) for clip_id in clip_ids])
+
+    def do_GET(self):
+        server = self.server.fake
+        url = urlparse(self.path)
+        if url.path == "/api/get":
+            server.get_calls += 1
+            ids = parse_qs(url.query)["ids"][0].split(",")
+            self._send_json([self._clip(clip_id) for clip_id in ids])
+        elif url.path.startswith("/audio/"):
+            self._send_audio(url.path[len("/audio/") : -len(".mp3")])
+        elif url.path == "/api/get_limit":
+            self._send_json(
+                {"credits_left": 500, "monthly_limit": 500, "monthly_usage": 0}
+            )
+        else:
+            self._send_json({"error": "not found"}, status=404)
+
+
+class FakeSuno:
+    def __init__(
+        self, ready_after=2.0, complete_after=None, audio_size=1024, drop_after=0
+    ):
+        self.ready_after = ready_after
+        self.complete_after = ready_after if complete_after is None else complete_after
+        self.audio_size = audio_size
+        self.drop_after = drop_after
+        self.audio_requests = {}  # clip id -> number of requests for its audio
+        self.clips = {}  # clip id -> creation time
+        self.lock = threading.Lock()
+        self.generate_calls = 0
+        self.get_calls = 0
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self._httpd.daemon_threads = True
+        self._httpd.fake = self
+
+    def audio(self, clip_id):
+        # the same bytes for every request, so resumed downloads can be checked
+        return hashlib.sha256(clip_id.encode()).digest() * (self.audio_size // 32)
+
+    @property
+    def base_url(self):
+        host, port = self._httpd.server_address
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._httpd.shutdown()
+        self._httpd.server_close()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Offline load test of `MyBot`, with fake chats and stubbed backends.
+
+Replays a mix of traffic across many group chats through
+`MyBot.message_handler` and the chat mailboxes, with fake OpenAI and Suno
+servers, and reports:
+
+- messages per second handled
+- p50/p99 latency from delivery until the message's commands are done
+- state I/O per message (history loads and appends, other state files),
+  from the bot's metrics
+
+Messages arrive as a Poisson process at `--rate` per second (0 delivers them
+all at once).  The mix gives the weight of each kind of message:
+
+    python3 bench/loadtest.py --groups 50 --messages 2000 \\
+        --mix chat=70,thots=20,suno=2,help=3,stats=5
+
+With `--max-p99` or `--min-rate` it exits with status 1 if the run is slower,
+so it can be used as a regression check.
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import statistics
+
+import anyio
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from fake_openai import FakeOpenAI  # noqa: E402
+from fake_suno import FakeSuno  # noqa: E402
+from fake_signal import make_chats  # noqa: E402
+from bench_mailbox import make_bot, start_bot  # noqa: E402
+
+BODIES = {
+    "chat": ["anyone about?", "lol", "did you see that", "aye go on then"],
+    "thots": ["/thots what do you reckon?", "/thots settle this for us"],
+    "suno": ["/suno a sea shanty about the group chat"],
+    "dalle": ["/dalle3 a cat in a teapot"],
+    "help": ["/help"],
+    "stats": ["/cache-stats"],
+    "status": ["/suno-status"],
+}
+
+
+def parse_mix(spec):
+    mix = {}
+    for item in spec.split(","):
+        kind, _, weight = item.partition("=")
+        if kind.strip() not in BODIES:
+            raise SystemExit(f"unknown message kind {kind!r}, one of {list(BODIES)}")
+        mix[kind.strip()] = float(weight or 1)
+    return mix
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def traffic(args, chats, rng):
+    # (delay before delivery, chat, body) for every message
+    kinds, weights = zip(*parse_mix(args.mix).items())
+    for _ in range(args.messages):
+        kind = rng.choices(kinds, weights)[0]
+        delay = rng.expovariate(args.rate) if args.rate else 0.0
+        yield delay, rng.choice(chats), rng.choice(BODIES[kind])
+
+
+async def run(args):
+    from metrics import METRICS
+    from llm import preload
+
+    # as done in the background by MyBot.run
+    preload()
+
+    rng = random.Random(args.seed)
+    latencies = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        chats = make_chats(args.groups)
+        bot = make_bot(tmp_dir, chats)
+        bot.suno_jobs.poll_interval = 0.1
+
+        delivered = {}  # id of the message -> delivery time
+        process_commands = bot.process_commands
+
+        async def timed_process_commands(route, ctx, skip=()):
+            await process_commands(route, ctx, skip)
+            latencies.append(time.perf_counter() - delivered.pop(id(ctx.message)))
+
+        bot.process_commands = timed_process_commands
+
+        start = time.perf_counter()
+        async with anyio.create_task_group() as tg:
+            await start_bot(bot, tg, chats)
+            for delay, chat, body in traffic(args, chats, rng):
+                if delay:
+                    await anyio.sleep(delay)
+                ctx = chat.context(body)
+                delivered[id(ctx.message)] = time.perf_counter()
+                tg.start_soon(bot.message_handler, ctx)
+            while delivered:
+                await anyio.sleep(0.005)
+            elapsed = time.perf_counter() - start
+            tg.cancel_scope.cancel()
+
+    state = {
+        op: h.count
+        for ((_, op),), h in sorted(METRICS.histograms["state_seconds"].items())
+    }
+    return elapsed, latencies, state
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--groups", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--rate", type=float, default=0.0)
+    parser.add_argument("--mix", default="chat=70,thots=20,suno=2,help=3,stats=5")
+    parser.add_argument("--openai-delay", type=float, default=0.2)
+    parser.add_argument("--coalesce-window", type=float, default=0.0)
+    parser.add_argument("--history-store", default="log")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-p99", type=float, help="fail if p99 is above this")
+    parser.add_argument("--min-rate", type=float, help="fail if msgs/s is below this")
+    args = parser.parse_args()
+    os.environ["BOT_COALESCE_WINDOW"] = str(args.coalesce_window)
+    os.environ["BOT_HISTORY_STORE"] = args.history_store
+    os.environ.setdefault("BOT_LOG_LEVEL", "OFF")
+
+    from logs import setup_logging
+    from utils import SunoAPI
+
+    setup_logging(os.environ["BOT_LOG_LEVEL"])
+    with FakeOpenAI(delay=args.openai_delay) as openai, FakeSuno(0.2) as suno:
+        os.environ["OPENAI_BASE_URL"] = openai.base_url
+        os.environ.setdefault("OPENAI_API_KEY", "fake")
+        os.environ.setdefault("OPENAI_DEFAULT_CONCURRENCY", str(args.groups))
+        SunoAPI.base_url = suno.base_url
+        elapsed, latencies, state = anyio.run(run, args)
+
+        rate = len(latencies) / elapsed
+        p50, p99 = percentile(latencies, 0.5), percentile(latencies, 0.99)
+        print(
+            f"{len(latencies)} messages in {elapsed:.2f}s: {rate:.0f} msgs/s, "
+            f"latency p50 {p50 * 1000:.1f}ms p99 {p99 * 1000:.1f}ms "
+            f"mean {statistics.mean(latencies) * 1000:.1f}ms"
+        )
+        print(
+            "state I/O per message: "
+            + ", ".join(f"{op} {n / len(latencies):.2f}" for op, n in state.items())
+        )
+        print(
+            f"backend calls: {len(openai.requests)} OpenAI, "
+            f"{suno.generate_calls} Suno generate, {suno.get_calls} Suno get"
+        )
+
+    failed = (args.max_p99 is not None and p99 > args.max_p99) or (
+        args.min_rate is not None and rate < args.min_rate
+    )
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
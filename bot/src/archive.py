@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+"""
+Searchable archive of chat messages, in SQLite with a full-text index.
+
+The history stores only keep the last messages of each chat, for prompts;
+the archive keeps every message for `retention` seconds, for /search and
+admin exports.  `add` is called by `MyBot.save_state` for each message,
+inserting one row, which an FTS5 index is kept in step with by triggers.
+The database is in WAL mode without a sync on every commit, so an insert
+costs about as much as appending to a history log, and it's done on the
+event loop, as those are.  So an insert only waits BUSY_TIMEOUT for another
+process writing, and if it fails the message is kept and inserted with the
+next one.  Searches and exports run in a worker thread, on a connection of
+their own, and `run` deletes expired messages, a batch at a time.
+
+Each chat's messages are indexed with a token for the chat, so searching
+one chat only reads the index entries of that chat, however many there are.
+"""
+
+import os
+import glob
+import gzip
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+
+import anyio
+
+from metrics import METRICS
+
+log = logging.getLogger(__name__)
+
+EXPORT_MARGIN = 256 * 1024  # see _export
+# the longest an insert waits for another process's write, in milliseconds
+BUSY_TIMEOUT = 100
+MAX_PENDING = 10000  # messages kept to insert later, if inserts fail
+PRUNE_BATCH = 1000  # messages deleted in one transaction
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    chat_id TEXT NOT NULL,
+    sender TEXT NOT NULL,
+    time REAL NOT NULL,
+    body TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_chat_time ON messages (chat_id, time);
+CREATE INDEX IF NOT EXISTS messages_time ON messages (time);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    chat, body, content='',
+    tokenize='unicode61 remove_diacritics 2'
+);
+"""
+
+INSERT = "INSERT INTO messages (chat_id, sender, time, body) VALUES (?, ?, ?, ?)"
+
+# the triggers keep the index in step with the messages table
+TRIGGERS = """
+CREATE TRIGGER IF NOT EXISTS messages_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, chat, body)
+    VALUES (new.id, chat_token(new.chat_id), new.body);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_delete AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, chat, body)
+    VALUES ('delete', old.id, chat_token(old.chat_id), old.body);
+END;
+"""
+
+
+class ExportTooLarge(Exception):
+    pass
+
+
+def chat_token(chat_id):
+    # one word standing for the chat in the index, as ids are base64
+    return "c" + hashlib.blake2b(chat_id.encode(), digest_size=8).hexdigest()
+
+
+def match_query(chat_id, terms):
+    """
+    An FTS5 query for messages of the chat with all the words in terms, each
+    quoted so it's taken literally; a word ending in * matches as a prefix.
+    """
+    words = []
+    for word in terms.split():
+        prefix = word.endswith("*")
+        word = word.rstrip("*").replace('"', '""')
+        if word:
+            words.append(f'"{word}"' + ("*" if prefix else ""))
+    if not words:
+        return None
+    return f"chat : {chat_token(chat_id)} AND body : ({' '.join(words)})"
+
+
+class ChatArchive:
+    def __init__(self, path, retention=365 * 24 * 3600, prune_interval=3600.0):
+        self.path = path
+        self.retention = retention
+        self.prune_interval = prune_interval
+        self._read_db = None  # see _reader
+        self._read_lock = threading.Lock()
+        self.db = self._connect()
+        self.db.executescript(SCHEMA + TRIGGERS)
+        # a new archive starts with what the history logs have kept, once,
+        # even if several processes open it at the same time
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            if not self.db.execute("PRAGMA user_version").fetchone()[0]:
+                self.backfill(os.path.dirname(path))
+                self.db.execute("PRAGMA user_version = 1")
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        # inserts run on the event loop, so they don't wait long for the lock
+        self.db.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT}")
+        self._pending = []  # (chat id, sender, time, message) to insert
+
+    def _connect(self, **options):
+        db = sqlite3.connect(self.path, timeout=10, isolation_level=None, **options)
+        db.create_function("chat_token", 1, chat_token, deterministic=True)
+        # several processes can share the archive, see shards.py
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    def backfill(self, state_dir):
+        count = 0
+        for path in glob.glob(os.path.join(state_dir, "*.log")):
+            # the logs are named by group_key(chat id), and base64 group
+            # ids and numbers have no "_", so the id can be recovered
+            chat_id = os.path.basename(path)[: -len(".log")].replace("_", "/")
+            seen = os.path.getmtime(path)
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        sender, msg = json.loads(line)
+                    except ValueError:
+                        continue
+                    self._insert(chat_id, sender, msg, seen)
+                    count += 1
+        if count:
+            log.info("Archived %d messages from the history logs", count)
+
+    def _insert(self, chat_id, sender, msg, seen):
+        self.db.execute(INSERT, (chat_id, sender, seen, msg))
+
+    def add(self, chat_id, sender, msg, seen=None):
+        """
+        Archive a message.  If that fails, e.g. as another process is
+        writing, it's logged, and the message is inserted with the next.
+        """
+        self._pending.append(
+            (chat_id, sender, time.time() if seen is None else seen, msg)
+        )
+        try:
+            with METRICS.timed("state_seconds", op="archive"):
+                self.db.execute("BEGIN")
+                try:
+                    self.db.executemany(INSERT, self._pending)
+                    self.db.execute("COMMIT")
+                except BaseException:
+                    self.db.execute("ROLLBACK")
+                    raise
+        except sqlite3.Error as e:
+            log.warning("Could not archive %d messages: %r", len(self._pending), e)
+            METRICS.inc("archive_errors_total")
+            del self._pending[:-MAX_PENDING]
+            return
+        self._pending.clear()
+
+    def _clear(self, chat_id):
+        db = self._connect()
+        try:
+            db.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,))
+        finally:
+            db.close()
+
+    async def clear(self, chat_id):
+        """
+        Delete the messages of a chat, in a worker thread as a chat can have
+        many.  Returns False, having logged why, if they couldn't be.
+        """
+        self._pending = [entry for entry in self._pending if entry[0] != chat_id]
+        try:
+            await anyio.to_thread.run_sync(self._clear, chat_id)
+        except sqlite3.Error as e:
+            log.warning("Could not clear %s from the archive: %r", chat_id, e)
+            METRICS.inc("archive_errors_total")
+            return False
+        return True
+
+    def _reader(self):
+        # a connection for the worker threads, which take turns with it
+        if self._read_db is None:
+            self._read_db = self._connect(check_same_thread=False)
+        return self._read_db
+
+    def _search(self, chat_id, terms, limit):
+        query = match_query(chat_id, terms)
+        if query is None:
+            return []
+        # rowids are in the order messages were added, so the newest matches
+        # come straight from the index, without sorting all of them
+        with self._read_lock:
+            return (
+                self._reader()
+                .execute(
+                    "SELECT m.sender, m.time, m.body FROM messages m JOIN ("
+                    " SELECT rowid FROM messages_fts WHERE messages_fts MATCH ?"
+                    " ORDER BY rowid DESC LIMIT ?"
+                    ") f ON m.id = f.rowid ORDER BY m.id DESC",
+                    (query, limit),
+                )
+                .fetchall()
+            )
+
+    async def search(self, chat_id, terms, limit=10):
+        """
+        The chat's newest messages with all the words in terms, as
+        (sender, time, message) tuples.
+        """
+        with METRICS.timed("archive_search_seconds"):
+            return await anyio.to_thread.run_sync(self._search, chat_id, terms, limit)
+
+    def _export(self, chat_id, path, max_bytes):
+        db = self._connect()
+        count = 0
+        # zlib holds back what it hasn't compressed yet, so stop short of
+        # max_bytes by a margin for that and the end of the file
+        limit = max_bytes - EXPORT_MARGIN
+        try:
+            if chat_id is None:
+                rows = db.execute(
+                    "SELECT chat_id, sender, time, body FROM messages"
+                    " ORDER BY chat_id, time"
+                )
+            else:
+                rows = db.execute(
+                    "SELECT chat_id, sender, time, body FROM messages"
+                    " WHERE chat_id = ? ORDER BY time",
+                    (chat_id,),
+                )
+            with open(path, "wb") as raw, gzip.GzipFile(fileobj=raw, mode="wb") as f:
+                for chat, sender, seen, msg in rows:
+                    f.write((json.dumps([chat, sender, seen, msg]) + "\n").encode())
+                    count += 1
+                    if raw.tell() > limit:
+                        raise ExportTooLarge(f"the export is over {max_bytes} bytes")
+        finally:
+            db.close()
+        return count
+
+    async def export(self, chat_id, path, max_bytes):
+        """
+        Write the messages of a chat, or of all chats if chat_id is None, to
+        path as gzipped JSON lines of [chat id, sender, time, message].
+        Returns the number of messages, or raises ExportTooLarge once the
+        file would be bigger than max_bytes.
+        """
+        return await anyio.to_thread.run_sync(self._export, chat_id, path, max_bytes)
+
+    def _prune(self):
+        # in batches, so other processes' inserts don't wait for long
+        db = self._connect()
+        deleted = 0
+        try:
+            cutoff = time.time() - self.retention
+            while True:
+                count = db.execute(
+                    "DELETE FROM messages WHERE id IN ("
+                    " SELECT id FROM messages WHERE time < ? LIMIT ?)",
+                    (cutoff, PRUNE_BATCH),
+                ).rowcount
+                deleted += count
+                if count < PRUNE_BATCH:
+                    return deleted
+        finally:
+            db.close()
+
+    async def run(self):
+        # delete expired messages until cancelled
+        while True:
+            try:
+                deleted = await anyio.to_thread.run_sync(self._prune)
+            except sqlite3.Error as e:
+                # tried again next time
+                log.warning("Could not delete expired messages: %r", e)
+                METRICS.inc("archive_errors_total")
+            else:
+                if deleted:
+                    log.info("Deleted %d messages from the archive", deleted)
+            await anyio.sleep(self.prune_interval)
+
+    def close(self):
+        self.db.close()
+        if self._read_db is not None:
+            self._read_db.close()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Attachment files in the shared tmpfs, within a quota.
+
+The tmpfs signald reads attachments from is small (64MB in
+docker-compose.yml), and a send fails if it fills up, so its space is
+handed out by an `AttachmentStore`.  A file's size is reserved before it is
+written: its Content-Length when downloading, or the most it may be.  If
+that would go over `quota`, files only held by caches are evicted (through
+`evictors`), and failing that `reserve` waits for space to be released, for
+up to `wait_timeout` seconds before raising QuotaExceeded.  Once written, a
+file is charged its real size, after large images are re-encoded as JPEG in
+a worker thread (with Pillow, skipped if it can't be imported).
+
+Files are reference counted.  A new file has one reference, for whoever is
+making it; caches, and sends that haven't been handed to signald yet, take
+their own, and the file is deleted when the last is released.
+"""
+
+import os
+import logging
+
+import anyio
+
+from downloads import download_to_file, tmp_path, remove_file
+from metrics import METRICS
+
+log = logging.getLogger(__name__)
+
+# images that are re-encoded when they're large
+LOSSLESS_IMAGES = (".png", ".bmp", ".tiff")
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+class StoredFile:
+    __slots__ = ("path", "size", "refs")
+
+    def __init__(self, path):
+        self.path = path
+        self.size = 0  # bytes reserved for, or used by, the file
+        self.refs = 1
+
+
+class AttachmentStore:
+    def __init__(
+        self,
+        directory,
+        quota=48 * 1024 * 1024,
+        wait_timeout=60.0,
+        compress_over=2 * 1024 * 1024,
+        quality=85,
+    ):
+        self.directory = directory
+        self.quota = quota
+        self.wait_timeout = wait_timeout
+        self.compress_over = compress_over  # 0 never re-encodes
+        self.quality = quality
+        self.used = 0  # bytes reserved or used by all files
+        self.files = 0
+        self.waiting = 0
+        # callables that each drop a cached file, returning False if none left
+        self.evictors = []
+        self._released = None  # set when space is released, while waited on
+
+    def new_file(self, suffix):
+        self.files += 1
+        return StoredFile(tmp_path(self.directory, suffix))
+
+    def _evict(self):
+        for evict in self.evictors:
+            if evict():
+                METRICS.inc("attachments_evicted_total")
+                return True
+        return False
+
+    async def reserve(self, file, size):
+        if size > self.quota:
+            raise QuotaExceeded(f"{size} bytes is more than the attachment quota")
+        try:
+            with anyio.fail_after(self.wait_timeout):
+                while self.used + size > self.quota:
+                    if self._evict():
+                        continue
+                    if self._released is None:
+                        self._released = anyio.Event()
+                    self.waiting += 1
+                    try:
+                        with METRICS.timed("attachment_wait_seconds"):
+                            await self._released.wait()
+                    finally:
+                        self.waiting -= 1
+        except TimeoutError:
+            METRICS.inc("attachments_rejected_total")
+            raise QuotaExceeded("no space for attachments")
+        self.used += size
+        file.size += size
+
+    def _charge(self, file, size):
+        # set what the file is charged, releasing any space it doesn't need
+        self.used += size - file.size
+        file.size = size
+        if self._released is not None and self.used < self.quota:
+            self._released.set()
+            self._released = None
+
+    async def finish(self, file):
+        # charge a written file its real size, re-encoding it if it's large
+        size = os.path.getsize(file.path)
+        if (
+            self.compress_over
+            and size > self.compress_over
+            and file.path.endswith(LOSSLESS_IMAGES)
+        ):
+            size = await anyio.to_thread.run_sync(self._compress, file, size)
+        self._charge(file, size)
+
+    def _compress(self, file, size):
+        # in a worker thread: re-encode a lossless image as JPEG if smaller
+        try:
+            from PIL import Image
+        except ImportError:
+            return size
+        path = os.path.splitext(file.path)[0] + ".jpg"
+        try:
+            with Image.open(file.path) as image:
+                if image.format not in ("PNG", "BMP", "TIFF"):
+                    return size
+                image.convert("RGB").save(
+                    path, "JPEG", quality=self.quality, optimize=True
+                )
+            new_size = os.path.getsize(path)
+        except Exception as e:
+            log.warning("Could not re-encode %s: %r", file.path, e)
+            remove_file(path)
+            return size
+        if new_size >= size:
+            remove_file(path)
+            return size
+        remove_file(file.path)
+        file.path = path
+        METRICS.inc("attachments_compressed_total")
+        return new_size
+
+    async def download(self, client, url, suffix, max_bytes, **options):
+        """
+        Download url into a new file, reserving its space first, and return
+        it with the caller's reference.  The options are download_to_file's.
+        """
+        file = self.new_file(suffix)
+
+        async def reserve(length):
+            await self.reserve(file, length or max_bytes)
+
+        try:
+            await download_to_file(
+                client, url, file.path, max_bytes, on_length=reserve, **options
+            )
+            await self.finish(file)
+        except BaseException:
+            self.release(file)
+            raise
+        return file
+
+    def acquire(self, file):
+        file.refs += 1
+        return file
+
+    def release(self, file):
+        file.refs -= 1
+        if file.refs == 0:
+            remove_file(file.path)
+            self.files -= 1
+            self._charge(file, 0)
+
+    def stats(self):
+        return {
+            "used_bytes": self.used,
+            "quota_bytes": self.quota,
+            "files": self.files,
+            "waiting": self.waiting,
+        }
@@ -1,21 +1,47 @@
 #!/usr/bin/env python3
 import os
 import re
-import json
-import pickle
-import tempfile
-import requests
+import copy
+import signal
 import time
+import random
+import logging
 import anyio
-from collections import defaultdict
-
-from openai import OpenAI
+from collections import deque
 
 from semaphore import Bot, ChatContext, Attachment
 
-from utils import save_image, SunoAPI, AwsEc2Api
-
-client = OpenAI()
+from utils import SunoAPI, AwsEc2Api
+from downloads import make_http_client, DownloadTooLarge
+from attachments import AttachmentStore, QuotaExceeded
+from history import make_history_store
+from llm import OpenAIPool, parse_limits, preload as preload_openai
+from suno_jobs import SunoJobQueue
+from dedup import SeenIndex, message_key, seen_files
+from archive import ChatArchive, ExportTooLarge
+from router import CommandRouter
+from usernames import UsernameRegistry
+from context import ContextBuilder
+from summaries import Summarizer
+from mailboxes import ChatMailboxes
+from cache import TTLCache, prompt_hash
+from minecraft import MinecraftServers, parse_minecraft
+from config import ConfigFile, ConfigWatcher, parse_allow_list, freeze, NO_CONFIG
+from streaming import SentenceChunker
+from metrics import METRICS
+from outbox import Outbox, CONNECTION_ERRORS
+from ratelimit import RateLimiter, FairScheduler
+from logs import setup_logging
+
+log = logging.getLogger("bot")
+
+
+def strip_bot_prefix(msg, name="Bot"):
+    # the model sometimes replies in the transcript format, as "<name>: ..."
+    for prefix in (name, "Bot"):
+        if msg.lower().startswith(prefix.lower() + ":"):
+            return msg[len(prefix) + 1 :].strip()
+    return msg.strip()
 
 
 class MyBot:
@@ -29,6 +55,12 @@ class MyBot:
         socket_path: os.PathLike,
         usernames_file: os.PathLike,
         allow_list_file: os.PathLike,
+        history_store: str = "log",
+        state_dir: os.PathLike = "/app/state/",
+        shared_tmpfs: os.PathLike = "/shared_tmpfs/",
+        minecraft_file: os.PathLike = "minecraft.json",
+        suno_jobs_file: str = "suno_jobs.json",
+        seen_file: str = "seen.bin",
     ):
         self.bot_number = bot_number
         self.bot_default_name = bot_default_name
@@ -37,13 +69,184 @@ class MyBot:
         self.admin_uuid = admin_uuid
         self.socket_path = socket_path
         self.allow_list_file = allow_list_file
-        self.MAX_TOKEN = 256
+        self.MAX_TOKEN = int(os.environ.get("BOT_MAX_TOKEN", 256))
         self.MAX_MESSAGES = 50
-        self.shared_tmpfs = "/shared_tmpfs/"
-        # self.load_state()
-        self.load_allow_list()
+        self.MAX_IMAGES = int(os.environ.get("DALLE_MAX_IMAGES", 4))
+        self.MAX_IMAGE_BYTES = 16 * 1024 * 1024
+        # songs are sent as attachments if SUNO_ATTACHMENTS is set, or as
+        # links if they are bigger than SUNO_MAX_AUDIO_BYTES
+        self.SUNO_ATTACHMENTS = os.environ.get("SUNO_ATTACHMENTS", "0") == "1"
+        self.MAX_AUDIO_BYTES = int(
+            os.environ.get("SUNO_MAX_AUDIO_BYTES", 8 * 1024 * 1024)
+        )
+        self.STREAM_REPLIES = os.environ.get("BOT_STREAM_REPLIES", "0") == "1"
+        self.STREAM_CHUNK_CHARS = int(os.environ.get("BOT_STREAM_CHUNK_CHARS", 300))
+        self.reply_timings = deque(maxlen=100)  # latency of the latest /thots
+        # /thots can ask several models at once, and reply with the first
+        # answer ("first"), or all of them ("all"), also set per chat
+        self.FANOUT_MODELS = [
+            model.strip()
+            for model in os.environ.get("BOT_FANOUT_MODELS", "").split(",")
+            if model.strip()
+        ]
+        self.FANOUT = os.environ.get("BOT_FANOUT", "first")
+        self.FANOUT_HEDGE_AFTER = float(os.environ.get("BOT_FANOUT_HEDGE_AFTER", 0))
+        self.shared_tmpfs = shared_tmpfs
+        # space in the shared tmpfs, see attachments.py
+        self.attachments = AttachmentStore(
+            shared_tmpfs,
+            quota=int(os.environ.get("BOT_TMPFS_QUOTA", 48 * 1024 * 1024)),
+            wait_timeout=float(os.environ.get("BOT_TMPFS_WAIT", 60)),
+            compress_over=int(
+                os.environ.get("BOT_IMAGE_COMPRESS_OVER", 2 * 1024 * 1024)
+            ),
+        )
+        self._http = None  # see http
+        self.openai = OpenAIPool.from_env()
+        self.state_dir = state_dir
+        history_options = {}
+        if history_store == "log":
+            history_options["memory_budget"] = int(
+                os.environ.get("BOT_HISTORY_MEMORY", 64 * 1024 * 1024)
+            )
+        self.history = make_history_store(
+            history_store, self.state_dir, self.MAX_MESSAGES, **history_options
+        )
+        # every message, for /search and /export, see archive.py
+        self.archive = None
+        if os.environ.get("BOT_ARCHIVE", "1") == "1":
+            self.archive = ChatArchive(
+                os.path.join(self.state_dir, "archive.db"),
+                retention=float(os.environ.get("BOT_ARCHIVE_DAYS", 365)) * 86400,
+            )
+        self.MAX_EXPORT_BYTES = 16 * 1024 * 1024
+        # paid commands already run, so they aren't run again for messages
+        # that signald delivers again after a restart, see dedup.py
+        self.seen = SeenIndex(
+            os.path.join(self.state_dir, seen_file),
+            ttl=float(os.environ.get("BOT_SEEN_TTL", 7 * 24 * 3600)),
+            max_entries=int(os.environ.get("BOT_SEEN_MAX", 10000)),
+            load=seen_files(self.state_dir),
+        )
+        self.suno_jobs = SunoJobQueue(
+            os.path.join(self.state_dir, suno_jobs_file),
+            self.suno_job_done,
+            max_jobs=int(os.environ.get("SUNO_MAX_JOBS", 2)),
+            wait_complete=self.SUNO_ATTACHMENTS,
+        )
+        self.mailboxes = ChatMailboxes(
+            self.process_batch,
+            coalesce_window=float(os.environ.get("BOT_COALESCE_WINDOW", 0)),
+        )
+        self.suno_limits_cache = TTLCache(
+            maxsize=1, ttl=float(os.environ.get("SUNO_LIMITS_TTL", 60))
+        )
+        self.caches = {"suno-limits": self.suno_limits_cache}
+        # generated images are only kept if DALLE_CACHE_SIZE is set,
+        # as they take up space in the shared tmpfs, and are evicted early
+        # when it is needed for new attachments
+        self.image_cache = None
+        if int(os.environ.get("DALLE_CACHE_SIZE", 0)):
+            self.image_cache = TTLCache(
+                maxsize=int(os.environ["DALLE_CACHE_SIZE"]),
+                ttl=float(os.environ.get("DALLE_CACHE_TTL", 3600)),
+                on_evict=lambda key, files: [
+                    self.attachments.release(file) for file in files
+                ],
+            )
+            self.caches["dalle3"] = self.image_cache
+            self.attachments.evictors.append(self.image_cache.evict_oldest)
+        # Commands using paid backends, and their cost in credits (per image
+        # for /dalle3, per model asked for /thots, see command_cost).  Groups
+        # and users have hourly quotas of credits, which a group's entry in
+        # the allow list can change with "rate_per_hour" and "burst", and the
+        # commands share BOT_BACKEND_SLOTS slots fairly between groups, in
+        # proportion to their "weight".  Admins aren't limited, and go first.
+        self.COMMAND_COSTS = {
+            "/thots": 1,
+            "/dalle3": 4,
+            "/suno": 10,
+            "/suno-custom": 10,
+        }
+        self.GROUP_RATE = float(os.environ.get("BOT_GROUP_RATE", 600))
+        self.GROUP_BURST = float(os.environ.get("BOT_GROUP_BURST", 60))
+        self.USER_RATE = float(os.environ.get("BOT_USER_RATE", 300))
+        self.USER_BURST = float(os.environ.get("BOT_USER_BURST", 30))
+        self.MAX_THROTTLE_WAIT = float(os.environ.get("BOT_MAX_THROTTLE_WAIT", 120))
+        self.rate_limiter = RateLimiter()
+        self.scheduler = FairScheduler(int(os.environ.get("BOT_BACKEND_SLOTS", 4)))
+        self.setup_signald()
+        METRICS.gauge_fn(
+            "mailbox_queued",
+            lambda: [({}, sum(self.mailboxes.queued().values()))],
+        )
+        METRICS.gauge_fn(
+            "mailboxes_active", lambda: [({}, len(self.mailboxes.queued()))]
+        )
+        METRICS.gauge_fn(
+            "backend_slots",
+            lambda: [
+                ({"state": "running"}, self.scheduler.running),
+                ({"state": "waiting"}, self.scheduler.waiting()),
+            ],
+        )
+        METRICS.gauge_fn(
+            "suno_jobs",
+            lambda: [({"status": k}, n) for k, n in self.suno_jobs.counts().items()],
+        )
+        METRICS.gauge_fn(
+            "attachments",
+            lambda: [({"stat": k}, v) for k, v in self.attachments.stats().items()],
+        )
+        METRICS.gauge_fn(
+            "cache_size",
+            lambda: [({"cache": name}, len(c)) for name, c in self.caches.items()],
+        )
+        if hasattr(self.history, "stats"):
+            METRICS.gauge_fn(
+                "history",
+                lambda: [({"stat": k}, v) for k, v in self.history.stats().items()],
+            )
+        # the config files are held as immutable snapshots, which are
+        # replaced when the files change, see config.py
+        self.allow_list_config = ConfigFile(
+            allow_list_file, parse_allow_list, freeze({})
+        )
+        self.minecraft_config = ConfigFile(
+            minecraft_file, parse_minecraft, MinecraftServers()
+        )
         self.usernames_file = usernames_file
-        self.usernames = self.load_usernames()
+        self.usernames = UsernameRegistry(
+            usernames_file,
+            flush_interval=float(os.environ.get("USERNAMES_FLUSH_INTERVAL", 10)),
+        )
+        self.config = ConfigWatcher(
+            [self.allow_list_config, self.minecraft_config, self.usernames],
+            interval=float(os.environ.get("BOT_CONFIG_INTERVAL", 2)),
+        )
+        self.context = ContextBuilder(
+            bot_number,
+            self.usernames,
+            bot_name=bot_default_name,
+            budgets=parse_limits(os.environ.get("BOT_TOKEN_BUDGETS", "")),
+            default_budget=int(os.environ.get("BOT_TOKEN_BUDGET", 4000)),
+        )
+        # fold older turns into a rolling summary, see summaries.py
+        self.summaries = None
+        if os.environ.get("BOT_SUMMARIES", "0") == "1":
+            self.summary_model = (
+                os.environ.get("BOT_SUMMARY_MODEL") or bot_default_model
+            )
+            self.summaries = Summarizer(
+                self.state_dir,
+                lambda messages, max_tokens: self.complete(
+                    self.summary_model, messages, max_tokens
+                ),
+                lambda user, msg: self.context.name(user) + ": " + msg.strip(),
+                fold_after=int(os.environ.get("BOT_SUMMARY_AFTER", 30)),
+                keep=int(os.environ.get("BOT_SUMMARY_KEEP", 10)),
+                max_tokens=int(os.environ.get("BOT_SUMMARY_TOKENS", 300)),
+            )
 
         # Mapping of command substrings to member function calls.
         #
@@ -56,85 +259,204 @@ class MyBot:
             "/set-name": (self.set_name, "Set the name the bot uses for you"),
             "/server-on": (self.server_on, "Turn on the Minecraft server"),
             "/server-off": (self.server_off, "Turn off the Minecraft server"),
+            "/server-status": (self.server_status, "Is the Minecraft server on?"),
             "/clear": (self.clear_fn, "Clear the chat history"),
             "/suno-limits": (self.suno_limits_fn, "Returns the limits of Suno API"),
+            "/suno-status": (self.suno_status_fn, "Status of your Suno songs"),
             "/echo": (self.echo_fn, "Echo the message back"),
+            "/search": (self.search_fn, "Search the chat's messages"),
         }
 
         # Mapping of command substrings to member function calls.
         self.commands = {
             "/thots": (self.convo_fn, "Get an LLM to respond to a message"),
-            "/dalle3": (self.dalle3_fn, "DALLE-3 model"),
+            "/dalle3": (self.dalle3_fn, "DALLE-3 model, /dalle3 x2 for two images"),
             "/suno": (self.suno_fn, "Suno music generation model"),
-            "/suno-custom": (self.suno_custom_fn, "Suno music generation model"),
+            "/suno-custom": (
+                self.suno_custom_fn,
+                "Suno with your own lyrics, and [genre] tags",
+            ),
             # ... add all other command mappings
         }
         self.admin_commands = {
             "/awright": (self.admin_fn, "Admin command for initial test"),
+            "/cache-stats": (self.cache_stats_fn, "Hits and misses of the caches"),
+            "/stats": (self.stats_fn, "Latencies, call counts and queue depths"),
+            "/export": (self.export_fn, "The chat's messages, /export all for all"),
+        }
+        # Commands that work in any chat, including ones not on the allow list.
+        self.public_commands = {
+            "/show-group-id": (self.show_group_id_fn, "Show the group id"),
+            "/reload-allow-list": (self.reload_allow_list_fn, "Reload the allow list"),
+            "/show-uuid": (self.show_uuid_fn, "Show your uuid"),
         }
 
-    def load_usernames(self):
-        # Load the usernames from a JSON file
-        # unknown users are assigned the default name "User"
-        try:
-            with open(self.usernames_file) as f:
-                usernames = json.load(f)
-            return defaultdict(lambda: "User", usernames)
-        except FileNotFoundError:
-            print("No usernames file found")
-            return defaultdict(lambda: "User")
-
-    def save_usernames(self):
-        # Save the usernames as JSON
-        with open(self.usernames_file, "w") as f:
-            json.dump(self.usernames, f, indent=2)
+        # All the commands are matched in one pass over the message,
+        # with the same precedence as the order of these tiers.
+        self.command_tiers = {
+            "public": self.public_commands,
+            "special": self.special_commands,
+            "admin": self.admin_commands,
+            "regular": self.commands,
+        }
+        self.router = CommandRouter(list(self.command_tiers.items()))
+        self.help_text = self.build_help_text()
+
+    @property
+    def http(self):
+        # the download client, created on first use
+        if self._http is None:
+            self._http = make_http_client()
+        return self._http
 
     async def get_username(self, ctx):
-        # Get the username for a given number
+        # Get the username for a given number, or UUID if there is no number
         number = ctx.message.source.number
-        if number is None:
-            # use UUID as the key
-            username = self.usernames.get(ctx.message.source.uuid)
-        else:
-            username = self.usernames.get(number)
-            self.usernames[ctx.message.source.uuid] = username
-            self.save_usernames()
-
-        if username == "User" or username is None:
-            self.usernames[ctx.message.source.uuid] = "User"
-            self.save_usernames()
-            print("going to send a message")
+        uuid = ctx.message.source.uuid
+        self.usernames.link(number, uuid)
+        username = self.usernames.get(number or uuid)
+
+        if username is None:
             # send a message to the user to set their name
             await self.system_message(ctx, "Please set your name using /set-name")
         return username
 
+    @property
+    def allow_list(self):
+        # the valid chats, and their settings, from the allow list file
+        return self.allow_list_config.value
+
+    @property
+    def minecraft(self):
+        return self.minecraft_config.value
+
     def load_allow_list(self):
-        # read the allow list from a JSON file. they keys are the valid chats
+        return self.allow_list_config.reload()
+
+    def group_config(self, chat_id):
+        # allow list values are either the chat's name, or a dict of settings
+        # for the chat, e.g. {"name": "my_chat", "max_tokens": 512, "stream": true}
+        return self.allow_list.get(chat_id, NO_CONFIG)
+
+    async def show_group_id_fn(self, ctx):
+        await self.reply(
+            ctx,
+            f"[PG-Tips: group-id `{self.get_chat_id(ctx)}`]",
+        )
+
+    async def reload_allow_list_fn(self, ctx):
+        # the file is reloaded when it changes anyway, this doesn't wait
+        if self.load_allow_list():
+            await self.system_message(
+                ctx, f"Allow list reloaded, {len(self.allow_list)} chats"
+            )
+        else:
+            await self.system_message(ctx, "Allow list invalid, see the logs")
+
+    async def show_uuid_fn(self, ctx):
+        await self.reply(
+            ctx,
+            f"[PG-Tips: uuid `{ctx.message.source.uuid}`]",
+        )
+
+    async def reply(self, ctx, body, attachments=None, quote=False, wait=False):
+        # replies are queued in the outbox, and sent by deliver
+        return await self.outbox.put(
+            self.get_chat_id(ctx),
+            body,
+            attachments,
+            ctx.message if quote else None,
+            wait,
+        )
+
+    async def send(self, receiver, body, attachments=None, wait=False):
+        # messages that aren't replies, e.g. finished Suno jobs
+        return await self.outbox.put(receiver, body, attachments, None, wait)
+
+    async def deliver(self, message):
+        # send a message from the outbox through signald
+        if self.signal is None:
+            raise ConnectionError("not connected to signald")
+        if message.quote is not None:
+            try:
+                with METRICS.timed("signal_reply_seconds"):
+                    return await message.quote.reply(
+                        message.body, attachments=message.attachments, quote=True
+                    )
+            except CONNECTION_ERRORS:
+                # the message came in on a connection that has since been
+                # replaced, so it can't be quoted, send it unquoted instead
+                log.info("Can't quote a message from an old connection")
+                # the connection may have dropped while we waited, in which
+                # case the outbox keeps the message until it's back
+                if self.signal is None:
+                    raise ConnectionError("not connected to signald")
+        with METRICS.timed("signal_send_seconds"):
+            return await self.signal.send_message(
+                message.chat_id, message.body, attachments=message.attachments
+            )
+
+    async def typing(self, ctx, started=True):
+        # typing notifications aren't queued in the outbox, they go to the
+        # connection the message came in on, which may be gone, so they
+        # are only sent if they can be
         try:
-            with open(self.allow_list_file) as f:
-                self.allow_list = json.load(f)
-        except FileNotFoundError:
-            print("No allow list file found")
-            self.allow_list = {}
+            if started:
+                await ctx.message.typing_started()
+            else:
+                await ctx.message.typing_stopped()
+        except CONNECTION_ERRORS as e:
+            log.info("Typing notification failed: %r", e)
 
     async def system_message(self, ctx, msg):
-        await ctx.message.reply(f"[PG-Tips: {msg}]", quote=True)
+        await self.reply(ctx, f"[PG-Tips: {msg}]", quote=True)
 
-    async def clear_fn(self, ctx):
+    def get_chat_id(self, ctx):
+        # the group id, or the sender for direct messages
         group_id = ctx.message.get_group_id()
-        with open(f"/app/state/{group_id}.pkl", "wb") as f:
-            pickle.dump([], f)
+        if group_id is None:
+            group_id = ctx.message.source.number or ctx.message.source.uuid
+        return group_id
+
+    async def clear_fn(self, ctx):
+        with METRICS.timed("state_seconds", op="clear"):
+            self.history.clear(self.get_chat_id(ctx))
+            if self.summaries is not None:
+                self.summaries.clear(self.get_chat_id(ctx))
+            if self.archive is not None:
+                if not await self.archive.clear(self.get_chat_id(ctx)):
+                    await self.system_message(
+                        ctx, "Chat history cleared, but not the /search archive"
+                    )
+                    return
         await self.system_message(ctx, "Chat history cleared")
 
     async def echo_fn(self, ctx):
         msg = ctx.message.get_body()
         msg = self.remove_commands(msg)
-        await ctx.message.reply("(echo): " + msg.strip())
+        await self.reply(ctx, "(echo): " + msg.strip())
 
-    def save_state(self, ctx, msg_history, msg, number_override=None):
-        # add the message to the state (a series of messages)
-        # shoild be fast to load and store
-        # stored under state/group_id.pkl
+    async def search_fn(self, ctx):
+        terms = self.remove_commands(ctx.message.get_body())
+        if self.archive is None:
+            await self.system_message(ctx, "Search is turned off")
+            return
+        if not terms:
+            await self.system_message(ctx, "Please provide some words to find")
+            return
+        results = await self.archive.search(self.get_chat_id(ctx), terms)
+        if not results:
+            await self.system_message(ctx, "No messages found")
+            return
+        lines = []
+        for sender, seen, msg in results:
+            when = time.strftime("%Y-%m-%d %H:%M", time.localtime(seen))
+            lines.append(f"{when} {self.context.name(sender)}: {msg}")
+        await self.system_message(ctx, "\n".join(lines))
+
+    def save_state(self, ctx, msg, number_override=None):
+        # add the message to the chat history, which only keeps
+        # the last MAX_MESSAGES (see history.py for the storage)
         if number_override:
             number = number_override
         else:
@@ -142,264 +464,497 @@ class MyBot:
                 number = ctx.message.source.uuid
             else:
                 number = ctx.message.source.number
-        msg_history.append((number, msg))  # tuple of (number, message)
-        group_id = ctx.message.get_group_id()
-        # if the file does not exist, it will be created
-        os.makedirs(os.path.dirname("/app/state/"), exist_ok=True)
-        group_id = group_id.replace("/", "_")
-        # only store the last MAX_MESSAGES
-        msg_history = msg_history[-self.MAX_MESSAGES :]
-        with open(f"/app/state/{group_id}.pkl", "wb") as f:
-            pickle.dump(msg_history, f)
+        chat_id = self.get_chat_id(ctx)
+        with METRICS.timed("state_seconds", op="append"):
+            self.history.append(chat_id, (number, msg))
+        if self.archive is not None:
+            self.archive.add(chat_id, number, msg)
+        if self.summaries is not None:
+            self.summaries.maybe_fold(chat_id, self.history.load(chat_id))
 
     def load_state(self, group_id):
-        # Load the state using pickle
-        # if the file does not exist, return an empty dict
-        group_id = group_id.replace("/", "_")
-        try:
-            with open(f"/app/state/{group_id}.pkl", "rb") as f:
-                return pickle.load(f)
-        except FileNotFoundError:
-            return []
+        # list of (number, message) tuples, oldest first
+        with METRICS.timed("state_seconds", op="load"):
+            return self.history.load(group_id)
 
-    async def process_commands(self, msg, ctx):
-        words = msg.lower().split()
+    def is_admin(self, ctx):
+        number = ctx.message.source.number
+        uuid = ctx.message.source.uuid
+        return number == self.admin_number or uuid == self.admin_uuid
+
+    async def process_batch(self, chat_id, batch):
+        # Messages of one chat, in order, that arrived close together.
+        # Only the last /thots in the batch is run, once all the messages
+        # before it are in the history, so one reply covers them all.
+        thots = [i for i, (_, route) in enumerate(batch) if "/thots" in route.commands]
+        for i, (ctx, route) in enumerate(batch):
+            skip = ("/thots",) if thots and i != thots[-1] else ()
+            await self.process_commands(route, ctx, skip)
+
+    async def process_commands(self, route, ctx, skip=()):
+        if route.kind in ("special", "admin"):
+            # only one special or admin command at a time
+            command = route.commands[0]
+            log.info("%s command: %s", route.kind, command)
+            with METRICS.timed("command_seconds", command=command):
+                await self.command_tiers[route.kind][command][0](ctx)
+            return
 
-        for command in self.special_commands:
-            # only allow one special command at a time
-            if command in words:
-                await self.special_commands[command][0](ctx)
-                print(f"Special command: {command}")
+        # add the message to the state without the commands
+        self.save_state(ctx, route.body)
+
+        for command in route.commands:
+            if command in skip:
+                log.info("Command: %s (merged into a later message)", command)
+                METRICS.inc("commands_merged_total", command=command)
+                continue
+            if command in self.COMMAND_COSTS and not self.first_run(ctx, command):
+                log.info("Command: %s (already run, skipped)", command)
+                continue
+            log.info("Command: %s", command)
+            with METRICS.timed("command_seconds", command=command):
+                if command in self.COMMAND_COSTS:
+                    await self.run_limited(ctx, command, self.commands[command][0])
+                else:
+                    await self.commands[command][0](ctx)
+
+    def first_run(self, ctx, command):
+        # record that the message's command is run, False if it already was
+        key = message_key(ctx.message, self.get_chat_id(ctx), command)
+        return key is None or self.seen.add(key)
+
+    async def run_limited(self, ctx, command, handler):
+        # run a paid command within the group's and user's quotas, and a
+        # fair share of the backend slots, telling the chat if it has to wait;
+        # a command waiting for credits is run later, in the background
+        chat_id = self.get_chat_id(ctx)
+        config = self.group_config(chat_id)
+        cost = self.command_cost(ctx, command)
+        admin = self.is_admin(ctx)
+        if not admin:
+            user = ctx.message.source.uuid or ctx.message.source.number
+            buckets = [
+                self.rate_limiter.bucket(
+                    ("group", chat_id),
+                    float(config.get("rate_per_hour", self.GROUP_RATE)),
+                    float(config.get("burst", self.GROUP_BURST)),
+                ),
+                self.rate_limiter.bucket(
+                    ("user", user), self.USER_RATE, self.USER_BURST
+                ),
+            ]
+            delay, ok = self.rate_limiter.reserve(buckets, cost, self.MAX_THROTTLE_WAIT)
+            if not ok:
+                METRICS.inc("throttled_total", command=command, outcome="rejected")
+                await self.system_message(
+                    ctx, f"Rate limited, try {command} again in {delay / 60:.0f} min"
+                )
+                return
+            if delay > 0:
+                METRICS.inc("throttled_total", command=command, outcome="delayed")
+                await self.system_message(
+                    ctx, f"Rate limited, {command} will run in about {delay:.0f}s"
+                )
+                # waiting here would hold up the chat's other messages
+                self._task_group.start_soon(
+                    self.run_later, delay, ctx, command, handler, cost
+                )
                 return
+        await self.run_in_slot(ctx, command, handler, cost, admin)
+
+    def command_cost(self, ctx, command):
+        # credits for one run: per image asked for, or per model asked
+        cost = self.COMMAND_COSTS[command]
+        if command == "/dalle3":
+            n, _ = self.image_request(ctx)
+            return cost * n
+        if command == "/thots":
+            config = self.group_config(self.get_chat_id(ctx))
+            return cost * len(self.thots_models(config))
+        return cost
+
+    async def run_later(self, delay, ctx, command, handler, cost):
+        # a throttled command, once its credits are there
+        await anyio.sleep(delay)
+        try:
+            with METRICS.timed("command_seconds", command=command):
+                await self.run_in_slot(ctx, command, handler, cost, admin=False)
+        except Exception as e:
+            log.exception("%s failed: %r", command, e)
 
-        number = ctx.message.source.number
-        uuid = ctx.message.source.uuid
-        if number == self.admin_number or uuid == self.admin_uuid:
-            for command in self.admin_commands:
-                if command in words:
-                    await self.admin_commands[command][0](ctx)
-                    print(f"Admin command: {command}")
-                    return
+    async def run_in_slot(self, ctx, command, handler, cost, admin):
+        # run a command in one of the backend slots, fairly shared by groups
+        chat_id = self.get_chat_id(ctx)
+        config = self.group_config(chat_id)
 
-        # add message to state (load state first)
-        group_id = ctx.message.get_group_id()
-        msg_history = self.load_state(group_id)
-        command_queue = []
-        # remove any commands from the message
-        for command in self.commands:
-            if command in words:
-                words.remove(command)
-                command_queue.append(command)
+        async def queued(ahead, eta):
+            METRICS.inc("throttled_total", command=command, outcome="queued")
+            await self.system_message(
+                ctx, f"Busy, {command} is queued behind {ahead}, about {eta:.0f}s"
+            )
 
-        # add the message to the state withut the command
-        self.save_state(ctx, msg_history, " ".join(words))
+        async with self.scheduler.slot(
+            chat_id,
+            weight=float(config.get("weight", 1)),
+            cost=cost,
+            priority=0 if admin else 1,
+            on_queued=queued,
+        ):
+            await handler(ctx)
 
-        for command in command_queue:
-            print(f"Command: {command}")
-            await self.commands[command][0](ctx)
+    def thots_models(self, config):
+        # the models /thots asks, see reply_all and OpenAIPool.chat_first
+        return config.get("models") or self.FANOUT_MODELS or [self.bot_default_model]
 
     # Placeholder for conversational functionality
     async def convo_fn(self, ctx):
-        await ctx.message.typing_started()
-
-        number = ctx.message.source.number
-
-        # load the state
-        group_id = ctx.message.get_group_id()
-        msg_history = self.load_state(group_id)
-
-        print("Messages: ", msg_history)
-        messages = [
-            {
-                "role": "user" if msg[0:4] != "Bot" else "assistant",
-                "content": self.usernames[user] + ": " + msg.strip(),
-            }
-            for user, msg in msg_history
+        await self.typing(ctx)
+
+        # load the state, and keep the newest messages that fit the token budget
+        chat_id = self.get_chat_id(ctx)
+        config = self.group_config(chat_id)
+        max_tokens = int(config.get("max_tokens", self.MAX_TOKEN))
+        msg_history = self.load_state(chat_id)
+        summary = None
+        if self.summaries is not None:
+            # the summary stands in for the turns it covers
+            summary, msg_history = self.summaries.split(chat_id, msg_history)
+        # with several models, the prompt goes to all of them (see reply_all
+        # and OpenAIPool.chat_first), each with a context of its own size
+        models = self.thots_models(config)
+        prompts = [
+            (
+                model,
+                self.context.build(model, msg_history, max_tokens, chat_id, summary),
+            )
+            for model in models
         ]
+        log.debug("Prompt", extra={"fields": self.context.last_prompt[chat_id]})
 
-        # add a system message to the the start of the messages
-        messages.insert(
-            0,
-            {
-                "role": "system",
-                "content": "This is a group chat conversation with multiple participants. "
-                "Their messages are shown below, and are the format '[Name]: [Message]'.",
-            },
-        )
-        print("Messages: ", messages)
-
+        timing = {"chat_id": chat_id, "model": prompts[0][0]}
+        start = time.monotonic()
         try:
-            completion = client.chat.completions.create(
-                messages=messages,
-                model=self.bot_default_model,
-                max_tokens=self.MAX_TOKEN,
-            )
-            new_msg = completion.choices[0].message.content
-            if "bot:" in new_msg.lower():
-                # remove the bot: prefix
-                new_msg = new_msg[4:].strip()
+            if len(prompts) > 1 and config.get("fanout", self.FANOUT) == "all":
+                new_msg = await self.reply_all(ctx, prompts, max_tokens, timing)
+            elif len(prompts) == 1 and config.get("stream", self.STREAM_REPLIES):
+                model, messages = prompts[0]
+                new_msg = await self.stream_reply(
+                    ctx, model, messages, max_tokens, timing
+                )
+            else:
+                model, completion = await self.openai.chat_first(
+                    prompts, max_tokens, hedge_after=self.FANOUT_HEDGE_AFTER
+                )
+                timing["model"] = model
+                new_msg = strip_bot_prefix(
+                    completion.choices[0].message.content or "", self.bot_default_name
+                )
+                if len(new_msg):
+                    timing["first_token"] = timing["first_message"] = (
+                        time.monotonic() - start
+                    )
+                    await self.reply(ctx, new_msg, quote=True)
+        except TimeoutError:
+            await self.system_message(ctx, "API call timed out")
+            return
         except Exception as e:
             await self.system_message(ctx, f"API call failed {e}")
             return
+        finally:
+            timing["total"] = time.monotonic() - start
+            self.reply_timings.append(timing)
+            for key in ("first_token", "first_message", "total"):
+                if key in timing:
+                    METRICS.observe(f"thots_{key}_seconds", timing[key])
+            log.info("Reply timing", extra={"fields": timing})
         if not len(new_msg):
             await self.system_message(ctx, "No response from the API")
             return
 
-        await ctx.message.reply(new_msg, quote=True)
-        await ctx.message.typing_stopped()
+        self.save_state(ctx, new_msg, self.bot_number)
+        await self.typing(ctx, started=False)
 
-        if new_msg:
-            self.save_state(ctx, msg_history, new_msg)
+    async def reply_all(self, ctx, prompts, max_tokens, timing):
+        """
+        Send each model's reply, labelled with the model, as it arrives.
+        Returns them all, as one message for the history.
+        """
+        start = time.monotonic()
+        replies = []
+
+        async def ask(model, messages):
+            try:
+                completion = await self.openai.chat(model, messages, max_tokens)
+            except Exception as e:
+                log.warning("%s failed: %r", model, e)
+                return
+            text = strip_bot_prefix(
+                completion.choices[0].message.content or "", self.bot_default_name
+            )
+            if text:
+                timing.setdefault("first_token", time.monotonic() - start)
+                timing.setdefault("first_message", timing["first_token"])
+                replies.append(f"[{model}] {text}")
+                await self.reply(ctx, replies[-1], quote=len(replies) == 1)
+
+        async with anyio.create_task_group() as tg:
+            for model, messages in prompts:
+                tg.start_soon(ask, model, messages)
+        return "\n".join(replies)
+
+    async def stream_reply(self, ctx, model, messages, max_tokens, timing):
+        """
+        Stream a completion into the chat: the first sentence is sent as soon
+        as it is complete, quoting the request, and the rest follows in
+        chunks.  signald can't edit sent messages, so these are new messages.
+        """
+        start = time.monotonic()
+        chunker = SentenceChunker(self.STREAM_CHUNK_CHARS)
+        sent = []
+
+        async def send(chunks):
+            for chunk in chunks:
+                if not sent:
+                    chunk = strip_bot_prefix(chunk, self.bot_default_name)
+                    if not chunk:
+                        continue
+                    timing["first_message"] = time.monotonic() - start
+                await self.reply(ctx, chunk, quote=not sent)
+                sent.append(chunk)
+
+        async def on_text(delta):
+            timing.setdefault("first_token", time.monotonic() - start)
+            await send(chunker.feed(delta))
+
+        await self.openai.chat_stream(model, messages, max_tokens, on_text)
+        await send(chunker.flush())
+        return " ".join(sent)
+
+    async def complete(self, model, messages, max_tokens):
+        # the text of a completion, for work outside a chat such as summaries
+        completion = await self.openai.chat(model, messages, max_tokens)
+        return completion.choices[0].message.content or ""
 
     async def set_name(self, ctx):
-        print("Setting name")
         msg = ctx.message.get_body()
         msg = self.remove_commands(msg)
         if len(msg) == 0:
             await self.system_message(ctx, "Please provide a name")
             return
-        if ctx.message.source.number is None:
-            # use UUID as the key
-            self.usernames[ctx.message.source.uuid] = msg
-        else:
-            self.usernames[ctx.message.source.number] = msg
-            self.usernames[ctx.message.source.uuid] = msg
-        self.save_usernames()
+        number = ctx.message.source.number
+        uuid = ctx.message.source.uuid
+        self.usernames.link(number, uuid)
+        self.usernames.set(number or uuid, msg)
         await self.system_message(ctx, f"Name set to {msg}")
 
     async def admin_fn(self, ctx):
-        print("Admin functionality")
         msg = "Ahhhhhh, father, I am alivee!!!!"
 
-        msg_history = self.load_state(ctx.message.get_group_id())
-        await ctx.message.reply(msg, quote=True)
-        self.save_state(ctx, msg_history, msg, self.bot_number)
-        msg_history = self.load_state(ctx.message.get_group_id())
-        msg = "Jesus Chirst, I have been resurrected"
-        await ctx.message.reply(msg)
-        self.save_state(ctx, msg_history, msg, self.bot_number)
-
-        msg_history = self.load_state(ctx.message.get_group_id())
-        msg = "It hurt so much, but I am back"
-        await ctx.message.reply(msg)
-        self.save_state(ctx, msg_history, msg, self.bot_number)
-        msg_history = self.load_state(ctx.message.get_group_id())
-
-        msg = "Well, not fully, I am in a new codebase, still to implement some features, maybe some kinks to figure out"
-        await ctx.message.reply(msg)
-        self.save_state(ctx, msg_history, msg, self.bot_number)
-        msg_history = self.load_state(ctx.message.get_group_id())
+        await self.reply(ctx, msg, quote=True)
+        self.save_state(ctx, msg, self.bot_number)
+
+        for msg in [
+            "Jesus Chirst, I have been resurrected",
+            "It hurt so much, but I am back",
+            "Well, not fully, I am in a new codebase, still to implement some features, maybe some kinks to figure out",
+        ]:
+            await self.reply(ctx, msg)
+            self.save_state(ctx, msg, self.bot_number)
+
+    def image_request(self, ctx):
+        # "/dalle3 x3 <prompt>" asks for three images, returns (3, prompt)
+        msg = self.remove_commands(ctx.message.get_body())
+        n = 1
+        match = re.match(r"x(\d+)\s+", msg)
+        if match:
+            n = max(1, min(int(match.group(1)), self.MAX_IMAGES))
+            msg = msg[match.end() :]
+        return n, msg
 
     async def dalle3_fn(self, ctx):
-        print("DALLE-3 functionality")
-        msg = ctx.message.get_body()
-        # remove all commands from the message
-        for command in self.special_commands:
-            msg = msg.replace(command, "")
-        for command in self.commands:
-            msg = msg.replace(command, "")
-        for command in self.admin_commands:
-            msg = msg.replace(command, "")
-
-        msg = msg.strip()
+        n, msg = self.image_request(ctx)
         if len(msg) == 0:
             await self.system_message(ctx, "Please provide a message")
             return
 
-        await ctx.message.typing_started()
+        await self.typing(ctx)
+        key = (prompt_hash(msg), n)
+        cached = self.image_cache.get(key) if self.image_cache is not None else None
+        files = []  # our references to the images, released once sent
         try:
-            response = client.images.generate(
-                model="dall-e-3",
-                prompt=msg,
-                size="1024x1024",
-                quality="standard",
-                n=1,
-            )
-            image_url = response.data[0].url
-
-            image_urls = [image_url]
-            attachments = []
-            for i, url_path in enumerate(image_urls):
-                print(url_path)
-                with tempfile.NamedTemporaryFile(
-                    dir=self.shared_tmpfs, suffix=".png", delete=True
-                ) as tmp_file:
-                    tmp_file_path = tmp_file.name
-                    # tmp_file_path = "/app/src/image.png"
-                    print(tmp_file_path)
-                    save_image(url_path, tmp_file_path)
-                    attachments.append(Attachment(tmp_file_path))
-                    await ctx.message.reply(
-                        body="", attachments=attachments, quote=True
-                    )
-                    # assert tmp_file_path exists
-                    assert os.path.exists(tmp_file_path)
-
-        except Exception as e:
-            await self.system_message(ctx, f"API call failed {e}")
+            if cached is None:
+                # DALL-E 3 makes one image per request, so make them in parallel
+                async with anyio.create_task_group() as tg:
+                    for _ in range(n):
+                        tg.start_soon(self.make_image, msg, files)
+            else:
+                # kept until signald has sent them, even if evicted meanwhile
+                files = [self.attachments.acquire(file) for file in cached]
+            attachments = [Attachment(file.path) for file in files]
+            await self.reply(ctx, "", attachments=attachments, quote=True, wait=True)
+            if cached is None and self.image_cache is not None:
+                # the cache holds references of its own
+                self.image_cache.set(
+                    key, tuple(self.attachments.acquire(file) for file in files)
+                )
+        except (Exception, anyio.ExceptionGroup) as e:
+            # the images' errors come as a group
+            errors = getattr(e, "exceptions", [e])
+            if any(isinstance(error, QuotaExceeded) for error in errors):
+                await self.system_message(ctx, "No room for more images, try later")
+            else:
+                await self.system_message(ctx, f"API call failed {e}")
             return
-        await ctx.message.typing_stopped()
+        finally:
+            for file in files:
+                self.attachments.release(file)
+        await self.typing(ctx, started=False)
+
+    async def make_image(self, prompt, files):
+        response = await self.openai.images(
+            prompt=prompt,
+            model="dall-e-3",
+            size="1024x1024",
+            quality="standard",
+            n=1,
+        )
+        url = response.data[0].url
+        log.debug("DALL-E image %s", url)
+        files.append(
+            await self.attachments.download(
+                self.http, url, ".png", self.MAX_IMAGE_BYTES
+            )
+        )
 
     def remove_commands(self, msg):
-        for command in self.special_commands:
-            msg = msg.replace(command, "")
-        for command in self.commands:
-            msg = msg.replace(command, "")
-        for command in self.admin_commands:
-            msg = msg.replace(command, "")
-        return msg.strip()
+        return self.router.strip(msg)
 
     async def suno_fn(self, ctx):
         msg = ctx.message.get_body()
         msg = self.remove_commands(msg)
+        if len(msg) == 0:
+            await self.system_message(ctx, "Please provide a prompt")
+            return
 
-        await ctx.message.typing_started()
+        # the song is generated in the background, see suno_job_done
+        job_id = self.suno_jobs.submit(
+            self.get_chat_id(ctx),
+            {"prompt": msg, "make_instrumental": False, "wait_audio": False},
+        )
+        await self.system_message(
+            ctx, f"Making song {job_id}, it will be posted here when it's ready"
+        )
+
+    async def suno_job_done(self, job):
+        # these are queued until signald is connected, and sent as one
+        # message if they are queued close together
+        chat_id = job["chat_id"]
+        if job["status"] != "done":
+            await self.send(
+                chat_id, f"[PG-Tips: Song {job['id']} failed: {job['error']}]"
+            )
+            return
+        files = [None] * len(job["urls"])
+        if self.SUNO_ATTACHMENTS:
+            async with anyio.create_task_group() as tg:
+                for i, url in enumerate(job["urls"]):
+                    tg.start_soon(self.download_song, url, files, i)
+        try:
+            attachments = [
+                Attachment(
+                    file.path,
+                    content_type="audio/mpeg",
+                    custom_filename=f"song-{job['id']}-{i + 1}.mp3",
+                )
+                for i, file in enumerate(files)
+                if file is not None
+            ]
+            sent = False
+            if attachments:
+                sent = await self.send(
+                    chat_id, f"Song {job['id']}", attachments=attachments, wait=True
+                )
+            for i, (url, file) in enumerate(zip(job["urls"], files)):
+                if file is None or not sent:
+                    await self.send(chat_id, f"Audio {i + 1}: {url}")
+        finally:
+            for file in files:
+                if file is not None:
+                    self.attachments.release(file)
+        # the song has been sent, so failing now would only send it again
         try:
-            url1, url2 = SunoAPI.generate_audio_by_prompt(
-                {"prompt": msg, "make_instrumental": False, "wait_audio": True}
+            limits = await self.suno_limits_msg()
+        except Exception as e:
+            log.warning("Could not get the Suno limits: %r", e)
+            return
+        await self.send(chat_id, f"[PG-Tips: {limits}]")
+
+    async def download_song(self, url, files, i):
+        # songs that are too big, or can't be downloaded, are sent as links
+        try:
+            files[i] = await self.attachments.download(
+                self.http, url, ".mp3", self.MAX_AUDIO_BYTES, retries=3
             )
+        except (DownloadTooLarge, QuotaExceeded) as e:
+            log.info("Sending %s as a link: %s", url, e)
         except Exception as e:
-            await self.system_message(ctx, f"API call failed {e}")
+            log.warning("Could not download %s, sending it as a link: %r", url, e)
+
+    async def suno_status_fn(self, ctx):
+        job_id = self.remove_commands(ctx.message.get_body()) or None
+        jobs = self.suno_jobs.status(self.get_chat_id(ctx), job_id)
+        if not jobs:
+            await self.system_message(ctx, "No songs found")
             return
-        await ctx.message.reply(f"Audio 1: {url1}")
-        await ctx.message.reply(f"Audio 2: {url2}")
-        await self.suno_limits_fn(ctx)
-        await ctx.message.typing_stopped()
+        lines = []
+        for job in jobs[:5]:
+            line = f"{job['id']}: {job['status']}"
+            if job["status"] == "done":
+                line += " " + " ".join(job["urls"])
+            elif job["status"] == "failed":
+                line += f" ({job['error']})"
+            lines.append(line)
+        await self.system_message(ctx, "\n".join(lines))
 
     async def suno_custom_fn(self, ctx):
-        msg = ctx.message.get_body()
-        # remove all commands from the message
-        for command in self.special_commands:
-            msg = msg.replace(command, "")
-        for command in self.commands:
-            msg = msg.replace(command, "")
-
-        # find genere tags inside [  ]
+        # lyrics, with the genre tags inside [ ]
+        msg = self.remove_commands(ctx.message.get_body())
         tags = re.findall(r"\[(.*?)\]", msg)
-        msg = re.sub(r"\[(.*?)\]", "", msg)
-
-        print("generating song with tags: ", tags)
+        lyrics = re.sub(r"\[(.*?)\]", "", msg).strip()
+        if len(lyrics) == 0:
+            await self.system_message(ctx, "Please provide some lyrics")
+            return
 
-        clips = suno_client.songs.generate(
-            msg.strip(),
+        log.info("generating song with tags: %s", tags)
+        job_id = self.suno_jobs.submit(
+            self.get_chat_id(ctx),
+            {
+                "prompt": lyrics,
+                "tags": ", ".join(tags),
+                "title": "",
+                "make_instrumental": False,
+                "wait_audio": False,
+            },
             custom=True,
-            tags=tags,
-            instrumental=False,
         )
-        clip = client.songs.get("your-clip-id-here")
-        print(clip)
+        await self.system_message(
+            ctx, f"Making song {job_id}, it will be posted here when it's ready"
+        )
+
+    async def suno_limits_msg(self):
+        data = self.suno_limits_cache.get("limits")
+        if data is None:
+            data = await anyio.to_thread.run_sync(SunoAPI.get_limits)
+            if data is None:
+                return "Failed to get limits"
+            self.suno_limits_cache.set("limits", data)
+        return f"Monthly limit: {data['monthly_limit']}, Monthly usage: {data['monthly_usage']}, Credits left: {data['credits_left']}"
 
     async def suno_limits_fn(self, ctx):
         """
         Get the limits of the Suno API (i.e. how much credit is left)
         """
-
-        data = SunoAPI.get_limits()
-        if data is not None:
-            msg = f"Monthly limit: {data['monthly_limit']}, Monthly usage: {data['monthly_usage']}, Credits left: {data['credits_left']}"
-            await self.system_message(ctx, msg)
-        else:
-            await self.system_message(ctx, "Failed to get limits")
+        await self.system_message(ctx, await self.suno_limits_msg())
 
     # Placeholder for stable diffusion functionality
     def stable_fn(self, ctx):
@@ -408,55 +963,126 @@ class MyBot:
     def default_action(self, ctx):
         pass
 
-    async def help_fn(self, ctx):
+    def build_help_text(self):
         msg = "Commands:\n"
         for command in self.special_commands:
             msg += f"{command}: {self.special_commands[command][1]}\n"
         for command in self.commands:
             msg += f"{command}: {self.commands[command][1]}\n"
-        await self.system_message(ctx, msg)
+        return msg
+
+    async def help_fn(self, ctx):
+        await self.system_message(ctx, self.help_text)
+
+    async def export_fn(self, ctx):
+        # the archived messages, as gzipped JSON lines sent to the chat
+        if self.archive is None:
+            await self.system_message(ctx, "The archive is turned off")
+            return
+        which = self.remove_commands(ctx.message.get_body())
+        chat_id = None if which == "all" else which or self.get_chat_id(ctx)
+        # workers each have a share of the tmpfs, which can be smaller
+        max_bytes = min(self.MAX_EXPORT_BYTES, self.attachments.quota)
+        file = self.attachments.new_file(".jsonl.gz")
+        try:
+            await self.attachments.reserve(file, max_bytes)
+            count = await self.archive.export(chat_id, file.path, max_bytes)
+            await self.attachments.finish(file)
+            attachment = Attachment(
+                file.path,
+                content_type="application/gzip",
+                custom_filename="messages.jsonl.gz",
+            )
+            await self.reply(
+                ctx,
+                f"[PG-Tips: {count} messages]",
+                attachments=[attachment],
+                quote=True,
+                wait=True,
+            )
+        except QuotaExceeded:
+            await self.system_message(ctx, "No room for the export, try later")
+        except ExportTooLarge:
+            await self.system_message(ctx, "The export is too big to send")
+        finally:
+            self.attachments.release(file)
+
+    async def cache_stats_fn(self, ctx):
+        lines = []
+        for name, cache in self.caches.items():
+            stats = cache.stats()
+            lines.append(
+                f"{name}: {stats['hits']} hits, {stats['misses']} misses, "
+                f"{stats['size']} entries"
+            )
+        await self.system_message(ctx, "\n".join(lines))
+
+    async def stats_fn(self, ctx):
+        lines = METRICS.summary()
+        await self.system_message(ctx, "\n".join(lines) or "No stats yet")
 
     def load_minecraft_info(self):
-        with open("minecraft.json") as f:
-            info = json.load(f)
         # info is formatted as {"instance_id": ["ip", "allowed_group1", "allowed_group2", ...]}
-        return info
+        return self.minecraft.info
 
-    async def server_on(self, ctx):
-        group_id = ctx.message.get_group_id()
+    async def change_server_state(self, ctx, action):
+        servers = self.minecraft.for_group(ctx.message.get_group_id())
+        if not servers:
+            await self.system_message(ctx, "No Minecraft server for this chat")
+            return
+        instance_id, server_ip = servers[0]
+        try:
+            ret_txt = await anyio.to_thread.run_sync(
+                AwsEc2Api.change_instance_state, action, instance_id
+            )
+        except Exception as e:
+            ret_txt = str(e)
+        log.info("server %s %s: %s", instance_id, action, ret_txt)
+        await self.system_message(ctx, ret_txt)
 
-        info = self.load_minecraft_info()
-        # check if the group_id is in the allowed groups
-        for instance_id, values in info.items():
-            if group_id in values[1:]:
-                server_ip = values[0]
-                ret_txt = None
-                try:
-                    ret_txt = AwsEc2Api.change_instance_state("ON", instance_id)
-                except Exception as e:
-                    ret_txt = str(e)
-                print("server on complete?")
-                await self.system_message(ctx, ret_txt)
-                return
+    async def server_on(self, ctx):
+        await self.change_server_state(ctx, "ON")
 
     async def server_off(self, ctx):
-        group_id = ctx.message.get_group_id()
-        info = self.load_minecraft_info()
-        # check if the group_id is in the allowed groups
-        for instance_id, values in info.items():
-            if group_id in values[1:]:
-                server_ip = values[0]
-                ret_txt = None
-                try:
-                    ret_txt = AwsEc2Api.change_instance_state("OFF", instance_id)
-                except Exception as e:
-                    ret_txt = str(e)
-                print("server off complete?")
-                await self.system_message(ctx, ret_txt)
-                return
+        await self.change_server_state(ctx, "OFF")
+
+    async def server_status(self, ctx):
+        servers = self.minecraft.for_group(ctx.message.get_group_id())
+        if not servers:
+            await self.system_message(ctx, "No Minecraft server for this chat")
+            return
+        try:
+            states = await anyio.to_thread.run_sync(
+                AwsEc2Api.describe_instances,
+                [instance_id for instance_id, _ in servers],
+            )
+        except Exception as e:
+            await self.system_message(ctx, f"API call failed {e}")
+            return
+        lines = []
+        for instance_id, server_ip in servers:
+            state, public_ip = states.get(instance_id, ("unknown", None))
+            lines.append(f"{public_ip or server_ip}: {state}")
+        await self.system_message(ctx, "\n".join(lines))
 
     async def register_handlers(self, bot):
-        bot.register_handler("", self.message_handler)
+        bot.register_handler("", self.on_message)
+
+    async def on_message(self, ctx: ChatContext):
+        # semaphore's own group accepting (for each sender's first message)
+        # waits behind the sends, letting their later messages overtake it,
+        # so groups are accepted here in the background, once per connection
+        group_id = ctx.message.get_group_id()
+        if group_id is not None and group_id not in self._accepted:
+            self._accepted.add(group_id)
+            self._task_group.start_soon(self.accept_group, self.signal, group_id)
+        await self.message_handler(ctx)
+
+    async def accept_group(self, signal, group_id):
+        try:
+            await signal.accept_invitation(group_id)
+        except CONNECTION_ERRORS as e:
+            log.info("Accepting %s failed: %r", group_id, e)
 
     async def message_handler(self, ctx: ChatContext):
         msg = ctx.message.get_body()
@@ -466,49 +1092,164 @@ class MyBot:
         if group_id is None:
             group_id = number
 
-        if "/show-group-id" in msg.lower():
-            await ctx.message.reply(
-                f"[PG-Tips: group-id `{group_id}`]",
-            )
-            return
-        if "/reload-allow-list" in msg.lower():
-            self.load_allow_list()
-            return
-        if "/show-uuid" in msg.lower():
-            await ctx.message.reply(
-                f"[PG-Tips: uuid `{ctx.message.source.uuid}`]",
-            )
+        skip = () if self.is_admin(ctx) else ("admin",)
+        route = self.router.route(msg, skip=skip)
+        if route.kind == "public":
+            await self.public_commands[route.commands[0]][0](ctx)
             return
 
         if group_id not in self.allow_list:
             return
 
         username = await self.get_username(ctx)
-        print("number: ", number)
-        print("username: ", username)
-        print("uuid: ", ctx.message.source.uuid)
-        print("group_id: ", group_id)
-        print(f"Processing command for: {msg}")
-        await self.process_commands(msg, ctx)
+        METRICS.inc("messages_total", kind=route.kind)
+        log.debug(
+            "Processing message",
+            extra={
+                "fields": {
+                    "number": number,
+                    "username": username,
+                    "uuid": ctx.message.source.uuid,
+                    "group_id": group_id,
+                    "msg": msg,
+                }
+            },
+        )
+        # semaphore reuses the context for the next message from the same
+        # sender, so the queued message gets a copy of its own
+        await self.mailboxes.put(self.get_chat_id(ctx), (copy.copy(ctx), route))
+
+    async def stop_on_signal(self, cancel_scope):
+        with anyio.open_signal_receiver(signal.SIGTERM, signal.SIGINT) as signals:
+            async for signum in signals:
+                log.info("Received signal %s, shutting down", signum)
+                cancel_scope.cancel()
+                return
 
-    async def run(self):
-        async with Bot(self.bot_number, socket_path=self.socket_path) as bot:
+    async def start_services(self, tg):
+        # the background work, which carries on across signald reconnects
+        self._task_group = tg
+        tg.start_soon(self.usernames.run)
+        tg.start_soon(self.config.run)
+        if self.archive is not None:
+            tg.start_soon(self.archive.run)
+        self.outbox.start(tg)
+        self.mailboxes.start(tg)
+        if self.summaries is not None:
+            self.summaries.start(tg)
+        await self.suno_jobs.start(tg)
+
+    async def connect(self):
+        # one connection to signald, returns or raises when it drops
+        async with Bot(
+            self.bot_number, socket_path=self.socket_path, group_auto_accept=False
+        ) as bot:
             await bot.set_profile(self.bot_default_name)
             await self.register_handlers(bot)
-            await bot.start()
+            self.signal = bot
+            self._accepted = set()
+            self.on_connected()
+            log.info("Connected to signald")
+            try:
+                await bot.start()
+            finally:
+                self.signal = None
+                self.on_disconnected()
+
+    @classmethod
+    def from_env(cls, **kwargs):
+        # the bot configured by the environment, as in bot.env
+        return cls(
+            bot_number=os.environ["BOT_NUMBER"],
+            bot_default_name=os.environ["BOT_DEFAULT_NAME"],
+            bot_default_model=os.environ["BOT_DEFAULT_MODEL"],
+            usernames_file="usernames.json",
+            socket_path=os.environ["SIGNALD_SOCKET_PATH"],
+            admin_number=os.environ["BOT_ADMIN_NUMBER"],
+            admin_uuid=os.environ["BOT_ADMIN_UUID"],
+            allow_list_file="allowlist.json",
+            history_store=os.environ.get("BOT_HISTORY_STORE", "log"),
+            state_dir=os.environ.get("BOT_STATE_DIR", "/app/state/"),
+            shared_tmpfs=os.environ.get("BOT_SHARED_TMPFS", "/shared_tmpfs/"),
+            **kwargs,
+        )
+
+    def setup_signald(self):
+        # the connection to signald and the outbox, all the front needs of
+        # the bot in sharded mode (see shards.py)
+        self.signal = None  # the semaphore Bot, while connected
+        self._accepted = set()  # groups accepted on this connection
+        self._task_group = None
+        self.RECONNECT_MIN = float(os.environ.get("SIGNALD_RECONNECT_MIN", 1))
+        self.RECONNECT_MAX = float(os.environ.get("SIGNALD_RECONNECT_MAX", 60))
+        self.outbox = Outbox(
+            self.deliver,
+            window=int(os.environ.get("BOT_SEND_WINDOW", 4)),
+            min_interval=float(os.environ.get("BOT_SEND_INTERVAL", 0.5)),
+        )
+        # local Prometheus-style endpoint, off unless BOT_METRICS_PORT is set
+        self.metrics_port = int(os.environ.get("BOT_METRICS_PORT", 0))
+        METRICS.gauge_fn("outbox_queued", lambda: [({}, self.outbox.queued())])
+        METRICS.gauge_fn("outbox_merged", lambda: [({}, self.outbox.merged)])
+
+    def on_connected(self):
+        self.outbox.connected()
+
+    def on_disconnected(self):
+        self.outbox.disconnected()
+
+    async def supervise(self):
+        # stay connected to signald, reconnecting with exponential backoff
+        delay = self.RECONNECT_MIN
+        while True:
+            connected_at = time.monotonic()
+            try:
+                await self.connect()
+                error = "closed the connection"
+            except (Exception, anyio.ExceptionGroup) as e:
+                error = f"connection failed: {e!r}"
+            METRICS.inc("signal_disconnects_total")
+            if time.monotonic() - connected_at > self.RECONNECT_MAX:
+                # the connection was up for a while, so retry promptly
+                delay = self.RECONNECT_MIN
+            log.warning("signald %s, reconnecting in %.1fs", error, delay)
+            await anyio.sleep(delay * random.uniform(0.8, 1.2))
+            delay = min(delay * 2, self.RECONNECT_MAX)
+
+    async def run(self):
+        try:
+            async with anyio.create_task_group() as tg:
+                tg.start_soon(self.stop_on_signal, tg.cancel_scope)
+                tg.start_soon(anyio.to_thread.run_sync, preload_openai)
+                if self.metrics_port:
+                    tg.start_soon(METRICS.serve, self.metrics_port)
+                await self.start_services(tg)
+                await self.supervise()
+                tg.cancel_scope.cancel()
+        finally:
+            self.usernames.flush()
+            self.seen.close()
+            if self.archive is not None:
+                self.archive.close()
+            if self._http is not None:
+                await self._http.aclose()
+            if self.image_cache is not None:
+                self.image_cache.clear()
 
 
 # Main execution
 if __name__ == "__main__":
-    bot = MyBot(
-        bot_number=os.environ["BOT_NUMBER"],
-        bot_default_name=os.environ["BOT_DEFAULT_NAME"],
-        bot_default_model=os.environ["BOT_DEFAULT_MODEL"],
-        usernames_file="usernames.json",
-        socket_path=os.environ["SIGNALD_SOCKET_PATH"],
-        admin_number=os.environ["BOT_ADMIN_NUMBER"],
-        admin_uuid=os.environ["BOT_ADMIN_UUID"],
-        allow_list_file="allowlist.json",
+    setup_logging(
+        os.environ.get("BOT_LOG_LEVEL", "INFO"),
+        os.environ.get("BOT_LOG_FORMAT", "text"),
     )
+    workers = int(os.environ.get("BOT_WORKERS", 0))
+    if workers:
+        # chats are shared between worker processes, see shards.py
+        from shards import FrontBot
+
+        bot = FrontBot.from_env(workers=workers)
+    else:
+        bot = MyBot.from_env()
 
     anyio.run(bot.run)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Small in-memory caches for command results.
+"""
+
+import time
+import hashlib
+from collections import OrderedDict
+
+
+def normalize(text):
+    # cache key for free text: case and spacing don't change the result
+    return " ".join(text.lower().split())
+
+
+def prompt_hash(text):
+    return hashlib.sha256(normalize(text).encode()).hexdigest()
+
+
+class TTLCache:
+    """
+    A least-recently-used cache of at most `maxsize` entries, which each
+    expire `ttl` seconds after being set (never, if ttl is None).
+
+    `on_evict(key, value)` is called for entries that expire or are pushed
+    out, e.g. to delete files the values refer to.
+    """
+
+    def __init__(self, maxsize=128, ttl=None, on_evict=None, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (expiry time, value)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _evict(self, key):
+        _, value = self._entries.pop(key)
+        if self.on_evict is not None:
+            self.on_evict(key, value)
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires, value = entry
+            if expires is None or expires > self.clock():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            self._evict(key)
+        self.misses += 1
+        return default
+
+    def set(self, key, value):
+        if key in self._entries:
+            self._evict(key)
+        expires = None if self.ttl is None else self.clock() + self.ttl
+        self._entries[key] = (expires, value)
+        while len(self._entries) > self.maxsize:
+            self._evict(next(iter(self._entries)))
+
+    def evict_oldest(self):
+        # drop the least recently used entry, returning False if there's none
+        if not self._entries:
+            return False
+        self._evict(next(iter(self._entries)))
+        return True
+
+    def clear(self):
+        for key in list(self._entries):
+            self._evict(key)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self)}
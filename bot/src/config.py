@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Config files, reloaded when they change.
+
+Each file is parsed into an immutable snapshot (read-only mappings and
+tuples), with any indexes built at load time, and a new version replaces
+the old in one assignment.  Handling a message only reads the current
+snapshot, so it never touches the disk and always sees one consistent
+version of a file.
+
+`ConfigWatcher.run` polls the files' modification times every `interval`
+seconds, reads and parses the changed ones in a worker thread, and swaps
+them in on the event loop.  A file that doesn't parse or validate is
+logged, and the previous version is kept until it changes again.
+
+Watched files have `changed()`, `read()` (in a worker thread, returning
+what to give to `swap`, with any error as the value) and `swap(loaded)`.
+"""
+
+import os
+import json
+import logging
+from types import MappingProxyType
+
+import anyio
+
+from metrics import METRICS
+
+log = logging.getLogger(__name__)
+
+
+class ConfigError(ValueError):
+    pass
+
+
+def freeze(value):
+    # a read-only copy of parsed JSON
+    if isinstance(value, dict):
+        return MappingProxyType({key: freeze(v) for key, v in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+def file_signature(path):
+    # changes whenever the file is written or replaced, None if it is missing
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+def read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+# settings a chat can have in the allow list, and their types
+ALLOW_LIST_SETTINGS = {
+    "name": (str, type(None)),
+    "max_tokens": int,
+    "stream": bool,
+    "rate_per_hour": (int, float),
+    "burst": (int, float),
+    "weight": (int, float),
+    "models": list,
+    "fanout": str,
+}
+
+NO_CONFIG = MappingProxyType({"name": None})
+
+
+def parse_allow_list(data):
+    """
+    {chat id: settings}, where the settings of a chat given by name in the
+    file are {"name": name}.
+    """
+    if not isinstance(data, dict):
+        raise ConfigError("expected an object of chat ids")
+    allow_list = {}
+    for chat_id, value in data.items():
+        if not isinstance(value, dict):
+            value = {"name": value}
+        for key, expected in ALLOW_LIST_SETTINGS.items():
+            if key in value and not isinstance(value[key], expected):
+                raise ConfigError(f"{chat_id}: bad {key} {value[key]!r}")
+        for key in ("weight", "max_tokens", "rate_per_hour", "burst"):
+            if value.get(key, 1) <= 0:
+                raise ConfigError(f"{chat_id}: {key} must be positive")
+        if value.get("fanout", "first") not in ("first", "all"):
+            raise ConfigError(f'{chat_id}: fanout must be "first" or "all"')
+        if not all(isinstance(model, str) for model in value.get("models", [])):
+            raise ConfigError(f"{chat_id}: models must be model names")
+        allow_list[chat_id] = value
+    return freeze(allow_list)
+
+
+class ConfigFile:
+    def __init__(self, path, parse, empty):
+        self.path = path
+        self.parse = parse  # parsed JSON -> snapshot, or raises ValueError
+        self.empty = empty  # the snapshot when there's no file
+        self.signature = None
+        self.value = empty
+        self.reload()
+
+    def changed(self):
+        return file_signature(self.path) != self.signature
+
+    def read(self):
+        signature = file_signature(self.path)
+        if signature is None:
+            return signature, self.empty
+        try:
+            return signature, self.parse(read_json(self.path))
+        except (OSError, ValueError) as e:
+            return signature, e
+
+    def swap(self, loaded):
+        signature, value = loaded
+        self.signature = signature
+        name = os.path.basename(self.path)
+        if isinstance(value, Exception):
+            log.warning("Could not load %s, keeping the last version: %s", name, value)
+            METRICS.inc("config_loads_total", file=name, status="error")
+            return False
+        if signature is None:
+            log.warning("No %s found", name)
+        self.value = value
+        METRICS.inc("config_loads_total", file=name, status="ok")
+        return True
+
+    def reload(self):
+        return self.swap(self.read())
+
+
+class ConfigWatcher:
+    def __init__(self, files, interval=2.0):
+        self.files = files
+        self.interval = interval
+
+    def _read_changed(self):
+        return [(file, file.read()) for file in self.files if file.changed()]
+
+    async def check(self):
+        for file, loaded in await anyio.to_thread.run_sync(self._read_changed):
+            log.info("%s changed, reloading", file.path)
+            file.swap(loaded)
+
+    async def run(self):
+        # reload changed files until cancelled
+        while True:
+            await anyio.sleep(self.interval)
+            try:
+                await self.check()
+            except OSError as e:
+                log.warning("Checking the config files failed: %r", e)
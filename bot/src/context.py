@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+Prompt assembly for /thots.
+
+Each history entry is formatted into a chat message once, and its token
+count is cached alongside, so building a prompt is a walk back through the
+history adding up cached counts until the model's token budget is used up.
+The oldest turns that don't fit are left out.  The size of each prompt, and
+the turns left out, are recorded in the metrics.
+"""
+
+import logging
+from collections import OrderedDict
+
+from metrics import METRICS, TOKEN_BUCKETS
+
+log = logging.getLogger(__name__)
+
+SYSTEM_PROMPT = (
+    "This is a group chat conversation with multiple participants. "
+    "Their messages are shown below, and are the format '[Name]: [Message]'."
+)
+
+SUMMARY_PREFIX = "Summary of the conversation before these messages:\n"
+
+# tokens used by each chat message on top of its content (role, separators)
+MESSAGE_OVERHEAD = 4
+
+
+def estimate_tokens(text):
+    # offline estimate, English text averages about 4 characters per token
+    return len(text) // 4 + 1
+
+
+def make_tokenizer(model):
+    """
+    Token counter for a model, using tiktoken if it is installed and has
+    the encoding available, otherwise `estimate_tokens`.
+    """
+    try:
+        import tiktoken
+    except ImportError:
+        return estimate_tokens
+    try:
+        try:
+            encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            encoding = tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        # the encoding is downloaded on first use, which can fail offline
+        log.warning("No tiktoken encoding for %s, estimating tokens: %s", model, e)
+        return estimate_tokens
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+
+class ContextBuilder:
+    def __init__(
+        self,
+        bot_number,
+        usernames,
+        bot_name="Bot",
+        budgets=None,
+        default_budget=4000,
+        tokenizer_factory=make_tokenizer,
+        cache_size=4096,
+    ):
+        self.bot_number = bot_number
+        self.usernames = usernames
+        self.bot_name = bot_name  # the bot's turns are labelled with this
+        self.budgets = budgets or {}
+        self.default_budget = default_budget
+        self.tokenizer_factory = tokenizer_factory
+        self.cache_size = cache_size
+        self._tokenizers = {}  # model -> token counter
+        self._cache = OrderedDict()  # (model, user, name, msg) -> (message, tokens)
+        self.last_prompt = {}  # chat id -> size of the last prompt built
+
+    def budget(self, model):
+        return self.budgets.get(model, self.default_budget)
+
+    def count_tokens(self, model, text):
+        count = self._tokenizers.get(model)
+        if count is None:
+            count = self.tokenizer_factory(model)
+            self._tokenizers[model] = count
+        return count(text)
+
+    def name(self, user):
+        return self.bot_name if user == self.bot_number else self.usernames[user]
+
+    def _entry(self, model, user, msg):
+        name = self.name(user)
+        key = (model, user, name, msg)
+        entry = self._cache.get(key)
+        if entry is not None:
+            self._cache.move_to_end(key)
+            return entry
+        content = name + ": " + msg.strip()
+        message = {
+            "role": "assistant" if user == self.bot_number else "user",
+            "content": content,
+        }
+        entry = (message, self.count_tokens(model, content) + MESSAGE_OVERHEAD)
+        self._cache[key] = entry
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return entry
+
+    def build(self, model, msg_history, max_tokens, chat_id=None, summary=None):
+        """
+        The messages to send for a history of `(number, message)` tuples,
+        keeping the newest turns that fit in the model's budget, less the
+        `max_tokens` reserved for the reply.  A `summary` of the conversation
+        before `msg_history` goes after the system prompt.
+        """
+        system = [{"role": "system", "content": SYSTEM_PROMPT}]
+        used = self.count_tokens(model, SYSTEM_PROMPT) + MESSAGE_OVERHEAD
+        if summary:
+            content = SUMMARY_PREFIX + summary
+            system.append({"role": "system", "content": content})
+            used += self.count_tokens(model, content) + MESSAGE_OVERHEAD
+        available = self.budget(model) - max_tokens
+
+        turns = []
+        for user, msg in reversed(msg_history):
+            message, tokens = self._entry(model, user, msg)
+            if used + tokens > available:
+                break
+            used += tokens
+            turns.append(message)
+        turns.reverse()
+
+        dropped = len(msg_history) - len(turns)
+        METRICS.observe("thots_prompt_tokens", used, buckets=TOKEN_BUCKETS, model=model)
+        if dropped:
+            METRICS.inc("thots_dropped_turns_total", dropped, model=model)
+        if chat_id is not None:
+            self.last_prompt[chat_id] = {
+                "model": model,
+                "messages": len(turns),
+                "dropped": dropped,
+                "tokens": used,
+                "budget": available,
+                "summary": bool(summary),
+            }
+        return system + turns
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Paid commands already run, kept across restarts.
+
+After a restart signald can deliver recent messages again, which would run
+their /dalle3 or /suno a second time, and pay for it twice.  So each paid
+command is recorded in a `SeenIndex` before it runs, keyed on the message's
+timestamp, sender and chat, and the command, and a command already in the
+index is skipped.
+
+The keys are hashed to 16 bytes, and held in memory in an ordered dict, so
+a check is one lookup; as entries are added in time order, expired ones are
+dropped from the front.  On disk, each is appended to a log of fixed size
+records (the time seen, and the hash), which is rewritten without the
+expired entries when they make up most of it.
+"""
+
+import os
+import glob
+import time
+import struct
+import hashlib
+import logging
+from collections import OrderedDict
+
+from metrics import METRICS
+
+log = logging.getLogger(__name__)
+
+RECORD = struct.Struct("!I16s")  # seconds since the epoch, key hash
+
+
+def message_key(message, chat_id, command):
+    # None if the message can't be told apart from others
+    if not message.timestamp:
+        return None
+    sender = message.source.uuid or message.source.number
+    key = f"{message.timestamp}|{sender}|{chat_id}|{command}"
+    return hashlib.blake2b(key.encode(), digest_size=16).digest()
+
+
+class SeenIndex:
+    def __init__(
+        self, path, ttl=7 * 24 * 3600, max_entries=10000, clock=time.time, load=None
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        self.seen = OrderedDict()  # key hash -> time seen, oldest first
+        self.records = 0  # in the file, live or not
+        # several processes can have their own files (see shards.py), and a
+        # chat can move between them, so all of them are read at start up
+        entries = []
+        for path in set(load or [path]):
+            entries += self._read(path)
+        for seen, key in sorted(entries):
+            self.seen[key] = seen
+        self._expire()
+        self._file = None
+        self._compact()
+
+    def _read(self, path):
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return []
+        # a partly written last record, from a crash, is ignored
+        end = len(data) - len(data) % RECORD.size
+        return list(RECORD.iter_unpack(data[:end]))
+
+    def _expire(self):
+        cutoff = self.clock() - self.ttl
+        while self.seen and (
+            len(self.seen) > self.max_entries or next(iter(self.seen.values())) < cutoff
+        ):
+            self.seen.popitem(last=False)
+
+    def _compact(self):
+        # rewrite the file with only the live entries
+        tmp_path = f"{self.path}.tmp"
+        with METRICS.timed("state_seconds", op="seen_compact"):
+            with open(tmp_path, "wb") as f:
+                f.write(
+                    b"".join(RECORD.pack(seen, key) for key, seen in self.seen.items())
+                )
+            os.replace(tmp_path, self.path)
+        self.records = len(self.seen)
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self.path, "ab", buffering=0)
+
+    def __contains__(self, key):
+        return key in self.seen
+
+    def add(self, key):
+        """
+        Record key, returning False if it was already there.  The record is
+        in the file once this returns, so it survives the process crashing.
+        """
+        if key in self.seen:
+            METRICS.inc("duplicates_total")
+            return False
+        seen = int(self.clock())
+        self.seen[key] = seen
+        self._expire()
+        try:
+            self._file.write(RECORD.pack(seen, key))
+            self.records += 1
+            if self.records > max(1000, 2 * len(self.seen)):
+                self._compact()
+        except OSError as e:
+            log.warning("Could not record a seen message: %r", e)
+        return True
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def seen_files(state_dir):
+    # the files of every process sharing the state directory
+    return glob.glob(os.path.join(state_dir, "seen*.bin"))
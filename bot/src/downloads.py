@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Streaming downloads into the shared tmpfs.
+
+Files are fetched in chunks through a shared `httpx.AsyncClient`, so only
+one chunk per download is held in memory, and a download is abandoned as
+soon as it goes over its size limit.  A download that fails part way can
+be resumed from where it stopped.
+"""
+
+import os
+import secrets
+import logging
+
+import anyio
+
+from metrics import METRICS
+
+log = logging.getLogger(__name__)
+
+
+class DownloadTooLarge(Exception):
+    pass
+
+
+def make_http_client(max_connections=10, timeout=60.0):
+    # one pooled client for all downloads, httpx is imported when first needed
+    import httpx
+
+    return httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=max_connections),
+        timeout=timeout,
+        follow_redirects=True,
+    )
+
+
+def tmp_path(directory, suffix):
+    # a unique file name in the shared tmpfs, which signald can read
+    return os.path.join(directory, f"{secrets.token_hex(8)}{suffix}")
+
+
+async def download_to_file(
+    client,
+    url,
+    path,
+    max_bytes,
+    chunk_size=64 * 1024,
+    on_length=None,
+    retries=0,
+    retry_delay=1.0,
+):
+    """
+    Download url to path, returning the number of bytes written.
+
+    Raises DownloadTooLarge if the file is bigger than max_bytes, in which
+    case, or on any other error, no file is left behind.  If given,
+    `await on_length(length)` is called before anything is written, with
+    the Content-Length, or None if the server didn't send one.
+
+    If the connection fails, the download is resumed where it stopped with
+    a Range request, up to `retries` times.
+    """
+    import httpx
+
+    size = 0
+    started = False
+    attempt = 0
+    try:
+        with open(path, "wb") as f:
+            while True:
+                headers = {"Range": f"bytes={size}-"} if size else None
+                try:
+                    async with client.stream("GET", url, headers=headers) as response:
+                        response.raise_for_status()
+                        content_range = response.headers.get("Content-Range", "")
+                        if size and not content_range.startswith(f"bytes {size}-"):
+                            # the server ignored the range, start again
+                            f.seek(0)
+                            f.truncate()
+                            size = 0
+                        if not started:
+                            length = response.headers.get("Content-Length")
+                            if length is not None and int(length) > max_bytes:
+                                raise DownloadTooLarge(f"{url} is {length} bytes")
+                            if on_length is not None:
+                                await on_length(None if length is None else int(length))
+                            started = True
+                        async for chunk in response.aiter_bytes(chunk_size):
+                            size += len(chunk)
+                            if size > max_bytes:
+                                raise DownloadTooLarge(
+                                    f"{url} is over {max_bytes} bytes"
+                                )
+                            f.write(chunk)
+                    return size
+                except httpx.TransportError as e:
+                    if attempt == retries:
+                        raise
+                    attempt += 1
+                    log.info("Download of %s failed at %d bytes: %r", url, size, e)
+                    METRICS.inc("download_retries_total")
+                    await anyio.sleep(retry_delay * attempt)
+    except BaseException:
+        remove_file(path)
+        raise
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""
+Chat history storage.
+
+The history of a chat is a list of `(number, message)` tuples, oldest first,
+capped at `max_messages`.  Stores are selected by name with `make_history_store`.
+"""
+
+import os
+import sys
+import json
+import pickle
+import logging
+from collections import deque, OrderedDict
+
+log = logging.getLogger(__name__)
+
+
+class Turn:
+    """
+    A retained history entry.  The sender is interned, as a chat has a
+    handful of senders, so entries share one copy of each number or UUID.
+    The message is kept as UTF-8, which is smaller than a str, by a factor
+    of four for messages with an emoji, and is decoded when the history is
+    loaded for a prompt.
+    """
+
+    __slots__ = ("sender", "data")
+
+    def __init__(self, sender, msg):
+        self.sender = sys.intern(sender)
+        self.data = msg.encode()
+
+    def entry(self):
+        return (self.sender, self.data.decode())
+
+    def size(self):
+        return TURN_OVERHEAD + sys.getsizeof(self.data)
+
+
+# memory used by a retained entry on top of its message: the Turn and its
+# slot in the deque (the sender is shared)
+TURN_OVERHEAD = sys.getsizeof(Turn("", "")) + 8
+
+
+def group_key(group_id):
+    # group ids are base64, so can contain "/", which can't go in a filename
+    return group_id.replace("/", "_")
+
+
+class PickleHistoryStore:
+    """
+    The original store: the whole history is pickled to `{group_id}.pkl`,
+    and loaded and rewritten for every message.
+    """
+
+    def __init__(self, state_dir, max_messages):
+        self.state_dir = state_dir
+        self.max_messages = max_messages
+        os.makedirs(state_dir, exist_ok=True)
+
+    def _path(self, group_id):
+        return os.path.join(self.state_dir, f"{group_key(group_id)}.pkl")
+
+    def load(self, group_id):
+        try:
+            with open(self._path(group_id), "rb") as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return []
+
+    def append(self, group_id, entry):
+        msg_history = self.load(group_id)
+        msg_history.append(entry)
+        msg_history = msg_history[-self.max_messages :]
+        with open(self._path(group_id), "wb") as f:
+            pickle.dump(msg_history, f)
+
+    def clear(self, group_id):
+        with open(self._path(group_id), "wb") as f:
+            pickle.dump([], f)
+
+
+class LogHistoryStore:
+    """
+    Append-only log per group, stored as JSON lines in `{group_id}.log`.
+
+    The last `max_messages` entries of each group are kept in memory as
+    `Turn`s, so loading is cheap after the first access, and storing a message
+    appends one line to the log.  Once the retained entries of all groups
+    take more than `memory_budget` bytes, the least recently used groups are
+    dropped from memory, to be read back from their logs when next used.
+
+    Once a log holds `compact_factor * max_messages` lines it is compacted:
+    the retained entries are written to a temporary file which atomically
+    replaces the log.  A torn final line (e.g. a crash
+    mid-write) is skipped on load and removed by compacting.
+
+    If a group has no log but has a `.pkl` file from `PickleHistoryStore`,
+    the pickle is migrated on first load and renamed to `.pkl.migrated`.
+    """
+
+    def __init__(
+        self,
+        state_dir,
+        max_messages,
+        compact_factor=4,
+        fsync=False,
+        memory_budget=64 * 1024 * 1024,
+    ):
+        self.state_dir = state_dir
+        self.max_messages = max_messages
+        self.compact_factor = compact_factor
+        self.fsync = fsync
+        self.memory_budget = memory_budget
+        # group key -> deque of the retained entries, least recently used first
+        self._buffers = OrderedDict()
+        self._lines = {}  # group key -> number of lines in the log file
+        self._sizes = {}  # group key -> bytes used by the retained entries
+        self.memory = 0  # bytes used by all retained entries
+        self.evictions = 0
+        os.makedirs(state_dir, exist_ok=True)
+
+    def _path(self, key, ext="log"):
+        return os.path.join(self.state_dir, f"{key}.{ext}")
+
+    def _buffer(self, group_id):
+        key = group_key(group_id)
+        buffer = self._buffers.get(key)
+        if buffer is None:
+            buffer = self._read(key)
+            self._buffers[key] = buffer
+            self._resize(key, sum(turn.size() for turn in buffer))
+        else:
+            self._buffers.move_to_end(key)
+        return key, buffer
+
+    def _resize(self, key, size):
+        self.memory += size - self._sizes.get(key, 0)
+        self._sizes[key] = size
+        # drop the coldest groups, but never the one in use
+        while self.memory > self.memory_budget and len(self._buffers) > 1:
+            cold = next(iter(self._buffers))
+            del self._buffers[cold]
+            del self._lines[cold]
+            self.memory -= self._sizes.pop(cold)
+            self.evictions += 1
+
+    def _read(self, key):
+        buffer = deque(maxlen=self.max_messages)
+        try:
+            f = open(self._path(key), encoding="utf-8")
+        except FileNotFoundError:
+            if self._migrate(key, buffer):
+                return buffer
+            self._lines[key] = 0
+            return buffer
+
+        lines = 0
+        damaged = False
+        with f:
+            for line in f:
+                lines += 1
+                try:
+                    number, msg = json.loads(line)
+                except ValueError:
+                    damaged = True
+                    continue
+                buffer.append(Turn(number, msg))
+            if lines and not line.endswith("\n"):
+                damaged = True
+        self._lines[key] = lines
+        if damaged:
+            log.warning("Repairing damaged history log for %s", key)
+            self._compact(key, buffer)
+        return buffer
+
+    def _migrate(self, key, buffer):
+        pkl_path = self._path(key, "pkl")
+        try:
+            with open(pkl_path, "rb") as f:
+                msg_history = pickle.load(f)
+        except FileNotFoundError:
+            return False
+        log.info("Migrating %s to an append-only log", pkl_path)
+        buffer.extend(Turn(*entry) for entry in msg_history)
+        self._compact(key, buffer)
+        os.replace(pkl_path, pkl_path + ".migrated")
+        return True
+
+    def _write(self, f, data):
+        f.write(data)
+        f.flush()
+        if self.fsync:
+            os.fsync(f.fileno())
+
+    def _compact(self, key, buffer):
+        path = self._path(key)
+        tmp_path = path + ".tmp"
+        data = "".join(json.dumps(turn.entry()) + "\n" for turn in buffer)
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            self._write(f, data)
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        self._lines[key] = len(buffer)
+
+    def load(self, group_id):
+        _, buffer = self._buffer(group_id)
+        return [turn.entry() for turn in buffer]
+
+    def append(self, group_id, entry):
+        key, buffer = self._buffer(group_id)
+        turn = Turn(*entry)
+        size = self._sizes[key] + turn.size()
+        if len(buffer) == buffer.maxlen:
+            size -= buffer[0].size()
+        buffer.append(turn)
+        with open(self._path(key), "a", encoding="utf-8") as f:
+            self._write(f, json.dumps(turn.entry()) + "\n")
+        self._lines[key] += 1
+        if self._lines[key] >= self.compact_factor * self.max_messages:
+            self._compact(key, buffer)
+        self._resize(key, size)
+
+    def clear(self, group_id):
+        key, buffer = self._buffer(group_id)
+        buffer.clear()
+        self._compact(key, buffer)
+        self._resize(key, 0)
+
+    def stats(self):
+        return {
+            "groups": len(self._buffers),
+            "messages": sum(len(buffer) for buffer in self._buffers.values()),
+            "bytes": self.memory,
+            "evictions": self.evictions,
+        }
+
+
+HISTORY_STORES = {
+    "log": LogHistoryStore,
+    "pickle": PickleHistoryStore,
+}
+
+
+def make_history_store(kind, state_dir, max_messages, **options):
+    # options are passed on to the store, e.g. memory_budget for "log"
+    try:
+        store_cls = HISTORY_STORES[kind]
+    except KeyError:
+        raise ValueError(
+            f"Unknown history store '{kind}', expected one of {list(HISTORY_STORES)}"
+        )
+    return store_cls(state_dir, max_messages, **options)
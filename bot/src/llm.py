@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Non-blocking access to the OpenAI API.
+
+All calls go through one `AsyncOpenAI` client, so a slow completion only
+holds up the chat that asked for it.  Each model has its own concurrency
+limit, and every request has a deadline.  The openai package is only
+imported, and the client built, when the first request is made.
+"""
+
+import os
+import anyio
+
+from metrics import METRICS
+
+
+def parse_limits(spec):
+    # "gpt-4o=4,dall-e-3=2" -> {"gpt-4o": 4, "dall-e-3": 2}
+    limits = {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        model, _, limit = item.partition("=")
+        limits[model.strip()] = int(limit)
+    return limits
+
+
+def preload():
+    # import the SDK ahead of the first request, in a worker thread, so that
+    # request doesn't hold up the event loop while openai is imported
+    import openai  # noqa: F401
+
+
+class OpenAIPool:
+    def __init__(self, client=None, limits=None, default_limit=4, timeout=60.0):
+        self._client = client
+        self.limits = limits or {}
+        self.default_limit = default_limit
+        self.timeout = timeout
+        self._limiters = {}
+
+    @classmethod
+    def from_env(cls, client=None):
+        """
+        OPENAI_CONCURRENCY: per-model limits, e.g. "gpt-4o=4,dall-e-3=2"
+        OPENAI_DEFAULT_CONCURRENCY: limit for models not listed (default 4)
+        OPENAI_TIMEOUT: deadline in seconds for each request (default 60)
+        """
+        return cls(
+            client=client,
+            limits=parse_limits(os.environ.get("OPENAI_CONCURRENCY", "")),
+            default_limit=int(os.environ.get("OPENAI_DEFAULT_CONCURRENCY", 4)),
+            timeout=float(os.environ.get("OPENAI_TIMEOUT", 60)),
+        )
+
+    @property
+    def client(self):
+        if self._client is None:
+            from openai import AsyncOpenAI
+
+            self._client = AsyncOpenAI()
+        return self._client
+
+    def limiter(self, model):
+        limiter = self._limiters.get(model)
+        if limiter is None:
+            limiter = anyio.CapacityLimiter(self.limits.get(model, self.default_limit))
+            self._limiters[model] = limiter
+        return limiter
+
+    async def chat(self, model, messages, max_tokens, timeout=None):
+        timeout = timeout or self.timeout
+        async with self.limiter(model):
+            with METRICS.timed(
+                "openai_request_seconds", model=model, call="chat"
+            ), anyio.fail_after(timeout):
+                return await self.client.chat.completions.create(
+                    messages=messages,
+                    model=model,
+                    max_tokens=max_tokens,
+                    timeout=timeout,
+                )
+
+    async def chat_first(self, requests, max_tokens, hedge_after=0.0, timeout=None):
+        """
+        Send one prompt to several models, as (model, messages) pairs in order
+        of preference, and return (model, completion) of the first to answer,
+        cancelling the others.  Each model after the first is only asked once
+        `hedge_after` seconds have passed without an answer.  Raises the last
+        error if none answer, and empty answers are only returned if all are.
+        """
+        if len(requests) == 1:
+            model, messages = requests[0]
+            return model, await self.chat(model, messages, max_tokens, timeout)
+        first = None
+        empty = None
+        errors = []
+
+        async def ask(i, model, messages):
+            nonlocal first, empty
+            await anyio.sleep(i * hedge_after)
+            if i:
+                METRICS.inc("hedged_requests_total", model=model)
+            try:
+                completion = await self.chat(model, messages, max_tokens, timeout)
+            except Exception as e:
+                errors.append(e)
+                return
+            if not completion.choices[0].message.content:
+                empty = (model, completion)
+                return
+            if first is None:
+                first = (model, completion)
+                tg.cancel_scope.cancel()
+
+        async with anyio.create_task_group() as tg:
+            for i, (model, messages) in enumerate(requests):
+                tg.start_soon(ask, i, model, messages)
+        if first is not None:
+            METRICS.inc("fanout_wins_total", model=first[0])
+            return first
+        if empty is not None:
+            return empty
+        raise errors[-1]
+
+    async def chat_stream(self, model, messages, max_tokens, on_text, timeout=None):
+        """
+        Stream a completion, awaiting `on_text(delta)` for each piece of
+        text as it arrives.  Returns the whole text.
+        """
+        timeout = timeout or self.timeout
+        text = []
+        async with self.limiter(model):
+            with METRICS.timed(
+                "openai_request_seconds", model=model, call="stream"
+            ), anyio.fail_after(timeout):
+                stream = await self.client.chat.completions.create(
+                    messages=messages,
+                    model=model,
+                    max_tokens=max_tokens,
+                    stream=True,
+                    timeout=timeout,
+                )
+                async for chunk in stream:
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        text.append(delta)
+                        await on_text(delta)
+        return "".join(text)
+
+    async def images(
+        self,
+        prompt,
+        model="dall-e-3",
+        size="1024x1024",
+        quality="standard",
+        n=1,
+        timeout=None,
+    ):
+        timeout = timeout or self.timeout
+        async with self.limiter(model):
+            with METRICS.timed(
+                "openai_request_seconds", model=model, call="images"
+            ), anyio.fail_after(timeout):
+                return await self.client.images.generate(
+                    model=model,
+                    prompt=prompt,
+                    size=size,
+                    quality=quality,
+                    n=n,
+                    timeout=timeout,
+                )
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Logging setup.
+
+BOT_LOG_LEVEL sets the level (DEBUG, INFO, WARNING, ERROR, or OFF to turn
+logging off), BOT_LOG_FORMAT is "text" (the default) or "json", with one
+object per line.  Values passed with `extra={"fields": {...}}` are added to
+the record, e.g.
+
+    log.info("reply sent", extra={"fields": {"chat_id": chat_id, "total": 1.2}})
+"""
+
+import json
+import logging
+
+TEXT_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__(TEXT_FORMAT)
+
+    def format(self, record):
+        line = super().format(record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            line += " " + " ".join(f"{k}={v!r}" for k, v in fields.items())
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        data = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        data.update(getattr(record, "fields", None) or {})
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+def setup_logging(level="INFO", fmt="text"):
+    if level.upper() == "OFF":
+        logging.disable(logging.CRITICAL)
+        return
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter())
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level.upper())
+    # keep the HTTP clients' request logs out of INFO
+    for name in ("httpx", "httpcore", "botocore", "urllib3"):
+        logging.getLogger(name).setLevel(max(root.level, logging.WARNING))
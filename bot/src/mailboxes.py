@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Per-chat mailboxes.
+
+Each chat gets a queue drained by its own task, so the messages of one chat
+are handled one at a time and in order, while different chats are handled
+in parallel.  Messages that queue up while the previous ones are handled
+(or within `coalesce_window` seconds of the first) are handed over together
+as one batch, which lets the handler merge work such as several /thots.
+
+A chat's task exits after `idle_timeout` seconds without messages, and is
+started again by the next message.
+"""
+
+import logging
+
+import anyio
+
+log = logging.getLogger(__name__)
+
+
+class ChatMailboxes:
+    def __init__(
+        self,
+        handle_batch,
+        coalesce_window=0.0,
+        max_batch=20,
+        max_queued=100,
+        idle_timeout=300.0,
+    ):
+        self.handle_batch = handle_batch
+        self.coalesce_window = coalesce_window
+        self.max_batch = max_batch
+        self.max_queued = max_queued
+        self.idle_timeout = idle_timeout
+        self._boxes = {}  # chat id -> send stream of its mailbox
+        self._task_group = None
+
+    def start(self, task_group):
+        self._task_group = task_group
+
+    def queued(self):
+        # number of waiting messages per chat
+        return {
+            chat_id: send.statistics().current_buffer_used
+            for chat_id, send in self._boxes.items()
+        }
+
+    async def put(self, chat_id, item):
+        while True:
+            send = self._boxes.get(chat_id)
+            if send is None:
+                send, receive = anyio.create_memory_object_stream(self.max_queued)
+                self._boxes[chat_id] = send
+                self._task_group.start_soon(self._worker, chat_id, receive)
+            try:
+                try:
+                    send.send_nowait(item)
+                except anyio.WouldBlock:
+                    # the mailbox is full, wait for room
+                    await send.send(item)
+                return
+            except anyio.BrokenResourceError:
+                # the chat's task went idle and closed the mailbox, start
+                # a new one
+                if self._boxes.get(chat_id) is send:
+                    del self._boxes[chat_id]
+
+    async def _next_batch(self, receive, item):
+        if self.coalesce_window:
+            await anyio.sleep(self.coalesce_window)
+        batch = [item]
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(receive.receive_nowait())
+            except anyio.WouldBlock:
+                break
+        return batch
+
+    async def _worker(self, chat_id, receive):
+        async with receive:
+            while True:
+                item = None
+                with anyio.move_on_after(self.idle_timeout):
+                    item = await receive.receive()
+                if item is None:
+                    try:
+                        item = receive.receive_nowait()
+                    except anyio.WouldBlock:
+                        # idle; a message put after this finds the mailbox
+                        # closed, and put starts a new one for it
+                        del self._boxes[chat_id]
+                        return
+                batch = await self._next_batch(receive, item)
+                try:
+                    await self.handle_batch(chat_id, batch)
+                except Exception as e:
+                    log.exception("Handling messages for %s failed: %r", chat_id, e)
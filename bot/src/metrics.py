@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""
+In-process metrics: counters, gauges and latency histograms.
+
+Modules record into the shared `METRICS` registry, e.g.
+
+    with METRICS.timed("openai_request_seconds", model=model):
+        ...
+
+which observes the duration in a histogram and counts the call by outcome in
+`<name minus _seconds>_total{status="ok"|"error"}`.  The registry can be
+rendered as a summary for /stats, or in the Prometheus text format, which
+`serve` makes available over HTTP.
+"""
+
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+import anyio
+
+log = logging.getLogger(__name__)
+
+# histogram bucket upper bounds, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+# and for sizes in tokens
+TOKEN_BUCKETS = (250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000, 128000)
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        # upper bound of the bucket the quantile falls in
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class Metrics:
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.counters = {}  # name -> {labels: value}
+        self.gauges = {}  # name -> {labels: value}
+        self.gauge_fns = {}  # name -> function returning {labels dict: value}
+        self.histograms = {}  # name -> {labels: Histogram}
+        # Suno and AWS calls run in worker threads
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        with self._lock:
+            series = self.counters.setdefault(name, {})
+            key = _labels(labels)
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self.gauges.setdefault(name, {})[_labels(labels)] = value
+
+    def gauge_fn(self, name, fn):
+        # a gauge read when the metrics are, `fn()` returns {labels: value}
+        self.gauge_fns[name] = fn
+
+    def observe(self, name, value, buckets=BUCKETS, **labels):
+        with self._lock:
+            series = self.histograms.setdefault(name, {})
+            key = _labels(labels)
+            if key not in series:
+                series[key] = Histogram(buckets)
+            series[key].observe(value)
+
+    @contextmanager
+    def timed(self, name, **labels):
+        start = self.clock()
+        status = "error"
+        try:
+            yield
+            status = "ok"
+        finally:
+            self.observe(name, self.clock() - start, **labels)
+            self.inc(name.removesuffix("_seconds") + "_total", status=status, **labels)
+
+    def _gauge_values(self):
+        gauges = {name: dict(series) for name, series in self.gauges.items()}
+        for name, fn in self.gauge_fns.items():
+            try:
+                values = fn()
+            except Exception as e:
+                log.warning("gauge %s failed: %r", name, e)
+                continue
+            gauges[name] = {_labels(labels): v for labels, v in values}
+        return gauges
+
+    def summary(self):
+        """Human readable lines, for the /stats command."""
+        lines = []
+        with self._lock:
+            histograms = {
+                name: dict(series) for name, series in self.histograms.items()
+            }
+            counters = {name: dict(series) for name, series in self.counters.items()}
+        for name, series in sorted(histograms.items()):
+            unit = "s" if name.endswith("_seconds") else ""
+            for labels, h in sorted(series.items()):
+                lines.append(
+                    f"{name}{_format_labels(labels)}: n={h.count} "
+                    f"mean={h.sum / h.count:.3f}{unit} "
+                    f"p50<={h.quantile(0.5)}{unit} p99<={h.quantile(0.99)}{unit}"
+                )
+        for name, series in sorted(counters.items()):
+            for labels, value in sorted(series.items()):
+                lines.append(f"{name}{_format_labels(labels)}: {value}")
+        for name, series in sorted(self._gauge_values().items()):
+            for labels, value in sorted(series.items()):
+                lines.append(f"{name}{_format_labels(labels)}: {value}")
+        return lines
+
+    def render(self):
+        """The metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            for name, series in sorted(self.counters.items()):
+                lines.append(f"# TYPE {name} counter")
+                for labels, value in sorted(series.items()):
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+            for name, series in sorted(self.histograms.items()):
+                lines.append(f"# TYPE {name} histogram")
+                for labels, h in sorted(series.items()):
+                    cumulative = 0
+                    for bound, n in zip(h.buckets + ("+Inf",), h.counts):
+                        cumulative += n
+                        le = _format_labels(labels, [("le", bound)])
+                        lines.append(f"{name}_bucket{le} {cumulative}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {h.sum}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {h.count}")
+        for name, series in sorted(self._gauge_values().items()):
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in sorted(series.items()):
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    async def serve(self, port, host="127.0.0.1"):
+        """Serve `render()` to any HTTP request on host:port."""
+
+        async def handle(client):
+            async with client:
+                try:
+                    with anyio.fail_after(5):
+                        request = b""
+                        while b"\r\n\r\n" not in request and len(request) < 8192:
+                            request += await client.receive()
+                    body = self.render().encode()
+                    await client.send(
+                        b"HTTP/1.1 200 OK\r\n"
+                        b"Content-Type: text/plain; version=0.0.4\r\n"
+                        + f"Content-Length: {len(body)}\r\n".encode()
+                        + b"Connection: close\r\n\r\n"
+                        + body
+                    )
+                except (TimeoutError, anyio.EndOfStream, anyio.BrokenResourceError):
+                    pass
+
+        listener = await anyio.create_tcp_listener(local_host=host, local_port=port)
+        log.info("serving metrics on http://%s:%d/metrics", host, port)
+        await listener.serve(handle)
+
+
+METRICS = Metrics()
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+"""
+Index of the Minecraft servers each chat may control.
+
+minecraft.json is formatted as
+{"instance_id": ["ip", "allowed_group1", "allowed_group2", ...]}
+and is loaded by config.py into a `MinecraftServers` snapshot, indexed by
+group, so commands don't read or scan it.
+"""
+
+from types import MappingProxyType
+
+from config import ConfigError, freeze
+
+
+def index_by_group(info):
+    # {group_id: ((instance_id, ip), ...)}, in file order
+    servers = {}
+    for instance_id, values in info.items():
+        ip, groups = values[0], values[1:]
+        for group_id in groups:
+            servers.setdefault(group_id, []).append((instance_id, ip))
+    return {group_id: tuple(entries) for group_id, entries in servers.items()}
+
+
+class MinecraftServers:
+    __slots__ = ("info", "servers")
+
+    def __init__(self, info=None):
+        info = info or {}
+        self.info = freeze(info)
+        self.servers = MappingProxyType(index_by_group(info))
+
+    def for_group(self, group_id):
+        return self.servers.get(group_id, ())
+
+
+def parse_minecraft(data):
+    if not isinstance(data, dict):
+        raise ConfigError("expected an object of instance ids")
+    for instance_id, values in data.items():
+        if (
+            not isinstance(values, list)
+            or not values
+            or not all(isinstance(value, str) for value in values)
+        ):
+            raise ConfigError(f"{instance_id}: expected [ip, group, ...]")
+    return MinecraftServers(data)
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""
+Outgoing messages.
+
+Replies and other messages are queued per chat and sent in the background
+while signald is connected, so a dropped connection holds them until it is
+back instead of losing them.  Each chat gets at least `min_interval` seconds
+between sends.  Messages queued in that time, such as a song's audio links
+and the Suno limits after them, are merged into one message.  Up to `window`
+sends (to different chats) are outstanding at a time, and `put` waits once
+`max_queued` messages are waiting, so a flood of replies slows down the
+commands making them.
+
+Messages are delivered by `deliver(message)`, which raises one of
+CONNECTION_ERRORS if signald is gone, in which case the message is kept and
+sent again after the next `connected()`.
+"""
+
+import time
+import logging
+from collections import deque
+
+import anyio
+
+log = logging.getLogger(__name__)
+
+CONNECTION_ERRORS = (
+    ConnectionError,
+    OSError,
+    anyio.BrokenResourceError,
+    anyio.ClosedResourceError,
+    anyio.EndOfStream,
+)
+
+
+class OutMessage:
+    __slots__ = (
+        "chat_id",
+        "body",
+        "attachments",
+        "quote",
+        "sent",
+        "result",
+    )
+
+    def __init__(self, chat_id, body, attachments=None, quote=None):
+        self.chat_id = chat_id
+        self.body = body
+        self.attachments = attachments or []
+        self.quote = quote  # the message being replied to, if quoted
+        self.sent = anyio.Event()
+        self.result = None
+
+    def joins(self, other, max_chars):
+        # whether `other` can be added to a batch starting with this message
+        return (
+            not self.attachments
+            and not other.attachments
+            and other.quote is None
+            and len(other.body) < max_chars
+        )
+
+
+class Outbox:
+    def __init__(
+        self,
+        deliver,
+        window=4,
+        min_interval=0.5,
+        max_batch_chars=2000,
+        max_queued=1000,
+        clock=time.monotonic,
+    ):
+        self.deliver = deliver
+        self.window = window
+        self.min_interval = min_interval
+        self.max_batch_chars = max_batch_chars
+        self.max_queued = max_queued
+        self.clock = clock
+        self.connection = 0  # number of connections so far
+        self.sends = 0
+        self.merged = 0
+        self._queues = {}  # chat id -> deque of OutMessage
+        self._last_sent = {}  # chat id -> time of its last send
+        self._task_group = None
+        # created in start, they need the event loop
+        self._window = None
+        self._space = None
+        self._connected = None
+        self._reconnected = None
+
+    def start(self, task_group):
+        self._task_group = task_group
+        self._window = anyio.Semaphore(self.window)
+        self._space = anyio.Semaphore(self.max_queued)
+        self._connected = anyio.Event()
+        self._reconnected = anyio.Event()
+
+    def connected(self):
+        self.connection += 1
+        self._connected.set()
+        self._reconnected.set()
+        self._reconnected = anyio.Event()
+
+    def disconnected(self):
+        if self._connected.is_set():
+            self._connected = anyio.Event()
+
+    def queued(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    async def put(self, chat_id, body, attachments=None, quote=None, wait=False):
+        """
+        Queue a message, returning once it is queued, or once it is sent if
+        `wait` (e.g. to delete attachments after), with whether signald
+        accepted it.
+        """
+        await self._space.acquire()
+        message = OutMessage(chat_id, body, attachments, quote)
+        queue = self._queues.get(chat_id)
+        if queue is None:
+            queue = self._queues[chat_id] = deque()
+            self._task_group.start_soon(self._drain, chat_id, queue)
+        queue.append(message)
+        if wait:
+            await message.sent.wait()
+            return message.result
+        return True
+
+    def _take_batch(self, queue):
+        batch = [queue.popleft()]
+        chars = len(batch[0].body)
+        while queue and batch[0].joins(queue[0], self.max_batch_chars - chars):
+            chars += len(queue[0].body) + 1
+            batch.append(queue.popleft())
+        return batch
+
+    def _merge(self, batch):
+        first = batch[0]
+        if len(batch) == 1:
+            return first
+        self.merged += len(batch) - 1
+        merged = OutMessage(
+            first.chat_id,
+            "\n".join(message.body for message in batch),
+            first.attachments,
+            first.quote,
+        )
+        return merged
+
+    async def _drain(self, chat_id, queue):
+        # send a chat's messages in order, until its queue is empty
+        try:
+            while queue:
+                wait = self._last_sent.get(chat_id, -self.min_interval)
+                wait += self.min_interval - self.clock()
+                if wait > 0:
+                    # later messages can join the batch in the meantime
+                    await anyio.sleep(wait)
+                await self._connected.wait()
+                async with self._window:
+                    batch = self._take_batch(queue)
+                    connection = self.connection
+                    try:
+                        result = await self.deliver(self._merge(batch))
+                    except CONNECTION_ERRORS as e:
+                        log.warning("Sending to %s failed, will retry: %r", chat_id, e)
+                        queue.extendleft(reversed(batch))
+                        batch = None
+                    except Exception as e:
+                        log.exception("Sending to %s failed: %r", chat_id, e)
+                        result = False
+                if batch is None:
+                    # wait for the connection to be replaced
+                    if connection == self.connection:
+                        await self._reconnected.wait()
+                    continue
+                self.sends += 1
+                self._last_sent[chat_id] = self.clock()
+                for message in batch:
+                    message.result = result
+                    message.sent.set()
+                    self._space.release()
+        finally:
+            del self._queues[chat_id]
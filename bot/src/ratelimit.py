@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Throttling of the commands that use paid, slow backends.
+
+Each command has a cost in credits.  `RateLimiter` keeps a token bucket of
+credits per group and per user, refilled at an hourly rate, so a request
+either goes ahead, waits until its credits are available, or is turned
+away if that would take too long.
+
+`FairScheduler` then shares a fixed number of slots between the groups by
+start-time fair queueing: a group's requests are tagged with a virtual start
+time that advances by cost / weight for each request it makes, and waiting
+requests run in tag order.  A busy group can't starve a quiet one, and a
+group with weight 2 gets twice the share.  Priority 0 (admins) goes first.
+"""
+
+import time
+import heapq
+import itertools
+from contextlib import asynccontextmanager
+
+import anyio
+
+
+class TokenBucket:
+    def __init__(self, rate_per_hour, burst, clock=time.monotonic):
+        self.rate_per_hour = rate_per_hour
+        self.rate = rate_per_hour / 3600
+        self.burst = burst
+        self.clock = clock
+        self.tokens = burst
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, cost):
+        # take `cost` tokens, returning the seconds until they are there
+        self._refill()
+        self.tokens -= cost
+        return max(0.0, -self.tokens / self.rate) if self.rate else float("inf")
+
+    def refund(self, cost):
+        self.tokens = min(self.burst, self.tokens + cost)
+
+
+class RateLimiter:
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._buckets = {}  # key -> TokenBucket
+
+    def bucket(self, key, rate_per_hour, burst):
+        # the bucket for a key, replaced if its quota was changed
+        bucket = self._buckets.get(key)
+        if bucket is None or (bucket.rate_per_hour, bucket.burst) != (
+            rate_per_hour,
+            burst,
+        ):
+            bucket = TokenBucket(rate_per_hour, burst, self.clock)
+            self._buckets[key] = bucket
+        return bucket
+
+    def reserve(self, buckets, cost, max_wait):
+        """
+        Take `cost` from every bucket, returning `(delay, ok)`: how long until
+        the credits are all there, and whether that is within `max_wait`.
+        If it isn't, nothing is taken.
+        """
+        delay = max(bucket.reserve(cost) for bucket in buckets)
+        if delay > max_wait:
+            for bucket in buckets:
+                bucket.refund(cost)
+            return delay, False
+        return delay, True
+
+
+class FairScheduler:
+    def __init__(self, slots=4, clock=time.monotonic):
+        self.slots = slots
+        self.clock = clock
+        self.running = 0
+        self.service_time = 5.0  # moving average of the time a request takes
+        self._virtual = 0.0  # start tag of the last request to start
+        self._finish = {}  # key -> finish tag of its last request
+        self._waiting = []  # heap of (priority, start tag, seq, event)
+        self._seq = itertools.count()
+
+    def waiting(self):
+        return len(self._waiting)
+
+    def _release(self):
+        # hand the slot to the next request, if any
+        if self._waiting:
+            _, start, _, event = heapq.heappop(self._waiting)
+            self._virtual = max(self._virtual, start)
+            event.set()
+        else:
+            self.running -= 1
+
+    @asynccontextmanager
+    async def slot(self, key, weight=1.0, cost=1.0, priority=1, on_queued=None):
+        """
+        Hold one of the slots, waiting for it in fair order.  If it has to
+        wait, `on_queued(ahead, eta)` is awaited first, with the number of
+        requests ahead of it and an estimate of the wait in seconds.
+        """
+        start = max(self._virtual, self._finish.get(key, 0.0))
+        self._finish[key] = start + cost / weight
+        if self.running < self.slots and not self._waiting:
+            self.running += 1
+            self._virtual = start
+        else:
+            entry = (priority, start, next(self._seq), anyio.Event())
+            heapq.heappush(self._waiting, entry)
+            try:
+                if on_queued is not None:
+                    ahead = sum(1 for other in self._waiting if other < entry)
+                    eta = (ahead // self.slots + 1) * self.service_time
+                    await on_queued(ahead, eta)
+                await entry[3].wait()
+            except BaseException:
+                if entry[3].is_set():
+                    self._release()
+                else:
+                    self._waiting.remove(entry)
+                    heapq.heapify(self._waiting)
+                raise
+        started = self.clock()
+        try:
+            yield
+        finally:
+            elapsed = self.clock() - started
+            self.service_time = 0.8 * self.service_time + 0.2 * elapsed
+            self._release()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Single-pass command matching.
+
+The command tables are merged into one lookup table at startup, and a message
+is scanned once for words starting with "/", which are looked up in it.  A
+command only matches as a whole word, case-insensitively, e.g. "/suno" does
+not match inside "/suno-limits".
+"""
+
+import re
+from collections import namedtuple
+
+# kind: the tier of the matched commands, or None for a plain message
+# commands: the commands to run, in table order
+# body: the message with the matched commands removed
+Route = namedtuple("Route", ["kind", "commands", "body"])
+
+
+class CommandRouter:
+    def __init__(self, tiers):
+        """
+        `tiers` is a list of `(kind, commands)` pairs in order of precedence,
+        where `commands` is a dict keyed by command.  The "regular" tier runs
+        every command it matches, any other tier only the first in its dict.
+        """
+        self.tiers = tiers
+        self._lookup = {}  # command -> (tier index, position in its dict)
+        for tier, (kind, commands) in enumerate(tiers):
+            for position, command in enumerate(commands):
+                self._lookup.setdefault(command.lower(), (tier, position))
+        # candidate words, which are then looked up in the table
+        self._pattern = re.compile(r"/\S+")
+
+    def _scan(self, msg, skip=()):
+        # (tier, position, command) of every command in msg, and msg without
+        # them; commands in tiers whose kind is in skip are left in the message
+        hits = []
+        pieces = []
+        last = 0
+        for match in self._pattern.finditer(msg):
+            start = match.start()
+            if start and not msg[start - 1].isspace():
+                continue
+            command = match.group().lower()
+            found = self._lookup.get(command)
+            if found is None or self.tiers[found[0]][0] in skip:
+                continue
+            hits.append((*found, command))
+            pieces.append(msg[last:start])
+            last = match.end()
+        if not hits:
+            return hits, msg.strip()
+        pieces.append(msg[last:])
+        return hits, "".join(pieces).strip()
+
+    def strip(self, msg):
+        # the message with all commands removed
+        return self._scan(msg)[1]
+
+    def route(self, msg, skip=()):
+        """
+        Find the commands to run for a message.  Tiers whose kind is in
+        `skip` are ignored (e.g. the admin tier for other users), and their
+        commands kept in the body, as in a plain message.
+        """
+        hits, body = self._scan(msg, skip)
+        if not hits:
+            return Route(None, [], body)
+
+        hits.sort()
+        tier = hits[0][0]
+        kind = self.tiers[tier][0]
+        commands = []
+        for t, _, command in hits:
+            if t == tier and command not in commands:
+                commands.append(command)
+        if kind != "regular":
+            commands = commands[:1]
+        return Route(kind, commands, body)
@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+"""
+Sharded mode: chats spread over worker processes.
+
+With BOT_WORKERS=N, `bot.py` runs a `FrontBot`, which owns the signald
+connection and starts N workers (`shards.py <index>`), each a `WorkerBot`
+with its own mailboxes, caches, Suno jobs and backend clients.  The front
+hashes each message's chat id to pick its worker, so a chat's messages all
+go, in order, to one worker, and the prompt building, history and JSON work
+for different chats runs on different cores.
+
+Workers send their replies and typing notifications back through the
+front, which sends them to signald, and the front tells them when signald
+is (dis)connected, so their outboxes hold messages while it is down.  The
+history and summaries are per chat, so the workers share the state
+directory; usernames.json is shared too, merged on write (see usernames.py).
+The front keeps none of the chats' state; the Suno jobs of a single process
+bot are handed to the workers of their chats when it starts.
+
+Front and workers talk over a unix socket in the state directory, in
+length-prefixed pickles: the front sends ("message", message),
+("connected",), ("disconnected",) and ("result", call id, ok, value), and a
+worker sends ("hello", index) then ("call", call id, op, args).  Messages
+cross without their semaphore sender, and are bound to the current signald
+connection by the front when replied to.
+"""
+
+import os
+import sys
+import json
+import math
+import zlib
+import pickle
+import struct
+import random
+import itertools
+import logging
+
+import attr
+import anyio
+from anyio.streams.buffered import BufferedByteReceiveStream
+from semaphore import ChatContext
+
+from bot import MyBot
+from outbox import CONNECTION_ERRORS
+from metrics import METRICS
+from logs import setup_logging
+
+log = logging.getLogger(__name__)
+
+HEADER = struct.Struct("!I")
+
+
+def worker_for(chat_id, workers):
+    # crc32, as hash() of a str differs between processes
+    return zlib.crc32(chat_id.encode()) % workers
+
+
+def strip_sender(message):
+    # the message without the connection it came in on, to pickle it
+    return attr.evolve(message, sender=None)
+
+
+class Link:
+    """One end of the socket between the front and a worker."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.buffered = BufferedByteReceiveStream(stream)
+        self.lock = anyio.Lock()
+
+    async def send(self, item):
+        data = pickle.dumps(item, pickle.HIGHEST_PROTOCOL)
+        async with self.lock:
+            await self.stream.send(HEADER.pack(len(data)) + data)
+
+    async def receive(self):
+        (size,) = HEADER.unpack(await self.buffered.receive_exactly(HEADER.size))
+        return pickle.loads(await self.buffered.receive_exactly(size))
+
+
+# what ends a link: the other side went away
+LINK_CLOSED = CONNECTION_ERRORS + (anyio.IncompleteRead,)
+
+
+def split_suno_jobs(state_dir, workers):
+    """
+    Hand the Suno jobs of a single process bot (suno_jobs.json) to the
+    workers that now have their chats, so unfinished ones are resumed.
+    """
+    path = os.path.join(state_dir, "suno_jobs.json")
+    try:
+        with open(path) as f:
+            jobs = json.load(f)
+    except FileNotFoundError:
+        return
+    except ValueError:
+        log.warning("Could not read %s, its Suno jobs are dropped", path)
+        os.remove(path)
+        return
+    shares = [[] for _ in range(workers)]
+    for job in jobs:
+        shares[worker_for(job["chat_id"], workers)].append(job)
+    for index, share in enumerate(shares):
+        if not share:
+            continue
+        worker_path = os.path.join(state_dir, f"suno_jobs.{index}.json")
+        try:
+            with open(worker_path) as f:
+                share = json.load(f) + share
+        except FileNotFoundError:
+            pass
+        with open(worker_path + ".tmp", "w") as f:
+            json.dump(share, f)
+        os.replace(worker_path + ".tmp", worker_path)
+    os.remove(path)
+    log.info("Handed %d Suno jobs to the workers", len(jobs))
+
+
+class FrontBot(MyBot):
+    def __init__(
+        self, workers, bot_number, bot_default_name, socket_path, state_dir, **kwargs
+    ):
+        # only the signald connection and outbox of MyBot, the rest of its
+        # settings (in kwargs) are for the workers
+        self.bot_number = bot_number
+        self.bot_default_name = bot_default_name
+        self.socket_path = socket_path
+        self.state_dir = state_dir
+        os.makedirs(state_dir, exist_ok=True)
+        self.setup_signald()
+        self.workers = workers
+        split_suno_jobs(state_dir, workers)
+        self.front_path = os.path.join(self.state_dir, "front.sock")
+        self._links = [None] * workers  # the Link to each connected worker
+        self._linked = [None] * workers  # set once each worker is connected
+        self._queues = []  # (send, receive) memory streams, per worker
+        METRICS.gauge_fn(
+            "workers_connected",
+            lambda: [({}, sum(link is not None for link in self._links))],
+        )
+
+    async def message_handler(self, ctx):
+        # hand the message to its chat's worker, in the order they arrive
+        index = worker_for(self.get_chat_id(ctx), self.workers)
+        await self._queues[index][0].send(("message", strip_sender(ctx.message)))
+
+    def on_connected(self):
+        super().on_connected()
+        self._broadcast(("connected",))
+
+    def on_disconnected(self):
+        super().on_disconnected()
+        self._broadcast(("disconnected",))
+
+    def _broadcast(self, item):
+        for link in self._links:
+            if link is not None:
+                self._task_group.start_soon(self._send, link, item)
+
+    async def _send(self, link, item):
+        try:
+            await link.send(item)
+        except LINK_CLOSED:
+            pass  # the worker is told again when it reconnects
+
+    async def _forward(self, index):
+        # send a worker its messages, holding them while it is (re)starting
+        async with self._queues[index][1] as receive:
+            async for item in receive:
+                while True:
+                    await self._linked[index].wait()
+                    try:
+                        await self._links[index].send(item)
+                        break
+                    except LINK_CLOSED:
+                        await anyio.sleep(0.1)
+
+    async def _call(self, op, args):
+        # a worker's request, made through the current signald connection
+        if self.signal is None:
+            raise ConnectionError("not connected to signald")
+        if op == "send":
+            return await self.signal.send_message(*args)
+        # bound to the current connection (semaphore keeps it private)
+        message = attr.evolve(args[0], sender=self.signal._sender)
+        if op == "reply":
+            return await self.signal._sender.reply_message(message, args[1])
+        if op == "typing_started":
+            return await message.typing_started()
+        if op == "typing_stopped":
+            return await message.typing_stopped()
+        raise ValueError(f"unknown op {op!r}")
+
+    async def _answer(self, link, call_id, op, args):
+        try:
+            result = (True, await self._call(op, args))
+        except CONNECTION_ERRORS as e:
+            result = (False, ("connection", repr(e)))
+        except Exception as e:
+            log.exception("%s for a worker failed", op)
+            result = (False, ("error", repr(e)))
+        await self._send(link, ("result", call_id) + result)
+
+    async def serve_worker(self, stream):
+        link = Link(stream)
+        async with stream:
+            try:
+                _, index = await link.receive()
+            except LINK_CLOSED:
+                return
+            log.info("Worker %d connected", index)
+            self._links[index] = link
+            self._linked[index].set()
+            if self.signal is not None:
+                await self._send(link, ("connected",))
+            try:
+                async with anyio.create_task_group() as tg:
+                    while True:
+                        _, call_id, op, args = await link.receive()
+                        tg.start_soon(self._answer, link, call_id, op, args)
+            except LINK_CLOSED:
+                log.warning("Worker %d disconnected", index)
+            finally:
+                if self._links[index] is link:
+                    self._links[index] = None
+                    self._linked[index] = anyio.Event()
+
+    async def run_worker(self, index):
+        # keep the worker process running, restarting it if it exits
+        command = [sys.executable, os.path.abspath(__file__), str(index)]
+        delay = self.RECONNECT_MIN
+        while True:
+            process = await anyio.open_process(
+                command, stdin=None, stdout=None, stderr=None
+            )
+            try:
+                code = await process.wait()
+            except anyio.get_cancelled_exc_class():
+                # let it finish its work and save its state
+                process.terminate()
+                with anyio.CancelScope(shield=True):
+                    with anyio.move_on_after(10):
+                        await process.wait()
+                    if process.returncode is None:
+                        process.kill()
+                raise
+            METRICS.inc("worker_restarts_total")
+            log.warning("Worker %d exited with %s, restarting", index, code)
+            await anyio.sleep(delay * random.uniform(0.8, 1.2))
+            delay = min(delay * 2, self.RECONNECT_MAX)
+
+    async def start_services(self, tg):
+        # the workers do the chats' work, the front only forwards it
+        self._task_group = tg
+        self.outbox.start(tg)
+        for index in range(self.workers):
+            self._linked[index] = anyio.Event()
+            self._queues.append(anyio.create_memory_object_stream(1000))
+            tg.start_soon(self._forward, index)
+        if os.path.exists(self.front_path):
+            os.remove(self.front_path)
+        listener = await anyio.create_unix_listener(self.front_path)
+        tg.start_soon(listener.serve, self.serve_worker)
+        for index in range(self.workers):
+            tg.start_soon(self.run_worker, index)
+
+    async def run(self):
+        try:
+            async with anyio.create_task_group() as tg:
+                tg.start_soon(self.stop_on_signal, tg.cancel_scope)
+                if self.metrics_port:
+                    tg.start_soon(METRICS.serve, self.metrics_port)
+                await self.start_services(tg)
+                await self.supervise()
+        finally:
+            if os.path.exists(self.front_path):
+                os.remove(self.front_path)
+
+
+class FrontSender:
+    """
+    Stands in for semaphore's sender on the messages a worker receives, and
+    for its `Bot` as `signal`, making their calls through the front.
+    """
+
+    def __init__(self, worker):
+        self.worker = worker
+
+    async def send_message(self, receiver, body, attachments=None):
+        return await self.worker.call("send", (receiver, body, attachments))
+
+    async def reply_message(self, message, reply):
+        return await self.worker.call("reply", (strip_sender(message), reply))
+
+    async def typing_started(self, message):
+        await self.worker.call("typing_started", (strip_sender(message),))
+
+    async def typing_stopped(self, message):
+        await self.worker.call("typing_stopped", (strip_sender(message),))
+
+    async def mark_read(self, message):
+        pass  # done by the front when replying
+
+
+class WorkerBot(MyBot):
+    def __init__(self, index, **kwargs):
+        super().__init__(
+            suno_jobs_file=f"suno_jobs.{index}.json",
+            seen_file=f"seen.{index}.bin",
+            **kwargs,
+        )
+        self.index = index
+        self.front_path = os.path.join(self.state_dir, "front.sock")
+        if self.metrics_port:
+            self.metrics_port += 1 + index
+        self.sender = FrontSender(self)
+        # the workers share the tmpfs
+        self.attachments.quota //= int(os.environ.get("BOT_WORKERS", 1))
+        self._link = None
+        self._calls = {}  # call id -> [event, result]
+        self._ids = itertools.count()
+        # messages are handled in a task of their own, as handling one can
+        # wait for a result, which comes in on the same link
+        self._messages = anyio.create_memory_object_stream(math.inf)
+
+    async def call(self, op, args):
+        link = self._link
+        if link is None:
+            raise ConnectionError("not connected to the front")
+        call_id = next(self._ids)
+        self._calls[call_id] = call = [anyio.Event(), None]
+        try:
+            await link.send(("call", call_id, op, args))
+            await call[0].wait()
+        finally:
+            del self._calls[call_id]
+        ok, value = call[1]
+        if ok:
+            return value
+        kind, error = value
+        if kind == "connection":
+            raise ConnectionError(error)
+        raise RuntimeError(error)
+
+    async def handle(self, item):
+        kind = item[0]
+        if kind == "message":
+            self._messages[0].send_nowait(attr.evolve(item[1], sender=self.sender))
+        elif kind == "result":
+            call = self._calls.get(item[1])
+            if call is not None:
+                call[1] = item[2:]
+                call[0].set()
+        elif kind == "connected":
+            self.signal = self.sender
+            self.on_connected()
+        elif kind == "disconnected":
+            self.signal = None
+            self.on_disconnected()
+
+    async def handle_messages(self):
+        async with self._messages[1] as receive:
+            async for message in receive:
+                await self.message_handler(ChatContext(message, None, None, None))
+
+    async def start_services(self, tg):
+        await super().start_services(tg)
+        tg.start_soon(self.handle_messages)
+
+    async def supervise(self):
+        # handle what the front sends, returning when it goes away
+        async with await anyio.connect_unix(self.front_path) as stream:
+            self._link = Link(stream)
+            await self._link.send(("hello", self.index))
+            try:
+                while True:
+                    await self.handle(await self._link.receive())
+            except LINK_CLOSED:
+                log.info("The front went away, stopping")
+            finally:
+                self._link = None
+                self.signal = None
+                self.on_disconnected()
+                for call in self._calls.values():
+                    call[1] = (False, ("connection", "the front went away"))
+                    call[0].set()
+
+
+if __name__ == "__main__":
+    index = int(sys.argv[1])
+    setup_logging(
+        os.environ.get("BOT_LOG_LEVEL", "INFO"),
+        os.environ.get("BOT_LOG_FORMAT", "text"),
+    )
+    anyio.run(WorkerBot.from_env(index=index).run)
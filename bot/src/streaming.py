@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Splitting a streamed reply into messages.
+
+The first sentence is sent as soon as it is complete, so the chat sees the
+start of the reply quickly.  The rest is sent in chunks of at least
+`chunk_chars` characters, cut at the end of a sentence where possible.
+"""
+
+import re
+
+# the end of a sentence (with any closing quotes or brackets), or a blank line
+SENTENCE_END = re.compile(r"[.!?…]['\")\]]*\s+|\n\s*\n")
+
+
+class SentenceChunker:
+    def __init__(self, chunk_chars=300):
+        self.chunk_chars = chunk_chars
+        self.buffer = ""
+        self.sent_first = False
+
+    def _cut(self):
+        # where to end the next message, or None to wait for more text
+        if not self.sent_first:
+            match = SENTENCE_END.search(self.buffer)
+            return match.end() if match else None
+        if len(self.buffer) < self.chunk_chars:
+            return None
+        ends = [match.end() for match in SENTENCE_END.finditer(self.buffer)]
+        if ends:
+            return ends[-1]
+        if len(self.buffer) >= 2 * self.chunk_chars:
+            # no sentence end in sight, cut at a space instead
+            space = self.buffer.rfind(" ")
+            return space if space > 0 else len(self.buffer)
+        return None
+
+    def feed(self, text):
+        # the messages that can be sent now that `text` has arrived
+        self.buffer += text
+        messages = []
+        while True:
+            cut = self._cut()
+            if cut is None:
+                break
+            message, self.buffer = self.buffer[:cut].strip(), self.buffer[cut:]
+            self.sent_first = True
+            if message:
+                messages.append(message)
+        return messages
+
+    def flush(self):
+        # whatever is left once the stream has ended
+        message, self.buffer = self.buffer.strip(), ""
+        return [message] if message else []
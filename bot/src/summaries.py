@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Rolling summaries of long conversations.
+
+Once a chat has more than `fold_after` turns that aren't in its summary, the
+oldest of them (all but the newest `keep`) are folded into the summary by
+the LLM, in the background.  /thots then sends the summary and only the
+turns after it, so prompts stay the same size however long the chat runs,
+without forgetting what was said earlier.
+
+A summary is saved per chat, as `{group_id}.summary.json` in the state
+directory, with the last few turns it covers, which mark where the
+remaining turns start in the history.
+
+`complete(messages, max_tokens)` returns the LLM's reply as a string, and
+can be a stub for testing.
+"""
+
+import os
+import json
+import time
+import logging
+
+import anyio
+
+from history import group_key
+from metrics import METRICS
+
+log = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = (
+    "You keep a running summary of a group chat.  Update the summary below "
+    "with the new messages, keeping names, facts, decisions, running jokes "
+    "and anything people asked to be remembered.  Reply with the summary "
+    "only, in at most {words} words."
+)
+
+# number of folded turns kept to find where the summary ends in the history
+ANCHOR_TURNS = 3
+
+
+class Summarizer:
+    def __init__(
+        self,
+        state_dir,
+        complete,
+        format_turn,
+        fold_after=30,
+        keep=10,
+        max_tokens=300,
+    ):
+        self.state_dir = state_dir
+        self.complete = complete
+        self.format_turn = format_turn  # (sender, msg) -> "Name: msg"
+        self.fold_after = fold_after
+        self.keep = keep
+        self.max_tokens = max_tokens
+        self._summaries = {}  # group key -> {"summary", "anchor", "turns", ...}
+        self._folding = set()  # group keys with a fold running
+        self._task_group = None
+        os.makedirs(state_dir, exist_ok=True)
+
+    def start(self, task_group):
+        self._task_group = task_group
+
+    def _path(self, key):
+        return os.path.join(self.state_dir, f"{key}.summary.json")
+
+    def _get(self, key):
+        record = self._summaries.get(key)
+        if record is None:
+            try:
+                with open(self._path(key)) as f:
+                    record = json.load(f)
+            except FileNotFoundError:
+                record = {"summary": "", "anchor": [], "turns": 0}
+            except ValueError:
+                log.warning("Could not read the summary of %s, starting again", key)
+                record = {"summary": "", "anchor": [], "turns": 0}
+            self._summaries[key] = record
+        return record
+
+    def _save(self, key, record):
+        tmp_path = self._path(key) + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(record, f)
+        os.replace(tmp_path, self._path(key))
+        self._summaries[key] = record
+
+    def split(self, group_id, history):
+        """
+        The summary of a chat, and the turns of `history` after it.
+        """
+        record = self._get(group_key(group_id))
+        anchor = [tuple(turn) for turn in record["anchor"]]
+        n = len(anchor)
+        if n:
+            # the newest place the anchor turns appear, in order
+            for end in range(len(history), n - 1, -1):
+                if [tuple(turn) for turn in history[end - n : end]] == anchor:
+                    return record["summary"], history[end:]
+        return record["summary"], history
+
+    def maybe_fold(self, group_id, history):
+        # start folding the older turns into the summary if there are enough
+        key = group_key(group_id)
+        if key in self._folding or self._task_group is None:
+            return
+        _, turns = self.split(group_id, history)
+        if len(turns) <= self.fold_after:
+            return
+        self._folding.add(key)
+        self._task_group.start_soon(self._fold, key, turns[: -self.keep])
+
+    async def _fold(self, key, turns):
+        record = self._get(key)
+        summary = record["summary"]
+        try:
+            transcript = "\n".join(self.format_turn(*turn) for turn in turns)
+            messages = [
+                {
+                    "role": "system",
+                    "content": SUMMARY_PROMPT.format(words=self.max_tokens * 3 // 4),
+                },
+                {
+                    "role": "user",
+                    "content": f"Summary so far:\n{summary or '(none)'}\n\n"
+                    f"New messages:\n{transcript}",
+                },
+            ]
+            with METRICS.timed("summary_fold_seconds"):
+                new_summary = await self.complete(messages, self.max_tokens)
+            if not new_summary.strip():
+                raise ValueError("empty summary")
+            if self._summaries.get(key) is not record:
+                # cleared meanwhile, this fold is out of date
+                return
+            self._save(
+                key,
+                {
+                    "summary": new_summary.strip(),
+                    "anchor": [list(turn) for turn in turns[-ANCHOR_TURNS:]],
+                    "turns": record["turns"] + len(turns),
+                    "updated": time.time(),
+                },
+            )
+            log.info("Folded %d turns into the summary of %s", len(turns), key)
+        except anyio.get_cancelled_exc_class():
+            raise
+        except Exception as e:
+            log.warning("Summarising %s failed: %r", key, e)
+        finally:
+            self._folding.discard(key)
+
+    def clear(self, group_id):
+        key = group_key(group_id)
+        self._summaries[key] = {"summary": "", "anchor": [], "turns": 0}
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+Background queue for Suno song generation.
+
+`submit` records a job and returns its id straight away.  The job is then
+run in the background: the generation is started, and the clips are polled
+with an increasing interval until they are streaming (or complete, with
+`wait_complete`, so they can be downloaded), at which point `notify(job)`
+is called to post the result to the chat that asked for it.  If that
+raises, it is tried again, up to `notify_retries` times.
+
+Jobs are plain dicts, saved to a JSON file on every change so that
+unfinished jobs, and finished ones that haven't been posted, are picked up
+again after a restart.
+"""
+
+import os
+import json
+import time
+import logging
+import secrets
+
+import anyio
+
+from utils import SunoAPI
+from metrics import METRICS
+
+log = logging.getLogger(__name__)
+
+# job states
+QUEUED = "queued"
+GENERATING = "generating"
+DONE = "done"
+FAILED = "failed"
+
+
+class SunoJobQueue:
+    def __init__(
+        self,
+        jobs_file,
+        notify,
+        max_jobs=2,
+        poll_interval=5.0,
+        max_poll_interval=30.0,
+        timeout=600.0,
+        keep_finished=50,
+        wait_complete=False,
+        notify_retries=5,
+        notify_delay=10.0,
+    ):
+        self.jobs_file = jobs_file
+        self.notify = notify
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.timeout = timeout
+        self.keep_finished = keep_finished
+        self.max_jobs = max_jobs
+        self.wait_complete = wait_complete
+        self.notify_retries = notify_retries
+        self.notify_delay = notify_delay
+        self._limiter = None  # created in start, it needs the event loop
+        self._task_group = None
+        self.jobs = self._load()
+
+    def _load(self):
+        try:
+            with open(self.jobs_file) as f:
+                jobs = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            log.warning("Could not read %s, starting with no Suno jobs", self.jobs_file)
+            return {}
+        return {job["id"]: job for job in jobs}
+
+    def _save(self):
+        finished = [
+            job
+            for job in self.jobs.values()
+            if job["status"] in (DONE, FAILED) and job.get("notified", True)
+        ]
+        for job in finished[: -self.keep_finished or None]:
+            del self.jobs[job["id"]]
+        tmp_file = self.jobs_file + ".tmp"
+        with METRICS.timed("state_seconds", op="suno_jobs_save"):
+            with open(tmp_file, "w") as f:
+                json.dump(list(self.jobs.values()), f)
+            os.replace(tmp_file, self.jobs_file)
+
+    def _update(self, job, **changes):
+        job.update(changes, updated=time.time())
+        self._save()
+
+    async def start(self, task_group):
+        # run the jobs in the given task group, resuming any left unfinished
+        self._task_group = task_group
+        self._limiter = anyio.CapacityLimiter(self.max_jobs)
+        for job in self.jobs.values():
+            if job["status"] in (QUEUED, GENERATING):
+                log.info("Resuming Suno job %s", job["id"])
+                task_group.start_soon(self._run, job)
+            elif not job.get("notified", True):
+                log.info("Posting Suno job %s", job["id"])
+                task_group.start_soon(self._notify, job)
+
+    def submit(self, chat_id, payload, custom=False):
+        job_id = secrets.token_hex(3)
+        job = {
+            "id": job_id,
+            "chat_id": chat_id,
+            "payload": payload,
+            "custom": custom,
+            "status": QUEUED,
+            "clip_ids": [],
+            "urls": [],
+            "error": None,
+            "notified": False,
+            "created": time.time(),
+            "updated": time.time(),
+        }
+        self.jobs[job_id] = job
+        self._save()
+        self._task_group.start_soon(self._run, job)
+        return job_id
+
+    def status(self, chat_id, job_id=None):
+        # jobs of a chat, newest first, or just the one with the given id
+        jobs = [job for job in self.jobs.values() if job["chat_id"] == chat_id]
+        if job_id is not None:
+            jobs = [job for job in jobs if job["id"] == job_id]
+        return sorted(jobs, key=lambda job: job["created"], reverse=True)
+
+    def counts(self):
+        # number of jobs in each state
+        counts = {}
+        for job in self.jobs.values():
+            counts[job["status"]] = counts.get(job["status"], 0) + 1
+        return counts
+
+    async def _run(self, job):
+        try:
+            async with self._limiter:
+                await self._generate(job)
+        except Exception as e:
+            log.warning("Suno job %s failed: %s", job["id"], e)
+            job.update(status=FAILED, error=str(e))
+            self._try_save(job)
+        METRICS.observe("suno_job_seconds", time.time() - job["created"])
+        METRICS.inc("suno_jobs_total", status=job["status"])
+        await self._notify(job)
+
+    def _try_save(self, job):
+        # errors saving are logged, the job carries on in memory
+        try:
+            self._update(job)
+        except OSError as e:
+            log.warning("Could not save Suno job %s: %r", job["id"], e)
+
+    async def _notify(self, job):
+        # post the result, trying again if that fails; the job is only
+        # marked as posted once it has been
+        for attempt in range(self.notify_retries + 1):
+            try:
+                await self.notify(job)
+            except Exception as e:
+                log.warning("Could not post Suno job %s: %r", job["id"], e)
+                METRICS.inc("suno_notify_errors_total")
+                if attempt < self.notify_retries:
+                    await anyio.sleep(self.notify_delay * (attempt + 1))
+                continue
+            job["notified"] = True
+            self._try_save(job)
+            return
+
+    async def _generate(self, job):
+        if not job["clip_ids"]:
+            clip_ids = await anyio.to_thread.run_sync(
+                SunoAPI.submit_generation, job["payload"], job.get("custom", False)
+            )
+            self._update(job, status=GENERATING, clip_ids=clip_ids, started=time.time())
+
+        ids = ",".join(job["clip_ids"])
+        interval = self.poll_interval
+        # the time spent queued for a slot doesn't count
+        deadline = job.get("started", job["created"]) + self.timeout
+        while True:
+            data = await anyio.to_thread.run_sync(SunoAPI.get_audio_information, ids)
+            if any(clip["status"] == "error" for clip in data):
+                raise Exception("Suno reported an error generating the song")
+            if SunoAPI.clips_ready(data, self.wait_complete):
+                self._update(
+                    job, status=DONE, urls=[clip["audio_url"] for clip in data]
+                )
+                return
+            if time.time() + interval > deadline:
+                raise Exception("timed out waiting for the song")
+            await anyio.sleep(interval)
+            interval = min(interval * 1.5, self.max_poll_interval)
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+The names the bot uses for chat members.
+
+Members are known by phone number, or by uuid when signald can't give us
+their number.  A uuid seen together with a number is stored as an alias of
+that number, so each member has one name whichever id a message carries.
+
+Changes only mark the registry dirty; `run` writes it to disk in the
+background every `flush_interval` seconds, and `flush` writes it at shutdown.
+The file is also watched by config.py, so names edited by hand are picked
+up; changes made since the last write are applied again on top of them.
+The same happens when writing, if the file was changed since it was read.
+"""
+
+import os
+import json
+import errno
+import fcntl
+import logging
+
+import anyio
+
+from metrics import METRICS
+from config import file_signature, read_json
+
+log = logging.getLogger(__name__)
+
+
+class UsernameRegistry:
+    def __init__(self, path, default="User", flush_interval=10.0):
+        self.path = path
+        self.default = default
+        self.flush_interval = flush_interval
+        self.names = {}  # number or uuid -> name
+        self.aliases = {}  # uuid -> number
+        self.dirty = False
+        self.signature = None  # of the file as last read or written
+        self._pending = []  # changes not yet written, as (method, args)
+        self.load()
+
+    def load(self):
+        if not self.swap(self.read()):
+            raise ValueError(f"Could not load {self.path}")
+
+    def changed(self):
+        return file_signature(self.path) != self.signature
+
+    def read(self):
+        signature = file_signature(self.path)
+        if signature is None:
+            return signature, ({}, {})
+        try:
+            data = read_json(self.path)
+        except (OSError, ValueError) as e:
+            return signature, e
+        if "names" in data and isinstance(data["names"], dict):
+            return signature, (data["names"], data.get("aliases", {}))
+        # the original format, a flat mapping of number or uuid to name
+        names = {key: name for key, name in data.items() if name != "User"}
+        return signature, (names, {})
+
+    def swap(self, loaded):
+        signature, value = loaded
+        self.signature = signature
+        if isinstance(value, Exception):
+            log.warning("Could not load %s: %s", self.path, value)
+            return False
+        if signature is None:
+            log.warning("No usernames file found")
+        self.names, self.aliases = value
+        for method, args in self._pending:
+            method(*args)
+        return True
+
+    def canonical(self, member_id):
+        return self.aliases.get(member_id, member_id)
+
+    def link(self, number, uuid):
+        # record that uuid and number are the same member
+        if number is None or uuid is None or self.aliases.get(uuid) == number:
+            return
+        self._pending.append((self._link, (number, uuid)))
+        self._link(number, uuid)
+
+    def _link(self, number, uuid):
+        self.aliases[uuid] = number
+        if number not in self.names and uuid in self.names:
+            self.names[number] = self.names[uuid]
+        self.names.pop(uuid, None)
+        self.dirty = True
+
+    def get(self, member_id, default=None):
+        return self.names.get(self.canonical(member_id), default)
+
+    def __getitem__(self, member_id):
+        return self.get(member_id, self.default)
+
+    def set(self, member_id, name):
+        self._pending.append((self._set, (member_id, name)))
+        self._set(member_id, name)
+
+    def _set(self, member_id, name):
+        self.names[self.canonical(member_id)] = name
+        self.dirty = True
+
+    def _snapshot(self):
+        return json.dumps({"names": self.names, "aliases": self.aliases}, indent=2)
+
+    def _written(self, count):
+        # the first count changes are on disk; later ones are still pending
+        del self._pending[:count]
+        self.dirty = bool(self._pending)
+
+    def _write(self, data):
+        with METRICS.timed("state_seconds", op="usernames_save"):
+            self._write_file(data)
+
+    def _write_file(self, data):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            # a file bind-mounted into the container can't be replaced
+            if e.errno != errno.EBUSY:
+                raise
+            os.remove(tmp_path)
+            with open(self.path, "w") as f:
+                f.write(data)
+        # so the watcher doesn't read back our own write
+        self.signature = file_signature(self.path)
+
+    def _lock(self):
+        # held while merging and writing, as several processes can share the
+        # file (see shards.py), and each writes the names of all of them
+        lock = open(f"{self.path}.lock", "w")
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    def flush(self):
+        if not self.dirty:
+            return
+        try:
+            with self._lock():
+                if self.changed():
+                    self.swap(self.read())
+                count = len(self._pending)
+                self._write(self._snapshot())
+        except OSError as e:
+            log.warning("Could not save %s: %r", self.path, e)
+            METRICS.inc("usernames_save_errors_total")
+            return
+        self._written(count)
+
+    async def save(self):
+        lock = await anyio.to_thread.run_sync(self._lock)
+        with lock:
+            if self.changed():
+                self.swap(await anyio.to_thread.run_sync(self.read))
+            count = len(self._pending)
+            await anyio.to_thread.run_sync(self._write, self._snapshot())
+        self._written(count)
+
+    async def run(self):
+        # write changes in the background until cancelled; if writing fails,
+        # the changes are kept and written next time
+        while True:
+            await anyio.sleep(self.flush_interval)
+            if self.dirty:
+                try:
+                    await self.save()
+                except OSError as e:
+                    log.warning("Could not save %s: %r", self.path, e)
+                    METRICS.inc("usernames_save_errors_total")
@@ -1,17 +1,24 @@
 #!/usr/bin/env python3
 
-import requests
+# requests, boto3 and botocore are slow to import, so they are imported in
+# the functions that use them, when a command first needs them
+
 import os
 import asyncio
 from concurrent.futures import ThreadPoolExecutor
 import sys
-import boto3
+import logging
+import threading
 from datetime import datetime, timedelta
-from botocore.exceptions import ClientError
-from botocore.config import Config
+
+from metrics import METRICS
+
+log = logging.getLogger(__name__)
 
 
 def save_image(url, filename):
+    import requests
+
     response = requests.get(url)
     if response.status_code == 200:
         with open(filename, "wb") as f:
@@ -32,44 +39,48 @@ def save_image(url, filename):
 
 
 class SunoAPI:
-    base_url = "http://suno-api:3000"
+    base_url = os.environ.get("SUNO_API_URL", "http://suno-api:3000")
 
     @classmethod
-    def generate_audio_by_prompt(cls, payload):
-        url = f"{cls.base_url}/api/generate"
-        response = requests.post(
-            url, json=payload, headers={"Content-Type": "application/json"}
-        )
-        data = response.json()
-        print("suno data:", data)
+    def submit_generation(cls, payload, custom=False):
+        # start generating, returns the ids of the clips being generated;
+        # custom songs have their lyrics as the prompt, and style tags
+        import requests
+
+        url = f"{cls.base_url}/api/{'custom_generate' if custom else 'generate'}"
+        with METRICS.timed("suno_request_seconds", call="generate"):
+            response = requests.post(
+                url, json=payload, headers={"Content-Type": "application/json"}
+            )
+            data = response.json()
+        log.debug("suno data: %s", data)
         if "error" in data:
             raise Exception(data["error"])
-        ids = f"{data[0]['id']},{data[1]['id']}"
-
-        print(f"ids: {ids}")
-        for _ in range(60):
-            data = SunoAPI.get_audio_information(ids)
-            if data[0]["status"] == "streaming":
-                print(f"{data[0]['id']} ==> {data[0]['audio_url']}")
-                print(f"{data[1]['id']} ==> {data[1]['audio_url']}")
-                break
-            # sleep 5s
-            time.sleep(5)
-        # return the audio urls
-        urls = [data[0]["audio_url"], data[1]["audio_url"]]
-        return urls
-        # return response.json()
+        return [clip["id"] for clip in data]
+
+    @staticmethod
+    def clips_ready(data, complete=False):
+        # the audio urls can be played once the clips are streaming, but
+        # the whole file can only be downloaded once they are complete
+        ready = ("complete",) if complete else ("streaming", "complete")
+        return all(clip["status"] in ready for clip in data)
 
     @classmethod
     def get_audio_information(cls, audio_ids):
+        import requests
+
         url = f"{cls.base_url}/api/get?ids={audio_ids}"
-        response = requests.get(url)
-        return response.json()
+        with METRICS.timed("suno_request_seconds", call="get"):
+            response = requests.get(url)
+            return response.json()
 
     @classmethod
     def get_limits(cls):
+        import requests
+
         url = f"{cls.base_url}/api/get_limit"
-        response = requests.get(url)
+        with METRICS.timed("suno_request_seconds", call="get_limit"):
+            response = requests.get(url)
         if response.status_code == 200:
             return response.json()
         else:
@@ -77,45 +88,87 @@ class SunoAPI:
 
 
 class AwsEc2Api:
-    my_config = Config(
+    my_config = dict(
         region_name="eu-west-2",
         signature_version="v4",
         retries={"max_attempts": 10, "mode": "standard"},
     )
+    # boto3 clients are slow to create, so one per service is kept,
+    # created on first use (they are thread safe once created)
+    _clients = {}
+    _clients_lock = threading.Lock()
+
+    @classmethod
+    def client(cls, service):
+        with cls._clients_lock:
+            client = cls._clients.get(service)
+            if client is None:
+                import boto3
+                from botocore.config import Config
+
+                client = boto3.client(service, config=Config(**cls.my_config))
+                cls._clients[service] = client
+            return client
 
     @classmethod
     def change_instance_state(cls, action, instance_id):
-        ec2 = boto3.client("ec2", config=cls.my_config)
+        ec2 = cls.client("ec2")
+        from botocore.exceptions import ClientError
 
         ret_txt = "aye, looks like that worked"
         if action == "ON":
             try:
-                response = ec2.start_instances(InstanceIds=[instance_id], DryRun=False)
-                print(response)
+                with METRICS.timed("aws_request_seconds", call="start_instances"):
+                    response = ec2.start_instances(
+                        InstanceIds=[instance_id], DryRun=False
+                    )
+                log.debug("%s", response)
             except ClientError as e:
-                print(e)
+                log.warning("%s", e)
                 ret_txt = str(e)
         elif action == "OFF":
             try:
-                response = ec2.stop_instances(InstanceIds=[instance_id], DryRun=False)
-                print(response)
+                with METRICS.timed("aws_request_seconds", call="stop_instances"):
+                    response = ec2.stop_instances(
+                        InstanceIds=[instance_id], DryRun=False
+                    )
+                log.debug("%s", response)
             except ClientError as e:
-                print(e)
+                log.warning("%s", e)
                 ret_txt = str(e)
         elif action == "REBOOT":
             try:
-                response = ec2.reboot_instances(InstanceIds=[instance_id], DryRun=False)
-                print(response)
+                with METRICS.timed("aws_request_seconds", call="reboot_instances"):
+                    response = ec2.reboot_instances(
+                        InstanceIds=[instance_id], DryRun=False
+                    )
+                log.debug("%s", response)
             except ClientError as e:
-                print(e)
+                log.warning("%s", e)
                 ret_txt = str(e)
 
         return ret_txt
 
+    @classmethod
+    def describe_instances(cls, instance_ids):
+        # {instance_id: (state, public ip)} for all the instances in one call
+        ec2 = cls.client("ec2")
+        with METRICS.timed("aws_request_seconds", call="describe_instances"):
+            response = ec2.describe_instances(InstanceIds=list(instance_ids))
+        states = {}
+        for reservation in response["Reservations"]:
+            for instance in reservation["Instances"]:
+                states[instance["InstanceId"]] = (
+                    instance["State"]["Name"],
+                    instance.get("PublicIpAddress"),
+                )
+        return states
+
     @classmethod
     def get_instance_cost(cls, tag_key, tag_value, days):
         # Create a Cost Explorer client
-        ce = boto3.client("ce", config=clsmy_config)
+        ce = cls.client("ce")
+        from botocore.exceptions import ClientError
 
         # Calculate the start and end dates for the past N days
         end = datetime.utcnow().date()
@@ -130,13 +183,14 @@ class AwsEc2Api:
 
         # Try to retrieve the cost information, using tags for the given instance
         try:
-            data = ce.get_cost_and_usage(
-                TimePeriod={"Start": start, "End": end},
-                Granularity="DAILY",
-                Metrics=["UnblendedCost"],
-                GroupBy=[{"Type": "TAG", "Key": tag_key}],
-                Filter=tag_filter,
-            )
+            with METRICS.timed("aws_request_seconds", call="get_cost_and_usage"):
+                data = ce.get_cost_and_usage(
+                    TimePeriod={"Start": start, "End": end},
+                    Granularity="DAILY",
+                    Metrics=["UnblendedCost"],
+                    GroupBy=[{"Type": "TAG", "Key": tag_key}],
+                    Filter=tag_filter,
+                )
 
             # Calculate the total cost
             total_cost = sum(
@@ -151,5 +205,5 @@ class AwsEc2Api:
             return ret_txt
 
         except ClientError as e:
-            print(e)
+            log.warning("%s", e)
             return None